@@ -0,0 +1,163 @@
+import mysql.connector
+from mysql.connector import pooling
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from structuredLogging import getLogger
+
+"""
+Pooled connection layer for the MySQL database.
+
+Every request checks out its own connection from the pool, so concurrent requests
+no longer share (and corrupt) a single MySQL session. Connections are health checked
+when they are checked out and transparently reconnected if the server dropped them.
+
+Usage from synchronous code:
+    with dbPool.transaction() as (mydb, cursor):
+        cursor.execute(...)
+
+Usage from asynchronous code:
+    result = await dbPool.runAsync(someBlockingFunction, arg1, arg2)
+"""
+
+logger = getLogger(__name__)
+
+
+class DBPool:
+    def __init__(self, poolName: str = "tasteai_pool", poolSize: int = None, checkoutTimeout: float = None):
+        """
+        poolName: name used by mysql-connector to identify the pool.
+        poolSize: maximum number of simultaneous connections (DB_POOL_SIZE, 5 by default).
+        checkoutTimeout: seconds to wait for a free connection before giving up (DB_POOL_TIMEOUT, 10 by default).
+        """
+        load_dotenv()
+        self.poolName = poolName
+        self.poolSize = poolSize or int(os.environ.get("DB_POOL_SIZE", 5))
+        self.checkoutTimeout = checkoutTimeout or float(os.environ.get("DB_POOL_TIMEOUT", 10))
+        self.pool = None
+        self.lock = threading.Lock()
+        # One worker thread per pooled connection, so async callers never queue more
+        # blocking queries than the pool is able to serve
+        self.executor = ThreadPoolExecutor(max_workers=self.poolSize, thread_name_prefix="db")
+
+    def createPool(self) -> pooling.MySQLConnectionPool:
+        """
+        Create the connection pool if it does not exist yet. If the database was not reachable
+        the last time, the creation is attempted again, so the service recovers without a restart.
+
+        Returns:
+        The MySQL connection pool, or None if the database is not reachable.
+        """
+        if self.pool is not None:
+            return self.pool
+        with self.lock:
+            if self.pool is None:
+                try:
+                    self.pool = pooling.MySQLConnectionPool(
+                        pool_name=self.poolName,
+                        pool_size=self.poolSize,
+                        pool_reset_session=True,
+                        host=os.environ.get("DB_HOST"),
+                        user=os.environ.get("DB_USER"),
+                        password=os.environ.get("DB_PASSWORD"),
+                        database=os.environ.get("DB_DATABASE")
+                    )
+                    logger.info(f"Database {os.environ.get('DB_DATABASE')} connected with a pool of {self.poolSize} connections")
+                except Exception as e:
+                    logger.error(f"Error when creating the connection pool for {os.environ.get('DB_DATABASE')}: {e}")
+                    self.pool = None
+        return self.pool
+
+    def getConnection(self):
+        """
+        Check out a healthy connection from the pool. Waits up to checkoutTimeout seconds
+        when every connection is busy, and reconnects connections dropped by the server.
+
+        Returns:
+        A pooled MySQL connection. Calling close() on it returns it to the pool.
+
+        Raises:
+        mysql.connector.Error if no healthy connection could be obtained.
+        """
+        deadline = time.monotonic() + self.checkoutTimeout
+        while True:
+            pool = self.createPool()
+            if pool is None:
+                raise mysql.connector.errors.InterfaceError("Database connection is not available")
+            try:
+                connection = pool.get_connection()
+            except mysql.connector.errors.PoolError:
+                # Every connection is in use, wait for one to be returned
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+                continue
+
+            try:
+                # Health check, reconnects if the server closed the session
+                connection.ping(reconnect=True, attempts=3, delay=1)
+                return connection
+            except Exception as e:
+                logger.warning(f"Discarding unhealthy database connection: {e}")
+                connection.close()
+                if time.monotonic() >= deadline:
+                    raise
+
+    @contextmanager
+    def transaction(self, dictionary: bool = False):
+        """
+        Per-request transaction. Commits when the block finishes, rolls back if an exception
+        escapes it, and always returns the connection to the pool.
+
+        Arguments:
+        dictionary: if True, the cursor returns rows as dictionaries.
+
+        Yields:
+        (connection, cursor) tuple.
+        """
+        connection = self.getConnection()
+        cursor = connection.cursor(dictionary=dictionary)
+        try:
+            yield connection, cursor
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            connection.close()
+
+    async def runAsync(self, func, *args, **kwargs):
+        """
+        Run a blocking database function without blocking the event loop.
+
+        Arguments:
+        func: blocking callable that uses the pool.
+        args, kwargs: arguments forwarded to func.
+
+        Returns:
+        The value returned by func.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(*args, **kwargs))
+
+    def isAvailable(self) -> bool:
+        """
+        Check whether the database can be reached.
+
+        Returns:
+        True if a healthy connection could be checked out, False otherwise.
+        """
+        try:
+            connection = self.getConnection()
+            connection.close()
+            return True
+        except Exception:
+            return False
+
+
+dbPool = DBPool()
@@ -1,21 +1,31 @@
-import mysql.connector
 import os
 from dotenv import load_dotenv
-import bcrypt
 from models import User, UserLogin,BasicInformationUser,AdditionalInformationUser, UserFeedback
 from pydantic import EmailStr
-from openai import OpenAI
 import json
 from datetime import datetime
 from typing import Optional, Dict, Any
-from processingAgent import MultiLLMService
+from processingAgent import MultiLLMService, PartialJSONObjectParser
 from vectorizedDatabase import PineconeVectorizedDatabase
-from string import Template
+from promptRegistry import promptRegistry
+from promptContext import PromptContextBuilder, getPromptBudget, summarizeMenu, compactJSON
+from dbPool import dbPool
+from llmCache import LLMResponseCache
+from indexingQueue import EmbeddingIndexingQueue
+from userCache import UserProfileCache
+from passwordHasher import passwordHasher
+from nutritionEngine import nutritionEngine, getMacroTargets, parseAllergies, MACRO_TARGET_COLUMNS
+from menuPlanner import menuPlanner
+from recipeLibrary import recipeLibrary
+from lazyResources import lazy
+from structuredLogging import getLogger, logPayload
 load_dotenv()
 
+logger = getLogger(__name__)
+
 """
 List of functions to interact with the database.
-1. DBConnect: Connects to the database and creates a cursor.
+1. DBConnect: Initializes the database connection pool.
 2. createUsersTable: Creates the users table in the database.
 3. deleteSpecificTable: Deletes a specific table from the database.
 4. deleteAllElementsFromTable: Deletes all elements from a specific table.
@@ -34,110 +44,142 @@ List of functions to interact with the database.
 17. gatherDataToAlterDailyMenu: Gathers data to alter the daily menu of a user.
 18. getDailyModifiedMenu: Gets the modified daily menu of a user.
 19. saveModifiedDailyMenu: Saves the modified daily menu of a user.
+20. buildWeeklyMenusPrompt: Builds the prompt used to generate the weekly menus of a user.
+21. getWeeklyMenusStream: Streams the weekly menus of a user day by day.
+22. getChatMessagesByIds: Fetches several chat messages of a user with a single query.
+23. createMealsTables: Creates the versioned menu, day revision, meal and ingredient tables.
+24. migrateMenusToMeals: Moves the JSON menus of user_menus to the meals tables.
+25. getMealsByDay: Gets the meals of a single day of a user's menu.
+26. getWeeklyMacroTotals: Gets the daily and weekly macro totals of a user's menu.
+27. upgradeMealsTablesToVersions: Upgrades unversioned meals tables to versioned menus.
+28. getMenuAt: Gets the menu of a user as it was at a given moment.
+29. getMenuHistory: Gets the recent weekly menus of a user with their macro totals.
+30. rehashPassword: Replaces the password hash of a user made with an older cost factor.
+31. checkMenuNutrition: Recomputes the macros of a generated menu and rescales the days outside the macro bands.
+32. planWeeklyMenus: Builds the weekly menus of a user with the local menu planner, without the LLM.
+33. indexUserRecipes: Adds the meals of a saved menu to the recipe library.
 """
 
 
 
 def DBConnect():
     """
-    Function to connect to the database and create a cursor.
+    Function to initialize the database connection pool.
+    Connections are checked out per request through dbPool.transaction().
     Returns:
-        mydb: MySQL connection object
-        cursor: MySQL cursor object
+        dbPool: DBPool object, or None if the database is not reachable
     """
-    try:
-        mydb = mysql.connector.connect(
-            host=os.environ.get("DB_HOST"),
-            user=os.environ.get("DB_USER"),
-            password=os.environ.get("DB_PASSWORD"),
-            database=os.environ.get("DB_DATABASE")
-        )
-        print(f"Database {os.environ.get('DB_DATABASE')} connected")
-        return mydb
-    except Exception as e:
-        print(f"Error when connecting to {os.environ.get('DB_DATABASE')} and creating the cursor: {e}")
+    if dbPool.createPool() is None:
         return None
+    return dbPool
 
 
 
-mydb= DBConnect()
+#Columns of the users table that can be read through viewUserById. The password hash is never cached
+USER_PROFILE_COLUMNS = [
+    "id", "name", "email", "sex", "objective", "age", "weight", "height",
+    "allergies", "sportive_description", "medical_conditions", "food_preferences",
+    "recommended_daily_calories", "recommended_water_intake", "recommended_protein_intake",
+    "recommended_fats_intake", "recommended_carbohydrates_intake", "nutritional_deficiency_risks",
+    "general_recommendation", "country", "weekly_calories", "weekly_protein", "weekly_fats",
+    "weekly_carbohydrates", "imc"
+]
 
-# Check if database connection was successful before proceeding
-if mydb is None:
-    print("ERROR: Database connection failed. Please check your environment variables and database configuration.")
+#Keys of a meal that are stored in their own column of menu_meals or in meal_ingredients
+MEAL_COLUMNS = ["type", "hour", "ingredients", "instructions", "calories", "protein", "fats", "carbohydrates"]
 
-#Now initialize the processing agent
-AIAgent = MultiLLMService([])
-AIAgent.providers = [
-    AIAgent.gemini_provider,
-    AIAgent.openai_provider,
-    AIAgent.anthropic_provider
-]
+#Cache of user profiles, invalidated by every write to the users table
+userProfileCache = UserProfileCache()
+
+#The database pool and the external clients below are created on first use, so importing this module
+#does not connect to anything (see lazyResources.py)
+def createAIAgent():
+    #Processing agent, with a persistent cache of responses in front of it
+    agent = MultiLLMService([], cache=LLMResponseCache() if os.environ.get("LLM_CACHE_ENABLED", "true").lower() == "true" else None)
+    agent.providers = [
+        agent.gemini_provider,
+        agent.openai_provider,
+        agent.anthropic_provider
+    ]
+    return agent
+
+AIAgent = lazy("AI agent", createAIAgent)
+
+vectorizedDB = lazy("vectorized database", PineconeVectorizedDatabase)
+
+#Chat messages are embedded and upserted by a background worker
+#Responses larger than this are not copied into the vector metadata (Pinecone allows 40 KB per vector)
+CHAT_METADATA_MAX_BYTES=int(os.environ.get("CHAT_METADATA_MAX_BYTES", 30000))
+
+# Maximum tokens of a single chat message in the context of getDailyModifiedMenu
+CHAT_CONTEXT_MESSAGE_TOKENS=int(os.environ.get("CHAT_CONTEXT_MESSAGE_TOKENS", 400))
 
-#Now initialize the vectorized database
-vectorizedDB= PineconeVectorizedDatabase()
+# Weekly menus kept per user, older ones are pruned when a new menu is saved
+MENU_HISTORY_WEEKS=int(os.environ.get("MENU_HISTORY_WEEKS", 8))
+
+# Whether generated menus are checked and repaired by the nutrition engine before being saved
+NUTRITION_REPAIR=os.environ.get("NUTRITION_REPAIR", "true").lower() == "true"
+
+# Default engine of getWeeklyMenus: "llm", "planner" (local menu planner) or "auto" (planner for simple profiles)
+MENU_ENGINE=os.environ.get("MENU_ENGINE", "llm").lower()
+#Returned by getWeeklyMenus when the generated menu could not be saved
+MENU_SAVE_ERROR={"status": "error", "error": "Menu not saved", "message": "Failed to save menus, please, try again"}
+indexingQueue = lazy("indexing queue", lambda: EmbeddingIndexingQueue(vectorizedDB))
 
 def createUsersTable():
     """
     Function to create the users table in the database.
     This function does not return any value.
     """
-    
-    global mydb
-    
     # Check if database connection is valid
-    if mydb is None or not mydb.is_connected():
-        print("ERROR: Database connection is not available. Cannot create users table.")
+    if not dbPool.isAvailable():
+        logger.error("Database connection is not available. Cannot create users table.")
         return
     
-    cursor = mydb.cursor()
-
     if not checkIfTableExists("users"):
-        print("Creating table 'users'...")
+        logger.info("Creating table 'users'...")
         try:
-            user_initial_query = """
-            CREATE TABLE IF NOT EXISTS users (
-                id INT PRIMARY KEY AUTO_INCREMENT,
-                name VARCHAR(25) DEFAULT 'USER',
-                email VARCHAR(50),
-                password VARCHAR(60),
-                sex VARCHAR(10),
-                objective VARCHAR(20) DEFAULT NULL,
-                age INT,
-
-                weight FLOAT DEFAULT NULL,
-                height FLOAT DEFAULT NULL,
-                allergies TEXT DEFAULT NULL,
-                sportive_description TEXT DEFAULT NULL,
-                medical_conditions TEXT DEFAULT NULL,
-                food_preferences TEXT DEFAULT NULL,
-
-                recommended_daily_calories FLOAT DEFAULT NULL,
-                recommended_water_intake FLOAT DEFAULT NULL,
-                recommended_protein_intake FLOAT DEFAULT NULL,
-                recommended_fats_intake FLOAT DEFAULT NULL,
-                recommended_carbohydrates_intake FLOAT DEFAULT NULL,
-                nutritional_deficiency_risks TEXT DEFAULT NULL,
-                general_recommendation TEXT DEFAULT NULL,
-                country TEXT DEFAULT NULL,
-                weekly_calories TEXT DEFAULT NULL,
-                weekly_protein TEXT DEFAULT NULL,
-                weekly_fats TEXT DEFAULT NULL,
-                weekly_carbohydrates TEXT DEFAULT NULL,
-                imc FLOAT DEFAULT NULL
-
-            )
-            """
-            cursor.execute(user_initial_query)
-            mydb.commit()
-            print(f"Table 'users' created successfully")
-            cursor.close()
+            with dbPool.transaction() as (mydb, cursor):
+                user_initial_query = """
+                CREATE TABLE IF NOT EXISTS users (
+                    id INT PRIMARY KEY AUTO_INCREMENT,
+                    name VARCHAR(25) DEFAULT 'USER',
+                    email VARCHAR(50),
+                    password VARCHAR(60),
+                    sex VARCHAR(10),
+                    objective VARCHAR(20) DEFAULT NULL,
+                    age INT,
+
+                    weight FLOAT DEFAULT NULL,
+                    height FLOAT DEFAULT NULL,
+                    allergies TEXT DEFAULT NULL,
+                    sportive_description TEXT DEFAULT NULL,
+                    medical_conditions TEXT DEFAULT NULL,
+                    food_preferences TEXT DEFAULT NULL,
+
+                    recommended_daily_calories FLOAT DEFAULT NULL,
+                    recommended_water_intake FLOAT DEFAULT NULL,
+                    recommended_protein_intake FLOAT DEFAULT NULL,
+                    recommended_fats_intake FLOAT DEFAULT NULL,
+                    recommended_carbohydrates_intake FLOAT DEFAULT NULL,
+                    nutritional_deficiency_risks TEXT DEFAULT NULL,
+                    general_recommendation TEXT DEFAULT NULL,
+                    country TEXT DEFAULT NULL,
+                    weekly_calories TEXT DEFAULT NULL,
+                    weekly_protein TEXT DEFAULT NULL,
+                    weekly_fats TEXT DEFAULT NULL,
+                    weekly_carbohydrates TEXT DEFAULT NULL,
+                    imc FLOAT DEFAULT NULL
+
+                )
+                """
+                cursor.execute(user_initial_query)
+                mydb.commit()
+                logger.info(f"Table 'users' created successfully")
 
         except Exception as e:
-            print(f"Something went wrong when creating the user table: {e}")
-            cursor.close()
+            logger.error(f"Something went wrong when creating the user table: {e}")
     else:
-        cursor.close()
         return None
     
 
@@ -152,15 +194,11 @@ def createMenusTable():
     Returns:
     Raw text message describing the success or not of the query
     """
-    global mydb
-    
     # Check if database connection is valid
-    if mydb is None or not mydb.is_connected():
-        print("ERROR: Database connection is not available. Cannot create menus table.")
+    if not dbPool.isAvailable():
+        logger.error("Database connection is not available. Cannot create menus table.")
         return
     
-    cursor = mydb.cursor()
-
     create_menus_table_query="""
     CREATE TABLE if NOT EXISTS user_menus (
         user_id INT PRIMARY KEY,
@@ -177,11 +215,211 @@ def createMenusTable():
     );
     """
     try:
-        cursor.execute(create_menus_table_query)
-        mydb.commit()
-        print("Menus table created successfully")
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute(create_menus_table_query)
+            mydb.commit()
+        logger.info("Menus table created successfully")
     except Exception as e:
-        print("There was an error when creating the menus table", e)
+        logger.error(f"There was an error when creating the menus table: {e}")
+
+
+
+def createMealsTables():
+    """
+    Function to create the append-only tables that store the menus:
+    - menu_versions: one row per generated weekly menu of a user.
+    - menu_day_revisions: one row per version of a day. Generating a menu creates revision 0 of
+      every day, and each modification of a day adds a new revision instead of rewriting it.
+    - menu_meals: one row per meal of a day revision, with its macros.
+    - meal_ingredients: one row per ingredient of a meal.
+
+    Args:
+    None
+
+    Returns:
+    Raw text message describing the success or not of the query
+    """
+    create_menu_versions_table_query="""
+    CREATE TABLE if NOT EXISTS menu_versions (
+        version_id INT PRIMARY KEY AUTO_INCREMENT,
+        user_id INT NOT NULL,
+        creationDate DATETIME NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+            ON DELETE CASCADE,
+        INDEX idx_user_creation (user_id, creationDate)
+    );
+    """
+    create_menu_day_revisions_table_query="""
+    CREATE TABLE if NOT EXISTS menu_day_revisions (
+        version_id INT NOT NULL,
+        day INT NOT NULL,
+        revision INT NOT NULL,
+        creationDate DATETIME NOT NULL,
+        PRIMARY KEY (version_id, day, revision),
+        FOREIGN KEY (version_id) REFERENCES menu_versions(version_id)
+            ON DELETE CASCADE,
+        INDEX idx_version_day_creation (version_id, day, creationDate)
+    );
+    """
+    create_menu_meals_table_query="""
+    CREATE TABLE if NOT EXISTS menu_meals (
+        meal_id INT PRIMARY KEY AUTO_INCREMENT,
+        version_id INT NOT NULL,
+        user_id INT NOT NULL,
+        day INT NOT NULL,
+        revision INT NOT NULL DEFAULT 0,
+        position INT NOT NULL,
+        type VARCHAR(20) DEFAULT NULL,
+        hour VARCHAR(10) DEFAULT NULL,
+        instructions TEXT DEFAULT NULL,
+        calories INT DEFAULT NULL,
+        protein INT DEFAULT NULL,
+        fats INT DEFAULT NULL,
+        carbohydrates INT DEFAULT NULL,
+        extra TEXT DEFAULT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+            ON DELETE CASCADE,
+        FOREIGN KEY (version_id) REFERENCES menu_versions(version_id)
+            ON DELETE CASCADE,
+        UNIQUE KEY uq_version_day_revision_position (version_id, day, revision, position),
+        INDEX idx_user_type (user_id, type)
+    );
+    """
+    create_meal_ingredients_table_query="""
+    CREATE TABLE if NOT EXISTS meal_ingredients (
+        meal_id INT NOT NULL,
+        position INT NOT NULL,
+        ingredient VARCHAR(255) NOT NULL,
+        PRIMARY KEY (meal_id, position),
+        FOREIGN KEY (meal_id) REFERENCES menu_meals(meal_id)
+            ON DELETE CASCADE,
+        INDEX idx_ingredient (ingredient)
+    );
+    """
+    try:
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute(create_menu_versions_table_query)
+            cursor.execute(create_menu_day_revisions_table_query)
+            cursor.execute(create_menu_meals_table_query)
+            cursor.execute(create_meal_ingredients_table_query)
+            mydb.commit()
+        logger.info("Meals tables created successfully")
+    except Exception as e:
+        logger.error(f"There was an error when creating the meals tables: {e}")
+
+
+
+def upgradeMealsTablesToVersions():
+    """
+    Function to upgrade a menu_meals table created before menus were versioned.
+    The meals of each user become version 0 of their menu, dated with the creation date in user_menus.
+    Every user is committed on its own: the ALTER TABLE statements commit implicitly, so an upgrade
+    that stopped midway is resumed from the meals that still have no version.
+
+    Args:
+    None
+
+    Returns:
+    Number of upgraded menus
+    """
+    with dbPool.transaction() as (mydb, cursor):
+        cursor.execute("SHOW COLUMNS FROM menu_meals LIKE 'version_id'")
+        column=cursor.fetchone()
+    # The last step makes version_id NOT NULL, a nullable column means the upgrade did not finish
+    if column and column[2] == "NO":
+        logger.info("menu_meals is already versioned")
+        return 0
+
+    createMealsTables()
+    if not column:
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("""
+                ALTER TABLE menu_meals
+                ADD COLUMN version_id INT NULL AFTER meal_id,
+                ADD COLUMN revision INT NOT NULL DEFAULT 0 AFTER day
+            """)
+    else:
+        logger.info("Resuming the upgrade of menu_meals to versioned storage")
+
+    with dbPool.transaction() as (mydb, cursor):
+        cursor.execute("""
+            SELECT m.user_id, COALESCE(u.creationDate, CURRENT_DATE) FROM menu_meals m
+            LEFT JOIN user_menus u ON u.user_id = m.user_id
+            WHERE m.version_id IS NULL GROUP BY m.user_id, u.creationDate
+        """)
+        users_with_meals=cursor.fetchall()
+    for user_id, creation_date in users_with_meals:
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("INSERT INTO menu_versions (user_id, creationDate) VALUES (%s, %s)", (user_id, creation_date))
+            version_id=cursor.lastrowid
+            cursor.execute("UPDATE menu_meals SET version_id = %s WHERE user_id = %s AND version_id IS NULL", (version_id, user_id))
+            cursor.execute("""
+                INSERT INTO menu_day_revisions (version_id, day, revision, creationDate)
+                SELECT DISTINCT %s, day, 0, %s FROM menu_meals WHERE version_id = %s
+            """, (version_id, creation_date, version_id))
+            mydb.commit()
+
+    with dbPool.transaction() as (mydb, cursor):
+        cursor.execute("""
+            ALTER TABLE menu_meals
+            MODIFY version_id INT NOT NULL,
+            DROP INDEX uq_user_day_position,
+            ADD UNIQUE KEY uq_version_day_revision_position (version_id, day, revision, position),
+            ADD FOREIGN KEY (version_id) REFERENCES menu_versions(version_id) ON DELETE CASCADE
+        """)
+    logger.info(f"Upgraded {len(users_with_meals)} menus to versioned storage")
+    return len(users_with_meals)
+
+
+
+def migrateMenusToMeals():
+    """
+    Function to move the menus stored as JSON in the day1...day7 columns of user_menus
+    to the versioned meals tables. Migrated columns are set to NULL, so the migration can
+    be run again safely.
+
+    Args:
+    None
+
+    Returns:
+    Number of migrated menus
+    """
+    select_legacy_menus_query="""
+        SELECT user_id, day1, day2, day3, day4, day5, day6, day7, creationDate FROM user_menus
+        WHERE day1 IS NOT NULL OR day2 IS NOT NULL OR day3 IS NOT NULL OR day4 IS NOT NULL
+        OR day5 IS NOT NULL OR day6 IS NOT NULL OR day7 IS NOT NULL
+    """
+    clear_legacy_columns_query="""
+        UPDATE user_menus SET day1 = NULL, day2 = NULL, day3 = NULL, day4 = NULL,
+        day5 = NULL, day6 = NULL, day7 = NULL WHERE user_id = %s
+    """
+    with dbPool.transaction() as (mydb, cursor):
+        cursor.execute(select_legacy_menus_query)
+        legacy_menus=cursor.fetchall()
+
+    migrated=0
+    for legacy_menu in legacy_menus:
+        user_id=legacy_menu[0]
+        creation_date=legacy_menu[8] or datetime.now()
+        try:
+            with dbPool.transaction() as (mydb, cursor):
+                cursor.execute("INSERT INTO menu_versions (user_id, creationDate) VALUES (%s, %s)", (user_id, creation_date))
+                version_id=cursor.lastrowid
+                for day in range(1, 8):
+                    day_data=legacy_menu[day]
+                    meals=None
+                    if day_data:
+                        try:
+                            meals=json.loads(day_data)
+                        except json.JSONDecodeError:
+                            logger.warning(f"Skipping day {day} of user {user_id}: invalid JSON")
+                    insertDayRevision(cursor, user_id, version_id, day, 0, meals or [], creation_date)
+                cursor.execute(clear_legacy_columns_query, (user_id,))
+            migrated+=1
+        except Exception as e:
+            logger.error(f"Error migrating the menu of user {user_id}: {e}")
+    logger.info(f"Migrated {migrated} menus to the meals tables")
+    return migrated
 
 
 
@@ -197,9 +435,6 @@ def createChatHistoryTable():
     Return:
     Raw message of success or failure
     """
-    global mydb
-    cursor=mydb.cursor()
-
     create_chat_history_table_query="""
     CREATE TABLE if NOT EXISTS chat_history (
         message_id INT PRIMARY KEY AUTO_INCREMENT,
@@ -214,11 +449,12 @@ def createChatHistoryTable():
     );
     """
     try:
-        cursor.execute(create_chat_history_table_query)
-        mydb.commit()
-        print("Chat history table created successfully")
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute(create_chat_history_table_query)
+            mydb.commit()
+        logger.info("Chat history table created successfully")
     except Exception as e:
-        print("There was an error when creating the chat history table", e)
+        logger.error(f"There was an error when creating the chat history table: {e}")
 
 
 
@@ -232,23 +468,18 @@ def deleteSpecificTable(tableName:str):
     returns:
         Doesn't return a value
     """
-    global mydb
-    cursor= mydb.cursor()
-
     if not checkIfTableExists(tableName):
-        print(f"Table {tableName} does not exist, nothing to delete.")
-        cursor.close()
+        logger.warning(f"Table {tableName} does not exist, nothing to delete.")
     else:
-        print(f"Deleting table {tableName}...")
+        logger.info(f"Deleting table {tableName}...")
         try:
-            delete_specific_table_query=f"DROP TABLE IF EXISTS {tableName}"
-            cursor.execute(delete_specific_table_query)
-            mydb.commit()
-            print(f"Successfully deleted table {tableName}")
-            cursor.close()
+            with dbPool.transaction() as (mydb, cursor):
+                delete_specific_table_query=f"DROP TABLE IF EXISTS {tableName}"
+                cursor.execute(delete_specific_table_query)
+                mydb.commit()
+            logger.info(f"Successfully deleted table {tableName}")
         except Exception as e:
-            cursor.close()
-            print(f"Something went wrong when deleting table {tableName}: {e}")
+            logger.error(f"Something went wrong when deleting table {tableName}: {e}")
 
 
 
@@ -261,17 +492,14 @@ def deleteAllElementsFromTable(tableName:str):
     Returns:
         Doesn't return a value
     """
-    global mydb
-    cursor = mydb.cursor()
     if checkIfTableExists(tableName):
-        delete_all_elements_from_table_query = f"TRUNCATE TABLE {tableName}"
-        cursor.execute(delete_all_elements_from_table_query)
-        mydb.commit()
-        print(f"All elements from table {tableName} have been deleted.")
-        cursor.close()
+        with dbPool.transaction() as (mydb, cursor):
+            delete_all_elements_from_table_query = f"TRUNCATE TABLE {tableName}"
+            cursor.execute(delete_all_elements_from_table_query)
+            mydb.commit()
+        logger.info(f"All elements from table {tableName} have been deleted.")
     else:
-        print(f"Table {tableName} does not exist, nothing to delete.")
-        cursor.close()
+        logger.warning(f"Table {tableName} does not exist, nothing to delete.")
     return None
 
 
@@ -283,12 +511,9 @@ def checkIfTableExists(tableName: str):
     Returns:
         bool: True if the table exists, False otherwise.
     """
-    global mydb
-
-    cursor = mydb.cursor()
-    cursor.execute("SHOW TABLES")
-    tables= [table[0] for table in cursor.fetchall()]
-    cursor.close()
+    with dbPool.transaction() as (mydb, cursor):
+        cursor.execute("SHOW TABLES")
+        tables= [table[0] for table in cursor.fetchall()]
     if tableName in tables:
         return True
     else:
@@ -305,50 +530,44 @@ def signUpUser(user:User):
         A dictionary containing a success message and the user details if the user was created successfully,
         or an error message if the user already exists or if there was an error during the creation process.
         """
-    global mydb
-    cursor = mydb.cursor()
-
-    #Verify if the email already exists
-    check_existing_email_query = f"""
-    SELECT EXISTS (
-        SELECT 1 FROM users WHERE email = %s
-    );
+    # Hash the password before taking a connection from the pool (in the password hashing process pool)
+    hashed_password = passwordHasher.hash(user.password)
+    with dbPool.transaction() as (mydb, cursor):
+        #Verify if the email already exists
+        check_existing_email_query = f"""
+        SELECT EXISTS (
+            SELECT 1 FROM users WHERE email = %s
+        );
 
-    """
-    cursor.execute(check_existing_email_query, (user.email,))
-    email_exists = cursor.fetchone()[0]
-    if not email_exists:
-        try:
-            # Hash the password before storing it
-            salt = bcrypt.gensalt()
-            hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), salt)
-
-            create_new_user_query = """
-            INSERT INTO users (name, email, password, sex, age) 
-            VALUES (%s, %s, %s, %s, %s)
-            """
+        """
+        cursor.execute(check_existing_email_query, (user.email,))
+        email_exists = cursor.fetchone()[0]
+        if not email_exists:
+            try:
+                create_new_user_query = """
+                INSERT INTO users (name, email, password, sex, age) 
+                VALUES (%s, %s, %s, %s, %s)
+                """
 
-            cursor.execute(create_new_user_query, (
-            user.name,
-            user.email,
-            hashed_password.decode('utf-8'),  # Decode bytes to string for storage
-            user.sex,
-            user.age
-            ))
-            mydb.commit()
+                cursor.execute(create_new_user_query, (
+                user.name,
+                user.email,
+                hashed_password,
+                user.sex,
+                user.age
+                ))
+                mydb.commit()
 
-            print(f"Successfully added user {user.name}")
+                logger.info(f"Successfully added user {user.name}")
 
-            cursor.close()
-            return {"message": "User created successfully. Please, Login", "user": user}
-        except Exception as e:
-            print(f"Something went wrong when appending a new user: {e} ")
-            cursor.close()
-            return {"message": "Error when creating the user", "error": "Internal server error"}
-    else:
-        print(f"User with email {user.email} already exists.")
-        cursor.close()
-        return {"message": "User already exists", "email": user.email, "error": "User with this email already exists"}
+                return {"message": "User created successfully. Please, Login", "user": user}
+            except Exception as e:
+                mydb.rollback()
+                logger.error(f"Something went wrong when appending a new user: {e} ")
+                return {"message": "Error when creating the user", "error": "Internal server error"}
+        else:
+            logger.warning(f"User with email {user.email} already exists.")
+            return {"message": "User already exists", "email": user.email, "error": "User with this email already exists"}
 
 
 
@@ -360,58 +579,86 @@ def signInUser(user:UserLogin):
         A dictionary containing a success message and user details if login is successful,
         or an error message if the login fails.
     """
-    global mydb
-    cursor = mydb.cursor(dictionary=True)
     try:
-        # Check if the user exists
-        check_user_query = f"SELECT * FROM users WHERE email = %s"
-        cursor.execute(check_user_query, (user.email,))
-        user_data = cursor.fetchone()
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            # Check if the user exists
+            check_user_query = f"SELECT * FROM users WHERE email = %s"
+            cursor.execute(check_user_query, (user.email,))
+            user_data = cursor.fetchone()
         if user_data:
-            stored_hashed_password = user_data['password'].encode('utf-8')
-            if bcrypt.checkpw(user.password.encode('utf-8'), stored_hashed_password):
-                print(f"User {user.email} logged in successfully.")
+            stored_hashed_password = user_data['password']
+            if passwordHasher.verify(user.password, stored_hashed_password):
+                logger.info(f"User {user.email} logged in successfully.")
+                # The password is known here, so a hash made with an older cost factor is replaced transparently
+                if passwordHasher.needsRehash(stored_hashed_password):
+                    rehashPassword(user_data['id'], user.password)
                 user_whole_information= viewUserByEmail(user.email)
                 user_data.update(user_whole_information)
                 return {"message": "Login successful", "user": user_data}
             else:
                 return {"message": "Incorrect password", "error": "Invalid password"}
         else:
-            print(f"User with email {user.email} does not exist.")
+            logger.warning(f"User with email {user.email} does not exist.")
             return {"message": "User does not exist", "error": "User with this email does not exist"}
     except Exception as e:
-        print(f"Something went wrong when logging in user {user.email}: {e}")
+        logger.error(f"Something went wrong when logging in user {user.email}: {e}")
         return {"message": "Unexpected error during login", "error": "Internal server error"}
-    finally:
-        cursor.close()
 
 
 
-def viewUserById(user_id: int):
-    """Function to view a user by their ID.
+def rehashPassword(user_id: int, password: str):
+    """Function to replace the stored hash of a user with one made with the configured cost factor.
+    Errors are logged and ignored: the old hash keeps working.
+    Args:
+        user_id (int): The ID of the user.
+        password (str): The password of the user, already verified.
+    """
+    try:
+        hashed_password = passwordHasher.hash(password)
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("UPDATE users SET password = %s WHERE id = %s", (hashed_password, user_id))
+            mydb.commit()
+        passwordHasher.recordRehash()
+        logger.info(f"Password hash of user {user_id} updated to cost {passwordHasher.rounds}")
+    except Exception as e:
+        logger.error(f"Something went wrong when rehashing the password of user {user_id}: {e}")
+
+
+
+def viewUserById(user_id: int, columns: list = None):
+    """Function to view a user by their ID. Results are served from the user profile cache when possible.
     Args:
         user_id (int): The ID of the user to be viewed.
+        columns (list): The columns the caller needs. None returns every column except the password.
     Returns:
         A dictionary containing user details if found, otherwise None.
     """
-    global mydb
-    cursor = mydb.cursor(dictionary=True)
-    id_query= f"SELECT * FROM users WHERE id = %s"
+    cached_user = userProfileCache.get(user_id, columns)
+    if cached_user is not None:
+        return cached_user
+    #Taken before the SELECT, so a row read before a concurrent update is not cached after its invalidation
+    generation = userProfileCache.getGeneration(user_id)
+
+    selected_columns = columns if columns is not None else USER_PROFILE_COLUMNS
+    unknown_columns = [column for column in selected_columns if column not in USER_PROFILE_COLUMNS]
+    if unknown_columns:
+        raise ValueError(f"Unknown user columns: {unknown_columns}")
+    id_query= f"SELECT {', '.join(selected_columns)} FROM users WHERE id = %s"
 
     try:
-        cursor.execute(id_query, (user_id,))
-        user = cursor.fetchone()
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            cursor.execute(id_query, (user_id,))
+            user = cursor.fetchone()
         if user:
-            print(f"User with ID {user_id} found: {user}")
+            logPayload(logger, f"User with ID {user_id} found", user=user)
+            userProfileCache.set(user_id, columns, user, generation)
             return user
         else:
-            print(f"No user found with ID {user_id}")
+            logger.warning(f"No user found with ID {user_id}")
             return None
     except Exception as e:
-        print(f"Something went wrong when viewing user by ID {user_id}: {e}")
+        logger.error(f"Something went wrong when viewing user by ID {user_id}: {e}")
         return None
-    finally:
-        cursor.close()
 
 
 
@@ -422,20 +669,19 @@ def viewUserByEmail(email:EmailStr):
     Returns:
         A dictionary containing user details if found, otherwise None.
     """
-    global mydb
-    cursor = mydb.cursor(dictionary=True)
     email_query = f"SELECT * FROM users WHERE email = %s"
     try:
-        cursor.execute(email_query, (email,))
-        user = cursor.fetchone()
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            cursor.execute(email_query, (email,))
+            user = cursor.fetchone()
         if user:
-            print(f"User with email {email} found: {user}")
+            logPayload(logger, f"User with email {email} found", user=user)
             return user
         else:
-            print(f"No user found with email {email}")
+            logger.warning(f"No user found with email {email}")
             return None
     except Exception as e:
-        print(f"Something went wrong when viewing user by email {email}: {e}")
+        logger.error(f"Something went wrong when viewing user by email {email}: {e}")
         return None
 
 
@@ -448,13 +694,11 @@ def updateBasicInformation(user: BasicInformationUser):
         A dictionary containing a success message and updated user details if the update is successful,
         or an error message if the update fails.
     """
-    global mydb
-    cursor = mydb.cursor()  
     try:
         # Check if the user exists
-        existing_user = viewUserById(user.id)
+        existing_user = viewUserById(user.id, ["id"])
         if not existing_user:
-            print(f"User with ID {user.id} does not exist.")
+            logger.warning(f"User with ID {user.id} does not exist.")
             return {"message": "User does not exist", "error": "User with this ID does not exist"}
         if existing_user:
             # Update user information
@@ -471,30 +715,37 @@ def updateBasicInformation(user: BasicInformationUser):
             country = %s
             WHERE id = %s
             """
-            # Hash the password before storing it
-            salt = bcrypt.gensalt()
-            hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), salt)
-
-            cursor.execute(update_query, (
-                user.name,
-                hashed_password.decode('utf-8'),  # Decode bytes to string for storage
-                user.sex,
-                user.age,
-                user.objective,
-                user.weight,
-                user.height,
-                user.country,
-                user.id
-            ))
-            mydb.commit()
-            print(f"User {user.id} updated successfully.")
+            with dbPool.transaction() as (mydb, cursor):
+                cursor.execute("SELECT password FROM users WHERE id = %s", (user.id,))
+                stored_hashed_password = cursor.fetchone()[0]
+            # No password keeps the current one. The same plain password is only hashed again when the stored hash is outdated
+            if user.password is None or (stored_hashed_password and not passwordHasher.needsRehash(stored_hashed_password)
+                                         and passwordHasher.verify(user.password, stored_hashed_password)):
+                hashed_password = stored_hashed_password
+                passwordHasher.recordRehash(skipped=True)
+            else:
+                hashed_password = passwordHasher.hash(user.password)
+
+            with dbPool.transaction() as (mydb, cursor):
+                cursor.execute(update_query, (
+                    user.name,
+                    hashed_password,
+                    user.sex,
+                    user.age,
+                    user.objective,
+                    user.weight,
+                    user.height,
+                    user.country,
+                    user.id
+                ))
+                mydb.commit()
+            userProfileCache.invalidate(user.id)
+            logger.info(f"User {user.id} updated successfully.")
             updated_user = viewUserById(user.id)
             return {"message": "User updated successfully", "user": updated_user}
     except Exception as e:
-        print(f"Something went wrong when updating user {user.id}: {e}")
+        logger.error(f"Something went wrong when updating user {user.id}: {e}")
         return {"message": "Error when updating user", "error": "Internal server error"}
-    finally:
-        cursor.close()
 
 
 
@@ -506,19 +757,15 @@ def getAISuggestion(additionalInformationUser:AdditionalInformationUser):
     else:
         additionalInformationUser_str = additionalInformationUser
     
-    #Read the prompt template from file
-    with open("prompts/getAISuggestion.md", "r", encoding="utf-8") as f:
-        template = Template(f.read())
-
-    prompt = template.substitute(additionalInformationUser_str=str(additionalInformationUser_str))
-    print(prompt)
+    prompt = promptRegistry.render("getAISuggestion", additionalInformationUser_str=str(additionalInformationUser_str))
+    logPayload(logger, "Rendered prompt", prompt=prompt)
     try:
         # Make API call
-        response = AIAgent.getLLMResponse(prompt)
+        response = AIAgent.getLLMResponse(prompt, useCache=True)
         return response
         
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
         return None
 
 
@@ -531,13 +778,11 @@ def updateAdditionalInformation(additionalInformationUser:AdditionalInformationU
         A dictionary containing a success message and updated user details if the update is successful,
         or an error message if the update fails.
     """
-    global mydb
-    cursor = mydb.cursor()
     try:
         # Check if the user exists
-        existing_user = viewUserById(additionalInformationUser.id)
+        existing_user = viewUserById(additionalInformationUser.id, ["id"])
         if not existing_user:
-            print(f"User with ID {additionalInformationUser.id} does not exist.")
+            logger.warning(f"User with ID {additionalInformationUser.id} does not exist.")
             return {"message": "User does not exist", "error": "User with this ID does not exist"}
         if existing_user:
             # Update user information
@@ -555,20 +800,20 @@ def updateAdditionalInformation(additionalInformationUser:AdditionalInformationU
             sportive_json = json.dumps(additionalInformationUser.sportive_description) if additionalInformationUser.sportive_description else None
             medical_json = json.dumps(additionalInformationUser.medical_conditions) if additionalInformationUser.medical_conditions else None
             food_preferences_json = json.dumps(additionalInformationUser.food_preferences) if additionalInformationUser.food_preferences else None
-            cursor.execute(update_query, (
-                allergies_json,
-                sportive_json,
-                medical_json,
-                food_preferences_json,
-                additionalInformationUser.id
-            ))
-            mydb.commit()
-            print(f"User {additionalInformationUser.id} updated successfully.")
+            with dbPool.transaction() as (mydb, cursor):
+                cursor.execute(update_query, (
+                    allergies_json,
+                    sportive_json,
+                    medical_json,
+                    food_preferences_json,
+                    additionalInformationUser.id
+                ))
+                mydb.commit()
+            userProfileCache.invalidate(additionalInformationUser.id)
+            logger.info(f"User {additionalInformationUser.id} updated successfully.")
     except Exception as e:
-        print(f"Something went wrong when updating user {additionalInformationUser.id}: {e}")
+        logger.error(f"Something went wrong when updating user {additionalInformationUser.id}: {e}")
         return {"message": "Error when updating user", "error": "Internal server error"}
-    finally:
-        cursor.close()
 
 
 def getDetailedReport(id:int):
@@ -584,7 +829,8 @@ def getDetailedReport(id:int):
         dict: Transformed JSON data
     """
     #First get user data using the id
-    userData= viewUserById(id)
+    userData= viewUserById(id, ["age", "sex", "objective", "weight", "height", "allergies",
+                                "food_preferences", "sportive_description", "medical_conditions"])
     userAge=userData["age"]
     userSex=userData["sex"]
     userObjective=userData["objective"]
@@ -595,11 +841,7 @@ def getDetailedReport(id:int):
     userSportiveDescription=userData["sportive_description"]
     userMedicalConditions=userData["medical_conditions"]
 
-    #Read the prompt template from file
-    with open("prompts/getDetailedReport.md", "r", encoding="utf-8") as f:
-        template = Template(f.read())
-
-    prompt = template.substitute(
+    prompt = promptRegistry.render("getDetailedReport",
         userSex=userSex,
         userAge=userAge,
         userObjective=userObjective,
@@ -611,18 +853,17 @@ def getDetailedReport(id:int):
         foodPreferences=foodPreferences if foodPreferences else "The patient does not have any food preference that must be considered"
         )
     
-    print(prompt)
+    logPayload(logger, "Rendered prompt", prompt=prompt)
 
     try:
         # Make API call
-        response = AIAgent.getLLMResponse(prompt)
+        response = AIAgent.getLLMResponse(prompt, useCache=True)
         saveToDatabase=saveDetailedReport(response,id)
-        print(saveToDatabase)
 
         return response
         
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
         return None
 
 
@@ -638,9 +879,6 @@ def saveDetailedReport(jsonPayload:object,id:int):
     Returns:
     Success or failure message
     """
-    global mydb
-    cursor=mydb.cursor()
-
     detailedReportQuery="""
             UPDATE users 
             SET 
@@ -654,45 +892,48 @@ def saveDetailedReport(jsonPayload:object,id:int):
             WHERE id = %s
             """
     try:
-        cursor.execute(detailedReportQuery,(
-            jsonPayload["recommended_daily_calories"],
-            jsonPayload["recommended_water_intake"],
-            jsonPayload["recommended_protein_intake"],
-            jsonPayload["recommended_fats_intake"],
-            jsonPayload["recommended_carbohydrates_intake"],
-            json.dumps(jsonPayload["nutritional_deficiency_risks"]),
-            json.dumps(jsonPayload["general_recommendation"]),
-            id
-        ))
-        mydb.commit()
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute(detailedReportQuery,(
+                jsonPayload["recommended_daily_calories"],
+                jsonPayload["recommended_water_intake"],
+                jsonPayload["recommended_protein_intake"],
+                jsonPayload["recommended_fats_intake"],
+                jsonPayload["recommended_carbohydrates_intake"],
+                json.dumps(jsonPayload["nutritional_deficiency_risks"]),
+                json.dumps(jsonPayload["general_recommendation"]),
+                id
+            ))
+            mydb.commit()
+        userProfileCache.invalidate(id)
 
-        print(f"Successfully updated detailed report for user {id}")
+        logger.info(f"Successfully updated detailed report for user {id}")
         return {"message": f"Successfully updated detailed report for user {id}"}
     except Exception as e:
-        print(e)
+        logger.error(f"Error: {e}")
         return {"Error":e}
-    finally:
-        cursor.close()
 
 
-def getWeeklyMenus(id:int, userFeedback: UserFeedback = None):
+def buildWeeklyMenusPrompt(id:int, userFeedback: UserFeedback = None):
     """
-    Function that converts the user data into a dictionary. It contains the menu of
-    the whole week divided by days. It contains breakfast, lunch, dinner and snacks are optional.
+    Function that renders the prompt used to generate the weekly menus of a user.
 
     Args:
-    id: the ID of the user whose data will be used to generate the response
+    id: the ID of the user whose data will be used to generate the prompt
+    userFeedback: feedback of the user about last week's menu
 
-    Returns: 
-    Dict: the data of the menus in a JSON format
+    Returns:
+    Tuple (prompt, errorResponse). prompt is None when it cannot be built, in which case
+    errorResponse describes the reason (or is None if the user does not exist)
     """
 
     #First get user data using the id
-    userData= viewUserById(id)
+    userData= viewUserById(id, ["recommended_daily_calories", "recommended_protein_intake", "recommended_fats_intake",
+                                "recommended_carbohydrates_intake", "allergies", "sportive_description", "medical_conditions",
+                                "nutritional_deficiency_risks", "food_preferences", "country"])
     
     if userData is None:
-        print(f"No user found with ID {id}")
-        return None
+        logger.warning(f"No user found with ID {id}")
+        return None, None
 
     # Check if the user has completed their nutritional assessment
     required_fields = ["recommended_daily_calories", "recommended_protein_intake", 
@@ -701,9 +942,8 @@ def getWeeklyMenus(id:int, userFeedback: UserFeedback = None):
     missing_fields = [field for field in required_fields if field not in userData or userData[field] is None]
     
     if missing_fields:
-        print(f"User {id} has not completed nutritional assessment. Missing fields: {missing_fields}")
-        print("Please complete the nutritional assessment first by calling getDetailedReport()")
-        return {
+        logger.warning(f"User {id} has not completed nutritional assessment. Missing fields: {missing_fields}")
+        return None, {
             "error": "Nutritional assessment not completed",
             "message": "Please complete your nutritional assessment before generating weekly menus",
             "missing_fields": missing_fields
@@ -736,14 +976,13 @@ def getWeeklyMenus(id:int, userFeedback: UserFeedback = None):
     varietyFeedback = userFeedback.get("varietyFeedback", "") if userFeedback else ""
     physicalChangesFeedback = userFeedback.get("physicalChangesFeedback", "") if userFeedback else ""
     
-    # Get last week's menu for context
-    lastWeekMenu = getLastWeekMenu(id)
+    # Get last week's menu for context, within the token budget of the providers
+    contextBuilder = PromptContextBuilder(getPromptBudget(AIAgent.providers),
+        promptRegistry.getTemplate("getWeeklyMenus").template + "".join(str(value) for value in userData.values()))
+    contextBuilder.addSection("lastWeekMenu", getLastWeekMenu(id), priority=1)
+    lastWeekMenu = contextBuilder.build()["lastWeekMenu"]
     
-    #Read the prompt template from file
-    with open("prompts/getWeeklyMenus.md", "r", encoding="utf-8") as f:
-        template = Template(f.read())
-
-    prompt = template.substitute(
+    prompt = promptRegistry.render("getWeeklyMenus",
         recommendedDailyCalories=recommendedDailyCalories,
             lowerRecommendedDailyCalories=int(recommendedDailyCalories*0.95),
             upperRecommendedDailyCalories=int(recommendedDailyCalories*1.05),
@@ -769,21 +1008,340 @@ def getWeeklyMenus(id:int, userFeedback: UserFeedback = None):
             physicalChangesFeedback=physicalChangesFeedback if (physicalChangesFeedback and physicalChangesFeedback != "") else "N/A",
             lastWeekMenu=lastWeekMenu
             )
-    print(prompt)
+    return prompt, None
+
+
+def checkMenuNutrition(id:int, menu:dict, repair:bool=True):
+    """
+    Function that recomputes the macros of every day of a generated menu from its ingredients, and rescales
+    the portions of the days outside the macro bands of the user (see nutritionEngine.py).
+
+    Args:
+    id: the ID of the user the menu belongs to
+    menu: the menu, {"day1": [...], ...}, or a single day
+    repair: whether the days outside the bands are rescaled
+
+    Returns:
+    Tuple (menu, report). The menu is returned unchanged, with a None report, if the check is disabled,
+    the user has no macro targets or the check fails
+    """
+    if not NUTRITION_REPAIR or not isinstance(menu, dict):
+        return menu, None
+    try:
+        targets = getMacroTargets(viewUserById(id, list(MACRO_TARGET_COLUMNS.values())))
+        if targets is None:
+            return menu, None
+        checkedMenu, report = nutritionEngine.checkMenu(menu, targets, repair)
+        outOfBands = [day for day, dayReport in report.items() if not dayReport["withinBands"]]
+        repairedDays = [day for day, dayReport in report.items() if dayReport["repaired"]]
+        logger.info(f"Nutrition check of the menu of user {id}", extra={"fields": {"repairedDays": repairedDays, "outOfBands": outOfBands}})
+        logPayload(logger, "Nutrition report", report=report)
+        return checkedMenu, report
+    except Exception as e:
+        logger.error(f"Error checking the nutrition of the menu of user {id}: {e}")
+        return menu, None
+
+
+def planWeeklyMenus(id:int, simpleProfileOnly:bool=False):
+    """
+    Function that builds the weekly menus of a user with the local menu planner (see menuPlanner.py),
+    in milliseconds and without calling the LLM.
+
+    Args:
+    id: the ID of the user
+    simpleProfileOnly: only plan for users without medical conditions nor food preferences, which
+        the planner cannot take into account
+
+    Returns:
+    Dict: the menu with the same "dayN" schema as the LLM menus, or None if the user cannot be planned
+    for or some day does not fit the macro bands
+    """
+    userData = viewUserById(id, list(MACRO_TARGET_COLUMNS.values()) + ["allergies", "medical_conditions", "food_preferences", "country"])
+    targets = getMacroTargets(userData)
+    if targets is None:
+        return None
+    if simpleProfileOnly and any((userData.get(column) or "").strip("[]\" ") for column in ("medical_conditions", "food_preferences")):
+        logger.debug(f"User {id} does not have a simple profile, the menu planner is skipped")
+        return None
+    allergies = parseAllergies(userData.get("allergies"))
+    try:
+        # Meals generated for other users, of the user's cuisine first, widen the choice of the built-in library
+        extraMeals = recipeLibrary.getPlannerMeals(targets, allergies, userData.get("country"))
+    except Exception as e:
+        logger.warning(f"Recipe library unavailable, planning with the built-in meals only: {e}")
+        extraMeals = None
+    try:
+        # The same user gets a different menu every week, and the same menu if the week is planned again
+        menu, report = menuPlanner.planWeek(targets, allergies, extraMeals, seed=(id, datetime.now().isocalendar()[:2]))
+    except Exception as e:
+        logger.error(f"Error planning the weekly menus of user {id}: {e}")
+        return None
+    outOfBands = [day for day, dayReport in report.items() if not dayReport["withinBands"]]
+    if outOfBands:
+        logger.info(f"Menu planner could not fit the macro bands of user {id}", extra={"fields": {"outOfBands": outOfBands}})
+        return None
+    return menu
+
+
+def indexUserRecipes(id:int, menu:dict):
+    """
+    Function that adds the meals of a saved menu to the recipe library (see recipeLibrary.py), with the
+    country of the user as their cuisine. Errors are only logged, the menu is already saved.
+
+    Args:
+    id: the ID of the user the menu was generated for
+    menu: the menu, or the modified day, with the "dayN" schema
+
+    Returns:
+    int: the number of new recipes
+    """
+    userData = viewUserById(id, ["country"])
+    return recipeLibrary.addMenu(menu, userData.get("country") if isinstance(userData, dict) else None)
+
+
+def getWeeklyMenus(id:int, userFeedback: UserFeedback = None, engine:str = None):
+    """
+    Function that converts the user data into a dictionary. It contains the menu of
+    the whole week divided by days. It contains breakfast, lunch, dinner and snacks are optional.
+
+    Args:
+    id: the ID of the user whose data will be used to generate the response
+    userFeedback: feedback of the user about last week's menu (only used by the LLM)
+    engine: "llm", "planner" or "auto" (MENU_ENGINE by default). The planner falls back to the LLM
+        when it cannot build a menu within the macro bands
+
+    Returns: 
+    Dict: the data of the menus in a JSON format, MENU_SAVE_ERROR if they could not be saved
+    """
+    engine = (engine or MENU_ENGINE).lower()
+    if engine in ("planner", "auto"):
+        response = planWeeklyMenus(id, simpleProfileOnly=(engine == "auto"))
+        if response is not None:
+            # The planned meals come from the libraries, they are not indexed again
+            saveToDatabase=saveWeeklyMenus(response, id, indexRecipes=False)
+            if saveToDatabase["status"] == "error":
+                return MENU_SAVE_ERROR
+            return response
+        logger.info(f"Weekly menus of user {id} generated by the LLM instead of the menu planner")
+
+    prompt, errorResponse = buildWeeklyMenusPrompt(id, userFeedback)
+    if prompt is None:
+        return errorResponse
+
+    logPayload(logger, "Rendered prompt", prompt=prompt)
     try:
         # Make API call
         response = AIAgent.getLLMResponse(prompt)
+        #Every provider failed or the menu is incomplete: nothing to check nor save
+        if not isinstance(response, dict) or not all(f"day{day}" in response for day in range(1, 8)):
+            logger.warning(f"No complete weekly menu was generated for user {id}")
+            return None
+        #The macros reported by the LLM are recomputed, and days outside the bands get their portions rescaled
+        response, nutritionReport = checkMenuNutrition(id, response)
         #If the LLM request succeeds, save it to the DB. Save results as object. JSON format is useful to divide context by days
         saveToDatabase=saveWeeklyMenus(response,id)
-        print(saveToDatabase)
+        #A menu that was not saved is not returned, callers such as the batch runner must not treat it as done
+        if saveToDatabase["status"] == "error":
+            return MENU_SAVE_ERROR
 
         return response
         
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
+        return None
+
+
+
+def getWeeklyMenusStream(id:int, userFeedback: UserFeedback = None):
+    """
+    Function that generates the weekly menus like getWeeklyMenus, but yields every day
+    as soon as it has been parsed from the LLM token stream. The menu is only saved to the DB,
+    in a single write, once all seven days have arrived.
+
+    Args:
+    id: the ID of the user whose data will be used to generate the response
+    userFeedback: feedback of the user about last week's menu
+
+    Yields:
+    Dict events: {"event": "day", "day": "dayN", "meals": [...]} for each day, followed by
+    {"event": "done", "menu": {...}} or {"event": "error", "message": ...}
+    """
+    prompt, errorResponse = buildWeeklyMenusPrompt(id, userFeedback)
+    if prompt is None:
+        yield {"event": "error", "message": errorResponse.get("message") if errorResponse else f"No user found with ID {id}"}
+        return
+
+    dayKeys = [f"day{day}" for day in range(1, 8)]
+    parser = PartialJSONObjectParser()
+    menu = {}
+    try:
+        for chunk in AIAgent.getLLMResponseStream(prompt):
+            for key, value in parser.feed(chunk):
+                if key in dayKeys and key not in menu:
+                    menu[key] = value
+                    yield {"event": "day", "day": key, "meals": value}
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        yield {"event": "error", "message": "Failed to obtain menus, please, try again"}
+        return
+
+    missingDays = [key for key in dayKeys if key not in menu]
+    if missingDays:
+        logger.warning(f"Streamed weekly menu for user {id} is missing {missingDays}")
+        yield {"event": "error", "message": "Failed to obtain menus, please, try again"}
+        return
+
+    #Days were streamed as generated, the final event carries the menu checked by the nutrition engine
+    menu, nutritionReport = checkMenuNutrition(id, menu)
+    saveToDatabase=saveWeeklyMenus(menu, id)
+    if saveToDatabase["status"] == "error":
+        yield {"event": "error", "message": "Failed to save menus, please, try again"}
+        return
+    yield {"event": "done", "menu": menu}
+
+
+def toMacroValue(value):
+    """
+    Convert a macro reported by the LLM (number or numeric string) to an integer, or None
+    """
+    try:
+        return int(round(float(value)))
+    except (TypeError, ValueError):
         return None
 
 
+def insertDayRevision(cursor, id:int, versionId:int, day:int, revision:int, meals:list, creationDate=None):
+    """
+    Function to add a revision of one day of a menu version. Runs inside the caller's transaction.
+    Nothing is deleted: the new revision hides the previous ones of the same day.
+
+    Args:
+    cursor: Cursor of the caller's transaction
+    id: Unique identifier for each user
+    versionId: The menu version the day belongs to
+    day: The day of the menu
+    revision: 0 for a generated menu, previous revision + 1 for a modification
+    meals: List of meals in the menu JSON schema (type, hour, ingredients, instructions, calories, protein, fats, carbohydrates)
+    creationDate: Date of the revision, now by default
+
+    Returns:
+    None
+    """
+    cursor.execute(
+        "INSERT INTO menu_day_revisions (version_id, day, revision, creationDate) VALUES (%s, %s, %s, %s)",
+        (versionId, day, revision, creationDate or datetime.now())
+    )
+
+    insert_meal_query="""
+        INSERT INTO menu_meals (version_id, user_id, day, revision, position, type, hour, instructions,
+        calories, protein, fats, carbohydrates, extra)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    ingredients_rows=[]
+    for position, meal in enumerate(meals or []):
+        # Keys that are not part of the schema are kept, so no information is lost
+        extra={key: value for key, value in meal.items() if key not in MEAL_COLUMNS}
+        cursor.execute(insert_meal_query, (
+            versionId, id, day, revision, position, meal.get("type"), meal.get("hour"),
+            json.dumps(meal.get("instructions", []), ensure_ascii=False),
+            toMacroValue(meal.get("calories")), toMacroValue(meal.get("protein")),
+            toMacroValue(meal.get("fats")), toMacroValue(meal.get("carbohydrates")),
+            json.dumps(extra, ensure_ascii=False, default=str) if extra else None
+        ))
+        meal_id=cursor.lastrowid
+        for ingredient_position, ingredient in enumerate(meal.get("ingredients") or []):
+            ingredients_rows.append((meal_id, ingredient_position, str(ingredient)[:255]))
+
+    if ingredients_rows:
+        cursor.executemany("INSERT INTO meal_ingredients (meal_id, position, ingredient) VALUES (%s, %s, %s)", ingredients_rows)
+
+
+def getMenuVersion(cursor, id:int, asOf=None):
+    """
+    Function to find the menu version of a user that was current at a given moment
+
+    Args:
+    cursor: Cursor of the caller's transaction (dictionary cursor)
+    id: Unique identifier for each user
+    asOf: Point in time to look at, None for the latest version
+
+    Returns:
+    Dictionary with the version_id and creationDate of the version, or None if there is none
+    """
+    if asOf is None:
+        cursor.execute("""
+            SELECT version_id, creationDate FROM menu_versions WHERE user_id = %s
+            ORDER BY creationDate DESC, version_id DESC LIMIT 1
+        """, (id,))
+    else:
+        cursor.execute("""
+            SELECT version_id, creationDate FROM menu_versions WHERE user_id = %s AND creationDate <= %s
+            ORDER BY creationDate DESC, version_id DESC LIMIT 1
+        """, (id, asOf))
+    return cursor.fetchone()
+
+
+def loadMenuDays(cursor, versionId:int, days:list=None, asOf=None):
+    """
+    Function to read the meals of a menu version and rebuild them in the menu JSON schema.
+    Only the latest revision of each day is read.
+
+    Args:
+    cursor: Cursor of the caller's transaction (dictionary cursor)
+    versionId: The menu version to read
+    days: Days to read, all seven by default
+    asOf: Point in time to look at, None for the latest revisions
+
+    Returns:
+    Dictionary of "dayN" -> list of meals, or None for days without meals
+    """
+    days=days or list(range(1, 8))
+    placeholders=", ".join(["%s"] * len(days))
+    as_of_filter="AND creationDate <= %s" if asOf is not None else ""
+    parameters=(versionId, *days, *((asOf,) if asOf is not None else ()), versionId)
+    cursor.execute(f"""
+        SELECT m.meal_id, m.day, m.type, m.hour, m.instructions, m.calories, m.protein, m.fats, m.carbohydrates, m.extra
+        FROM menu_meals m
+        JOIN (
+            SELECT day, MAX(revision) AS revision FROM menu_day_revisions
+            WHERE version_id = %s AND day IN ({placeholders}) {as_of_filter}
+            GROUP BY day
+        ) latest ON latest.day = m.day AND latest.revision = m.revision
+        WHERE m.version_id = %s
+        ORDER BY m.day, m.position
+    """, parameters)
+    meal_rows=cursor.fetchall()
+
+    ingredients={}
+    if meal_rows:
+        meal_placeholders=", ".join(["%s"] * len(meal_rows))
+        cursor.execute(f"""
+            SELECT meal_id, ingredient FROM meal_ingredients
+            WHERE meal_id IN ({meal_placeholders}) ORDER BY meal_id, position
+        """, tuple(row["meal_id"] for row in meal_rows))
+        for row in cursor.fetchall():
+            ingredients.setdefault(row["meal_id"], []).append(row["ingredient"])
+
+    menu={f"day{day}": None for day in days}
+    for row in meal_rows:
+        meal={
+            "type": row["type"],
+            "hour": row["hour"],
+            "ingredients": ingredients.get(row["meal_id"], []),
+            "instructions": json.loads(row["instructions"]) if row["instructions"] else [],
+            "calories": row["calories"],
+            "protein": row["protein"],
+            "fats": row["fats"],
+            "carbohydrates": row["carbohydrates"],
+        }
+        if row["extra"]:
+            meal.update(json.loads(row["extra"]))
+        if menu[f"day{row['day']}"] is None:
+            menu[f"day{row['day']}"]=[]
+        menu[f"day{row['day']}"].append(meal)
+    return menu
+
+
 def getLastWeekMenu(id: int):
     """
     Function to get the last week's menu for context in generating new menus
@@ -792,48 +1350,140 @@ def getLastWeekMenu(id: int):
     id: Unique identifier for each user
     
     Returns:
-    String representation of the last week's menu or empty string if none exists
+    Compact summary of the last week's menu (meals and macros, without instructions) or empty string if none exists
     """
-    global mydb
-    cursor = mydb.cursor()
-    
     try:
-        # Get the most recent menu for this user
-        get_last_menu_query = """
-            SELECT day1, day2, day3, day4, day5, day6, day7 
-            FROM user_menus 
-            WHERE user_id = %s 
-            ORDER BY creationDate DESC 
-            LIMIT 1
-        """
-        cursor.execute(get_last_menu_query, (id,))
-        last_menu = cursor.fetchone()
-        
-        if last_menu:
-            # Convert the database row to a dictionary with day keys
-            last_week_menu = {}
-            for day in range(1, 8):
-                day_data = last_menu[day - 1]  # day1 is index 0, day2 is index 1, etc.
-                if day_data:
-                    try:
-                        # Parse JSON string back to object
-                        last_week_menu[f"day{day}"] = json.loads(day_data)
-                    except json.JSONDecodeError:
-                        last_week_menu[f"day{day}"] = None
-                else:
-                    last_week_menu[f"day{day}"] = None
-            
-            # Convert to JSON string for template substitution
-            return json.dumps(last_week_menu, indent=2)
-        else:
-            return ""
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            # The latest saved version is the menu of the week that is being replaced
+            menu_version=getMenuVersion(cursor, id)
+            last_week_menu=loadMenuDays(cursor, menu_version["version_id"]) if menu_version else {}
+
+        # The instructions are left out, the prompt only needs what was eaten and its macros
+        return summarizeMenu(last_week_menu)
     
     except Exception as e:
-        print(f"Error fetching last week's menu for user {id}: {e}")
+        logger.error(f"Error fetching last week's menu for user {id}: {e}")
         return ""
-    
-    finally:
-        cursor.close()
+
+
+def getMealsByDay(id:int, day:int):
+    """
+    Function to read the meals of a single day of the user's menu
+
+    Args:
+    id: Unique identifier for each user
+    day: The day of the menu
+
+    Returns:
+    List of meals in the menu JSON schema, or None if the day has no meals
+    """
+    try:
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            menu_version=getMenuVersion(cursor, id)
+            if menu_version is None:
+                return None
+            return loadMenuDays(cursor, menu_version["version_id"], [day])[f"day{day}"]
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return None
+
+
+# Daily and weekly macro totals of the latest revisions of a menu version
+MENU_MACRO_TOTALS_QUERY="""
+    SELECT m.day, SUM(m.calories) AS calories, SUM(m.protein) AS protein,
+    SUM(m.fats) AS fats, SUM(m.carbohydrates) AS carbohydrates
+    FROM menu_meals m
+    JOIN (
+        SELECT day, MAX(revision) AS revision FROM menu_day_revisions
+        WHERE version_id = %s GROUP BY day
+    ) latest ON latest.day = m.day AND latest.revision = m.revision
+    WHERE m.version_id = %s
+    GROUP BY m.day WITH ROLLUP
+"""
+
+
+def getWeeklyMacroTotals(id:int):
+    """
+    Function to aggregate the macros of the user's current menu in SQL
+
+    Args:
+    id: Unique identifier for each user
+
+    Returns:
+    Dictionary with the totals of each day ("dayN") and of the whole week ("week")
+    """
+    try:
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            menu_version=getMenuVersion(cursor, id)
+            if menu_version is None:
+                return {}
+            cursor.execute(MENU_MACRO_TOTALS_QUERY, (menu_version["version_id"], menu_version["version_id"]))
+            rows=cursor.fetchall()
+        totals={}
+        for row in rows:
+            key="week" if row["day"] is None else f"day{row['day']}"
+            totals[key]={macro: int(row[macro] or 0) for macro in ("calories", "protein", "fats", "carbohydrates")}
+        return totals
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return None
+
+
+def getMenuAt(id:int, asOf):
+    """
+    Function to read the menu of a user as it was at a given moment, including the
+    modifications of each day made until then
+
+    Args:
+    id: Unique identifier for each user
+    asOf: Point in time to look at (datetime)
+
+    Returns:
+    Tuple with the menu of the week and its creation date, or None if the user had no menu yet
+    """
+    try:
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            menu_version=getMenuVersion(cursor, id, asOf)
+            if menu_version is None:
+                return None
+            return loadMenuDays(cursor, menu_version["version_id"], asOf=asOf), menu_version["creationDate"]
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return None
+
+
+def getMenuHistory(id:int, limit:int=None):
+    """
+    Function to list the recent weekly menus of a user with their macro totals
+
+    Args:
+    id: Unique identifier for each user
+    limit: Maximum number of menus, MENU_HISTORY_WEEKS by default
+
+    Returns:
+    List of dictionaries with the version_id, creationDate, number of modifications and the
+    daily and weekly macro totals of each menu, newest first
+    """
+    limit=limit or MENU_HISTORY_WEEKS
+    try:
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            cursor.execute("""
+                SELECT v.version_id, v.creationDate, COUNT(r.revision) - COUNT(DISTINCT r.day) AS modifications
+                FROM menu_versions v LEFT JOIN menu_day_revisions r ON r.version_id = v.version_id
+                WHERE v.user_id = %s GROUP BY v.version_id, v.creationDate
+                ORDER BY v.creationDate DESC, v.version_id DESC LIMIT %s
+            """, (id, limit))
+            versions=cursor.fetchall()
+            for version in versions:
+                cursor.execute(MENU_MACRO_TOTALS_QUERY, (version["version_id"], version["version_id"]))
+                version["totals"]={}
+                for row in cursor.fetchall():
+                    key="week" if row["day"] is None else f"day{row['day']}"
+                    version["totals"][key]={macro: int(row[macro] or 0) for macro in ("calories", "protein", "fats", "carbohydrates")}
+        return versions
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return []
 
 
 def clearUserChatHistory(id: int):
@@ -846,80 +1496,68 @@ def clearUserChatHistory(id: int):
     Returns:
     Success or failure message
     """
-    global mydb
-    cursor = mydb.cursor()
-    
     try:
         # Delete all chat history for this user
         delete_chat_history_query = "DELETE FROM chat_history WHERE user_id = %s"
-        cursor.execute(delete_chat_history_query, (id,))
-        mydb.commit()
-        print(f"Cleared chat history for user {id}")
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute(delete_chat_history_query, (id,))
+            mydb.commit()
+        logger.info(f"Cleared chat history for user {id}")
         return {"status": "success", "message": f"Chat history cleared for user {id}"}
     
     except Exception as e:
-        print(f"Error clearing chat history for user {id}: {e}")
+        logger.error(f"Error clearing chat history for user {id}: {e}")
         return {"status": "error", "message": e}
-    
-    finally:
-        cursor.close()
 
 
-def saveWeeklyMenus(jsonPayload: object, id:int):
+def saveWeeklyMenus(jsonPayload: object, id:int, indexRecipes:bool=True):
     """
-    Function to save the menus as single days in the menus database.
-    First deletes any existing menu and chat history for the user, then inserts the new menu.
+    Function to save the menus as a new version in the meals tables, then clear the user's chat history.
+    Previous menus are kept as history, only the versions beyond MENU_HISTORY_WEEKS are pruned.
 
     Args:
     jsonPayload: Data in JSON format. It is a dictionary with 7 keys, one for each day of the week. Each key contains a list of dictionaries, one for each meal of the day.
     id: Unique identifier for each user
+    indexRecipes: add the meals to the recipe library
 
     Returns:
     Success or failure message
     """
-    global mydb
-    cursor=mydb.cursor()
-    current_date = datetime.now().date()   # YYYY-MM-DD
+    creation_date = datetime.now()
 
     try:
-        # First, delete any existing menu for this user
-        delete_existing_menu_query = "DELETE FROM user_menus WHERE user_id = %s"
-        cursor.execute(delete_existing_menu_query, (id,))
-        print(f"Deleted existing menu for user {id}")
+        # Every day is written in the same transaction, so the user never sees a partial menu
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("INSERT INTO menu_versions (user_id, creationDate) VALUES (%s, %s)", (id, creation_date))
+            version_id=cursor.lastrowid
+            for day in range(1, 8):
+                insertDayRevision(cursor, id, version_id, day, 0, jsonPayload[f"day{day}"], creation_date)
+
+            # Only the oldest versions are deleted, their meals and ingredients go with them by ON DELETE CASCADE
+            cursor.execute("""
+                SELECT version_id FROM menu_versions WHERE user_id = %s
+                ORDER BY creationDate DESC, version_id DESC LIMIT 18446744073709551615 OFFSET %s
+            """, (id, MENU_HISTORY_WEEKS))
+            expired_versions=[row[0] for row in cursor.fetchall()]
+            if expired_versions:
+                placeholders=", ".join(["%s"] * len(expired_versions))
+                cursor.execute(f"DELETE FROM menu_versions WHERE version_id IN ({placeholders})", tuple(expired_versions))
+            mydb.commit()
 
         # Clear chat history for this user
         clear_chat_result = clearUserChatHistory(id)
         if clear_chat_result["status"] == "error":
-            print(f"Warning: Failed to clear chat history for user {id}")
-
-        # Then insert the new menu
-        save_weekly_menus_query="""
-            INSERT INTO user_menus (user_id, day1,
-             day2, day3,
-              day4, day5, 
-              day6, day7, creationDate) 
-              VALUES (%s, %s,
-               %s, %s,
-               %s, %s, 
-               %s, %s, %s)
-        """
+            logger.warning(f"Failed to clear chat history for user {id}")
 
-        cursor.execute(save_weekly_menus_query, (id,json.dumps(jsonPayload["day1"]),
-        json.dumps(jsonPayload["day2"]), json.dumps(jsonPayload["day3"]),
-        json.dumps(jsonPayload["day4"]), json.dumps(jsonPayload["day5"]), 
-        json.dumps(jsonPayload["day6"]), json.dumps(jsonPayload["day7"]),
-        current_date
-        ))
-        mydb.commit()
-        print("Weekly menus saved successfully")
+        if indexRecipes:
+            indexUserRecipes(id, jsonPayload)
+
+        logger.info("Weekly menus saved successfully")
         return {"status": "success", "message": "Weekly menus saved successfully"}
     
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
         return {"status": "error", "message":e}
-    
-    finally:
-        cursor.close()
 
 def getDailyModifiedMenu(id:int, day:int, userRequest:str):
     """
@@ -933,14 +1571,13 @@ def getDailyModifiedMenu(id:int, day:int, userRequest:str):
     Object with the new menu for the day
     """
 
-    global mydb
-    cursor=mydb.cursor()
-
     #First lets get the user's data
-    userData= viewUserById(id)
+    userData= viewUserById(id, ["name", "recommended_daily_calories", "recommended_protein_intake", "recommended_fats_intake",
+                                "recommended_carbohydrates_intake", "allergies", "sportive_description", "medical_conditions",
+                                "food_preferences", "country"])
     
     if userData is None:
-        print(f"No user found with ID {id}")
+        logger.warning(f"No user found with ID {id}")
         return None
 
     # Check if the user has completed their nutritional assessment
@@ -950,8 +1587,7 @@ def getDailyModifiedMenu(id:int, day:int, userRequest:str):
     missing_fields = [field for field in required_fields if field not in userData or userData[field] is None]
     
     if missing_fields:
-        print(f"User {id} has not completed nutritional assessment. Missing fields: {missing_fields}")
-        print("Please complete the nutritional assessment first by calling getDetailedReport()")
+        logger.warning(f"User {id} has not completed nutritional assessment. Missing fields: {missing_fields}")
         return {
             "error": "Nutritional assessment not completed",
             "message": "Please complete your nutritional assessment before generating weekly menus",
@@ -969,16 +1605,12 @@ def getDailyModifiedMenu(id:int, day:int, userRequest:str):
     country=userData["country"]
     
     #Now get the menu of the day from the DB
-    menuOfTheDayQuery=f"""
-        SELECT day{day} FROM user_menus WHERE user_id = %s
-    """
-    cursor.execute(menuOfTheDayQuery, (id,))
-    menuOfTheDay=cursor.fetchone()
+    menuOfTheDay=getMealsByDay(id, day)
     if menuOfTheDay:
-        menuOfTheDay=menuOfTheDay[0]
+        menuOfTheDay=compactJSON(menuOfTheDay)
     else:
         menuOfTheDay=None
-        print(f"No menu of the day found for user {id} and day {day}")
+        logger.info(f"No menu of the day found for user {id} and day {day}")
 
     #Get the user name to personalize a bit the prompt
     userName=userData["name"]
@@ -986,10 +1618,13 @@ def getDailyModifiedMenu(id:int, day:int, userRequest:str):
     #Gather last 3 messages from the chat history for this user and day from oldest to newest
 
     #Now gather past messages using pinecone vectorized DB
+    semanticSearchResults=None
     try:
+        #Messages are indexed in the background, give the latest ones a bounded time to become searchable
+        indexingQueue.waitUntilIndexed(id, day)
         semanticSearchResults=vectorizedDB.semantic_search(userRequest, id, day)
     except Exception as e:
-        print(f"Error when retrieving past messages from vectorized DB: {e}")
+        logger.error(f"Error when retrieving past messages from vectorized DB: {e}")
 
     #Search the response for each message ID in the SQL DB to get the full message
     semanticallyRelatedChatHistory=""
@@ -1004,47 +1639,68 @@ def getDailyModifiedMenu(id:int, day:int, userRequest:str):
                 # Fallback to attribute access for QueryResponse objects
                 matches = getattr(semanticSearchResults, "matches", []) or []
         except Exception as e:
-            print(f"Warning: couldn't parse semanticSearchResults: {e}")
-
-    if matches and len(matches) > 0:
-        for match in matches:
-            # match can be a dict or an object; handle both
-            try:
-                message_id = match.get('id') if isinstance(match, dict) else getattr(match, 'id', None)
-            except Exception:
-                message_id = None
-
-            if not message_id:
-                continue
-
-            cursor.execute("SELECT request, response FROM chat_history WHERE message_id = %s", (message_id,))
-            record=cursor.fetchone()
-            if record:
-                semanticallyRelatedChatHistory+=f"User: {record[0]}\nAssistant: {record[1]}\n---\n"
-
-
+            logger.warning(f"couldn't parse semanticSearchResults: {e}")
 
     pastRecentMessagesQuery="""
         SELECT request, response FROM chat_history 
         WHERE user_id = %s AND day = %s ORDER BY creationDate ASC LIMIT 3"""
-    
-    cursor.execute(pastRecentMessagesQuery, (id, day))
-    pastRecentMessagesRecords=cursor.fetchall()
-    if pastRecentMessagesRecords:
-        recentChatHistory = ""
-        for record in pastRecentMessagesRecords:
-            recentChatHistory += f"User: {record[0]}\nAssistant: {record[1]}\n---\n"
-        print(f"Found {len(pastRecentMessagesRecords)} recent chat messages for user {id} and day {day}")
-    else:
-        recentChatHistory = None
-        print(f"No previous chat history found for user {id} and day {day}")
 
+    #The request and response are stored in the vector metadata, the SQL text is only used for
+    #older vectors that were indexed without them
+    relatedMessages=[]
+    for match in matches:
+        # match can be a dict or an object; handle both
+        try:
+            message_id = match.get('id') if isinstance(match, dict) else getattr(match, 'id', None)
+            metadata = (match.get('metadata') if isinstance(match, dict) else getattr(match, 'metadata', None)) or {}
+        except Exception:
+            message_id = None
+
+        if not message_id:
+            continue
 
+        if metadata.get("query") is not None and metadata.get("response") is not None:
+            relatedMessages.append((message_id, (metadata["query"], metadata["response"])))
+        else:
+            relatedMessages.append((message_id, None))
 
-    #Read the prompt template from file
-    with open("prompts/modifyDailyMenu.md", "r", encoding="utf-8") as f:
-        template = Template(f.read())
-    prompt = template.substitute(
+    with dbPool.transaction() as (mydb, cursor):
+        cursor.execute(pastRecentMessagesQuery, (id, day))
+        pastRecentMessagesRecords=cursor.fetchall()
+    if pastRecentMessagesRecords:
+        logger.debug(f"Found {len(pastRecentMessagesRecords)} recent chat messages for user {id} and day {day}")
+    else:
+        logger.debug(f"No previous chat history found for user {id} and day {day}")
+
+    #Related messages that are already part of the recent chat history are not repeated
+    recentRecords={(record[0], record[1]) for record in pastRecentMessagesRecords}
+    #One query gives both the text missing from the metadata and which matches still exist:
+    #vectors outlive the SQL rows cleared by clearUserChatHistory, matches of deleted messages are dropped
+    fetchedMessages=getChatMessagesByIds(id, [message_id for message_id, record in relatedMessages])
+    semanticallyRelatedRecords=[]
+    for message_id, record in relatedMessages:
+        if int(message_id) not in fetchedMessages:
+            continue
+        record = record or fetchedMessages[int(message_id)]
+        if record and tuple(record) not in recentRecords:
+            semanticallyRelatedRecords.append(record)
+
+    #Fit the chat history in the token budget of the providers. The menu and the request are always
+    #sent, recent messages come next and the related ones (best matches first) fill what is left
+    contextBuilder=PromptContextBuilder(getPromptBudget(AIAgent.providers),
+        promptRegistry.getTemplate("modifyDailyMenu").template + (menuOfTheDay or "") + userRequest
+        + "".join(str(value) for value in userData.values()))
+    contextBuilder.addSection("recentChatHistory", [f"User: {record[0]}\nAssistant: {record[1]}\n---\n" for record in pastRecentMessagesRecords],
+        priority=1, separator="", maxPartTokens=CHAT_CONTEXT_MESSAGE_TOKENS)
+    contextBuilder.addSection("semanticallyRelatedChatHistory", [f"User: {record[0]}\nAssistant: {record[1]}\n---\n" for record in semanticallyRelatedRecords],
+        priority=2, separator="", maxPartTokens=CHAT_CONTEXT_MESSAGE_TOKENS)
+    chatContext=contextBuilder.build()
+    recentChatHistory=chatContext["recentChatHistory"] or None
+    semanticallyRelatedChatHistory=chatContext["semanticallyRelatedChatHistory"]
+
+
+
+    prompt = promptRegistry.render("modifyDailyMenu",
             recommendedDailyCalories=recommendedDailyCalories,
             lowerRecommendedDailyCalories=int(recommendedDailyCalories*0.95),
             upperRecommendedDailyCalories=int(recommendedDailyCalories*1.05),
@@ -1069,23 +1725,24 @@ def getDailyModifiedMenu(id:int, day:int, userRequest:str):
             userName=userName,
             dayKey= f"day{day}"
     )
-    print(prompt)
+    logPayload(logger, "Rendered prompt", prompt=prompt)
     #Make API call
     try:
         response = AIAgent.getLLMResponse(prompt)
         #Check if the day{day} key is empty
         result_json=response
         if result_json[f"day{day}"]:
+            response, nutritionReport = checkMenuNutrition(id, response)
             #If the LLM request succeeds, save it to the DB
             saveModifiedDailyMenu(id, day, response)
         else:
-            print(f"No changes made to the menu for user {id} and day {day} due to vague user request")
+            logger.warning(f"No changes made to the menu for user {id} and day {day} due to vague user request")
         #Save the chat history no matter if the menu is modified or not
         saveChatHistory(id, day, userRequest, json.dumps(response, ensure_ascii=False, default=str))
         return response
     
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
         return None
 
 
@@ -1102,28 +1759,31 @@ def saveModifiedDailyMenu(id:int, day:int, jsonPayload:object):
     Success or failure message
     """
 
-    global mydb
-    cursor=mydb.cursor()
-
-    save_modified_daily_menu_query=f"""
-        UPDATE user_menus SET day{day} = %s WHERE user_id = %s
-    """
     try: #Check the length to see if it is an empty array
-        if jsonPayload[f"day{day}"].length > 0:
-            cursor.execute(save_modified_daily_menu_query, (json.dumps(jsonPayload[f"day{day}"], ensure_ascii=False, default=str), id))
-            mydb.commit()
+        if len(jsonPayload[f"day{day}"]) > 0:
+            # Only a new revision of this day is written, the previous one stays in the history
+            with dbPool.transaction(dictionary=True) as (mydb, cursor):
+                menu_version=getMenuVersion(cursor, id)
+                if menu_version is None:
+                    return {"status": "error", "message": f"User {id} has no menu to modify"}
+                # Locks the revisions of the day, so concurrent modifications get consecutive numbers
+                cursor.execute("""
+                    SELECT COALESCE(MAX(revision), -1) AS revision FROM menu_day_revisions
+                    WHERE version_id = %s AND day = %s FOR UPDATE
+                """, (menu_version["version_id"], day))
+                revision=cursor.fetchone()["revision"] + 1
+                insertDayRevision(cursor, id, menu_version["version_id"], day, revision, jsonPayload[f"day{day}"])
+                mydb.commit()
+            indexUserRecipes(id, {f"day{day}": jsonPayload[f"day{day}"]})
         else:
-            print(f"No changes made to the menu for user {id} and day {day} due to vague user request")
-        print(f"Modified daily menu for user {id} and day {day} saved successfully")
+            logger.warning(f"No changes made to the menu for user {id} and day {day} due to vague user request")
+        logger.info(f"Modified daily menu for user {id} and day {day} saved successfully")
         return {"status": "success", "message": f"Modified daily menu for user {id} and day {day} saved successfully"}
     
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
         return {"status": "error", "message":e}
     
-    finally:
-        cursor.close()
-    
 def saveChatHistory(id:int, day:int, userRequest:str, response:str):
     """
     Function to save the chat history
@@ -1137,41 +1797,62 @@ def saveChatHistory(id:int, day:int, userRequest:str, response:str):
     Returns:
     Success or failure message
     """
-    global mydb
-    cursor=mydb.cursor()
-    
     save_chat_history_query=f"""
         INSERT INTO chat_history (user_id, day, request, response, creationDate) VALUES (%s, %s, %s, %s, %s)
     """
-    get_last_id_query="""select max(message_id) from chat_history where user_id=%s and day=%s"""
 
     try:
         #First save to MySQL 
-        cursor.execute(save_chat_history_query, (id, day, userRequest, response, datetime.now()))
-        mydb.commit()
-        print(f"Chat history for user {id} and day {day} saved successfully")
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute(save_chat_history_query, (id, day, userRequest, response, datetime.now()))
+            #Get the ID of the inserted message to use it as reference. lastrowid is scoped to this
+            #connection, so concurrent requests cannot see each other's IDs
+            lastMessageID=cursor.lastrowid
+            mydb.commit()
+        logger.info(f"Chat history for user {id} and day {day} saved successfully")
+        logger.debug(f'Last ID for user {id} and day {day} is {lastMessageID}')
 
-        #Create the embedding for the user's request
-        generated_embedding=vectorizedDB.generate_embedding(userRequest)
+        #Queue the user's request to be embedded and saved in the vectorized DB in the background.
+        #The response is stored next to it, so semantic search results don't need to go back to SQL
+        metadata={"creationDate": str(datetime.now()), "query": userRequest, "day": str(day)}
+        if len(response.encode("utf-8")) <= CHAT_METADATA_MAX_BYTES:
+            metadata["response"]=response
+        indexingQueue.enqueue(id, lastMessageID, userRequest, day, metadata)
 
-        #Get the last inserted ID of that user and day to use it as reference
-        cursor.execute(get_last_id_query, (id, day))
-        lastMessageID=cursor.fetchone()
+        return {"status": "success", "message": f"Chat history for user {id} and day {day} saved successfully"}
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        return {"status": "error", "message":e}
 
-        if lastMessageID and lastMessageID[0]:
-            lastMessageID=lastMessageID[0]
-            print(f'Last ID for user {id} and day {day} is {lastMessageID}')
 
-        #Save the embedding in the vectorized DB
-        if generated_embedding is not None:
-            vectorizedDB.upsert_embedding(id, generated_embedding,lastMessageID,str(datetime.now()), userRequest, day)
+def getChatMessagesByIds(id:int, messageIds:list):
+    """
+    Function to fetch several chat messages of a user with a single query.
+    The vectorized DB keeps the messages deleted by clearUserChatHistory, so the result also tells which of its matches still exist
 
-        return {"status": "success", "message": f"Chat history for user {id} and day {day} saved successfully"}
+    Args:
+    id: Unique identifier for each user
+    messageIds: IDs of the messages in the chat_history table
+
+    Returns:
+    Dictionary of message ID -> (request, response). Messages that don't exist or belong to another user are left out,
+    and on error the dictionary is empty, so no stale message is used
+    """
+    messageIds=[int(messageId) for messageId in messageIds]
+    if not messageIds:
+        return {}
+    placeholders=", ".join(["%s"] * len(messageIds))
+    get_chat_messages_query=f"""
+        SELECT message_id, request, response FROM chat_history WHERE user_id = %s AND message_id IN ({placeholders})
+    """
+    try:
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute(get_chat_messages_query, (id, *messageIds))
+            records=cursor.fetchall()
+        return {record[0]: (record[1], record[2]) for record in records}
     except Exception as e:
-        print(f"Error: {e}")
-        return {"status": "error", "message":e}
-    finally:
-        cursor.close()
+        logger.error(f"Error: {e}")
+        return {}
 
 
 def loadUserMenu(id:int):
@@ -1184,32 +1865,17 @@ def loadUserMenu(id:int):
     Returns:
     Object with the menu of the week
     """
-    global mydb
-    cursor=mydb.cursor(dictionary=True)
-    load_user_menu_query=f"""
-        SELECT * FROM user_menus WHERE user_id = %s
-    """
     try:
-        cursor.execute(load_user_menu_query, (id,))
-        user_menu=cursor.fetchone()
-        if user_menu:
-            user_menu_object={}
-            creationDate=user_menu["creationDate"]
-            for day in range(1, 8):
-                day_data = user_menu[f"day{day}"]
-                if day_data:
-                    # Parse JSON string back to object/array
-                    user_menu_object[f"day{day}"] = json.loads(day_data)
-                else:
-                    user_menu_object[f"day{day}"] = None
-            return user_menu_object, creationDate
-        else:
-            return None
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            menu_version=getMenuVersion(cursor, id)
+            if menu_version:
+                user_menu_object=loadMenuDays(cursor, menu_version["version_id"])
+                return user_menu_object, menu_version["creationDate"].date()
+            else:
+                return None
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
         return None
-    finally:
-        cursor.close()
 
 def loadUserChatHistory(id:int):
     """
@@ -1221,14 +1887,13 @@ def loadUserChatHistory(id:int):
     Returns:
     Object with the chat history of the user divided by days
     """
-    global mydb
-    cursor=mydb.cursor(dictionary=True)
     try: 
         load_user_chat_history_query=f"""
             SELECT * FROM chat_history WHERE user_id = %s ORDER BY creationDate ASC
         """
-        cursor.execute(load_user_chat_history_query, (id,))
-        user_chat_history=cursor.fetchall()
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            cursor.execute(load_user_chat_history_query, (id,))
+            user_chat_history=cursor.fetchall()
         user_chat_history_object={}
 
         for record in user_chat_history:
@@ -1239,10 +1904,8 @@ def loadUserChatHistory(id:int):
             user_chat_history_object[day_key].append({"userRequest": record["request"], "response": json.loads(record["response"]).get("notes", "")})
         return user_chat_history_object
     except Exception as e:
-        print(f"Error: {e}")
+        logger.error(f"Error: {e}")
         return None
-    finally:
-        cursor.close()
 
 
 
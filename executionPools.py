@@ -0,0 +1,79 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from dbPool import dbPool
+
+"""
+Bounded executors used by the FastAPI endpoints to run blocking work off the event loop.
+
+Work is split in separate lanes so that slow calls cannot starve cheap ones:
+1. runLLM: LLM and vector database calls, which can take tens of seconds (LLM_WORKERS, 16 by default).
+2. runDB: plain database reads and writes, served by the connection pool executor (DB_POOL_SIZE).
+3. runCPU: CPU bound work such as the sign in and sign up flows (CPU_WORKERS, number of cores by default).
+   bcrypt itself runs in the process pool of passwordHasher.py, these threads only wait for it.
+"""
+
+
+class ExecutionPools:
+    def __init__(self, llmWorkers: int = None, cpuWorkers: int = None):
+        """
+        llmWorkers: maximum number of LLM bound calls running at the same time.
+        cpuWorkers: maximum number of CPU bound calls running at the same time.
+        """
+        load_dotenv()
+        self.llmWorkers = llmWorkers or int(os.environ.get("LLM_WORKERS", 16))
+        self.cpuWorkers = cpuWorkers or int(os.environ.get("CPU_WORKERS", os.cpu_count() or 2))
+        self.llmExecutor = ThreadPoolExecutor(max_workers=self.llmWorkers, thread_name_prefix="llm")
+        self.cpuExecutor = ThreadPoolExecutor(max_workers=self.cpuWorkers, thread_name_prefix="cpu")
+
+    async def runLLM(self, func, *args, **kwargs):
+        """
+        Run a blocking function that waits on an LLM or the vectorized database.
+
+        Arguments:
+        func: blocking callable.
+        args, kwargs: arguments forwarded to func.
+
+        Returns:
+        The value returned by func.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.llmExecutor, lambda: func(*args, **kwargs))
+
+    async def runDB(self, func, *args, **kwargs):
+        """
+        Run a blocking function that only talks to the database.
+
+        Arguments:
+        func: blocking callable.
+        args, kwargs: arguments forwarded to func.
+
+        Returns:
+        The value returned by func.
+        """
+        return await dbPool.runAsync(func, *args, **kwargs)
+
+    async def runCPU(self, func, *args, **kwargs):
+        """
+        Run a CPU bound function, such as password hashing.
+
+        Arguments:
+        func: blocking callable.
+        args, kwargs: arguments forwarded to func.
+
+        Returns:
+        The value returned by func.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpuExecutor, lambda: func(*args, **kwargs))
+
+    def shutdown(self):
+        """
+        Stop accepting new work and wait for the running calls to finish.
+        """
+        self.llmExecutor.shutdown(wait=True)
+        self.cpuExecutor.shutdown(wait=True)
+
+
+executionPools = ExecutionPools()
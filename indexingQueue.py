@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from dotenv import load_dotenv
+from structuredLogging import getLogger
+
+"""
+Background queue that indexes chat messages in the vectorized database.
+
+saveChatHistory only enqueues the message and returns. A worker thread embeds and upserts the
+pending messages in batches, retrying failures with exponential backoff. The backlog lives in a
+local SQLite file, so messages that were not indexed yet survive a restart.
+
+Messages are searchable only once they have been indexed. Callers that need to read their own
+writes use waitUntilIndexed() with a bounded timeout instead of sleeping after every upsert.
+"""
+
+logger = getLogger(__name__)
+
+
+class EmbeddingIndexingQueue:
+    def __init__(self, vectorizedDB, path: str = None, batchSize: int = None, maxAttempts: int = None, startWorker: bool = True):
+        """
+        vectorizedDB: PineconeVectorizedDatabase used to embed and upsert the messages.
+        path: SQLite file that stores the backlog (INDEXING_QUEUE_PATH, indexing_queue.sqlite3 by default).
+        batchSize: maximum number of messages indexed per batch (INDEXING_BATCH_SIZE, 50 by default).
+        maxAttempts: attempts before a message is marked as failed (INDEXING_MAX_ATTEMPTS, 8 by default).
+        startWorker: whether to start the background worker right away.
+        """
+        load_dotenv()
+        self.vectorizedDB = vectorizedDB
+        self.path = path or os.environ.get("INDEXING_QUEUE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexing_queue.sqlite3"))
+        self.batchSize = batchSize or int(os.environ.get("INDEXING_BATCH_SIZE", 50))
+        self.maxAttempts = maxAttempts or int(os.environ.get("INDEXING_MAX_ATTEMPTS", 8))
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.stats = {"enqueued": 0, "indexed": 0, "retries": 0, "failed": 0}
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS pending_embeddings (
+                message_id INTEGER PRIMARY KEY,
+                namespace INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                failed INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT DEFAULT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_pending_namespace_day ON pending_embeddings (namespace, day, failed)")
+        self.connection.commit()
+
+        self.worker = None
+        if startWorker:
+            self.start()
+
+    def start(self) -> None:
+        """
+        Start the background worker. Messages left in the backlog by a previous run are indexed first.
+        """
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self.run, name="embedding-indexer", daemon=True)
+            self.worker.start()
+
+    def enqueue(self, namespace: int, messageID: int, text: str, day: int, metadata: dict) -> None:
+        """
+        Add a message to the backlog and return immediately.
+
+        Arguments:
+        namespace: The partition to store the embedding (the user ID).
+        messageID: Unique identifier of the message in the chat history SQL table.
+        text: The text to embed.
+        day: Day of the menu the message belongs to.
+        metadata: Metadata stored next to the vector.
+        """
+        with self.condition:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO pending_embeddings (message_id, namespace, day, text, metadata, next_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+                (messageID, namespace, day, text, json.dumps(metadata, ensure_ascii=False, default=str), time.time())
+            )
+            self.connection.commit()
+            self.stats["enqueued"] += 1
+            self.condition.notify_all()
+
+    def pendingCount(self, namespace: int = None, day: int = None) -> int:
+        """
+        Number of messages waiting to be indexed, optionally for a single namespace and day.
+        Messages marked as failed are not counted.
+        """
+        query = "SELECT COUNT(*) FROM pending_embeddings WHERE failed = 0"
+        parameters = []
+        if namespace is not None:
+            query += " AND namespace = ?"
+            parameters.append(namespace)
+        if day is not None:
+            query += " AND day = ?"
+            parameters.append(day)
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchone()[0]
+
+    def waitUntilIndexed(self, namespace: int, day: int, timeout: float = None) -> bool:
+        """
+        Block until every pending message of the namespace and day has been indexed.
+
+        Arguments:
+        namespace: The partition to wait for.
+        day: The day to wait for.
+        timeout: maximum seconds to wait (INDEXING_READ_TIMEOUT, 2 by default).
+
+        Returns:
+        True if nothing is pending anymore, False if the timeout expired first.
+        """
+        timeout = timeout if timeout is not None else float(os.environ.get("INDEXING_READ_TIMEOUT", 2))
+        deadline = time.monotonic() + timeout
+        while self.pendingCount(namespace, day) > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Messages of namespace {namespace} and day {day} are still being indexed")
+                return False
+            with self.condition:
+                self.condition.wait(min(remaining, 0.25))
+        return True
+
+    def takeBatch(self) -> list:
+        """
+        Get the next messages that are due to be indexed.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT message_id, namespace, day, text, metadata, attempts FROM pending_embeddings WHERE failed = 0 AND next_attempt <= ? ORDER BY message_id LIMIT ?",
+                (time.time(), self.batchSize)
+            ).fetchall()
+
+    def indexBatch(self, batch: list) -> None:
+        """
+        Embed and upsert a batch of messages, grouped by namespace. Messages of a group that fails
+        are scheduled again with exponential backoff.
+        """
+        groups = {}
+        for row in batch:
+            groups.setdefault(row[1], []).append(row)
+
+        for namespace, rows in groups.items():
+            try:
+                embeddings = self.vectorizedDB.generate_embeddings([row[3] for row in rows])
+                vectors = []
+                for (messageID, _, _, _, metadata, _), embedding in zip(rows, embeddings):
+                    vectors.append({"id": str(messageID), "values": embedding.tolist(), "metadata": json.loads(metadata)})
+                self.vectorizedDB.upsert_embeddings(namespace, vectors)
+                with self.condition:
+                    self.connection.executemany("DELETE FROM pending_embeddings WHERE message_id = ?", [(row[0],) for row in rows])
+                    self.connection.commit()
+                    self.stats["indexed"] += len(rows)
+                    self.condition.notify_all()
+            except Exception as e:
+                logger.error(f"Error indexing {len(rows)} messages of namespace {namespace}: {e}")
+                self.scheduleRetry(rows, e)
+
+    def scheduleRetry(self, rows: list, error: Exception) -> None:
+        """
+        Schedule failed messages again, or mark them as failed after maxAttempts.
+        """
+        now = time.time()
+        with self.condition:
+            for row in rows:
+                attempts = row[5] + 1
+                if attempts >= self.maxAttempts:
+                    self.connection.execute(
+                        "UPDATE pending_embeddings SET attempts = ?, failed = 1, last_error = ? WHERE message_id = ?",
+                        (attempts, str(error), row[0])
+                    )
+                    self.stats["failed"] += 1
+                else:
+                    self.connection.execute(
+                        "UPDATE pending_embeddings SET attempts = ?, next_attempt = ?, last_error = ? WHERE message_id = ?",
+                        (attempts, now + min(2 ** attempts, 300), str(error), row[0])
+                    )
+                    self.stats["retries"] += 1
+            self.connection.commit()
+            # Readers waiting on a failed message should not wait for it anymore
+            self.condition.notify_all()
+
+    def run(self) -> None:
+        """
+        Worker loop: index every due message, then wait for new ones.
+        """
+        while True:
+            try:
+                batch = self.takeBatch()
+                if batch:
+                    self.indexBatch(batch)
+                    continue
+            except Exception as e:
+                logger.error(f"Error in the embedding indexing worker: {e}")
+            with self.condition:
+                self.condition.wait(1.0)
+
+    def getStats(self) -> dict:
+        """
+        Queue counters and current backlog size.
+        """
+        stats = dict(self.stats)
+        stats["pending"] = self.pendingCount()
+        return stats
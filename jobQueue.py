@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import threading
+from dotenv import load_dotenv
+from structuredLogging import getLogger
+
+"""
+Persistent queue of the long LLM requests (weekly menus, detailed report, AI suggestion, menu modification).
+
+Submitting a job stores it in a local SQLite file and returns its ID right away, so no HTTP connection
+is held open during the LLM call. A pool of worker threads runs the registered handlers and stores
+their results, which are read by polling get() or pushed to the subscribers of the job.
+
+A job identical to one that is still queued or running (same endpoint, user and input) is not queued
+again: the ID of the existing job is returned instead.
+
+Several processes can share the file. A job is claimed with a conditional UPDATE inside BEGIN IMMEDIATE,
+so only one worker runs it, and the claim is a lease that the owner renews while it runs. Jobs whose
+lease expired (their process stopped) are claimed again by the other workers.
+"""
+
+logger = getLogger(__name__)
+
+JOB_STATUSES = ("queued", "running", "done", "failed")
+
+
+class JobQueue:
+    def __init__(self, path: str = None, workers: int = None, resultTTL: float = None, leaseSeconds: float = None, startWorkers: bool = True):
+        """
+        path: SQLite file that stores the jobs (JOB_QUEUE_PATH, job_queue.sqlite3 by default).
+        workers: number of worker threads (JOB_WORKERS, 8 by default).
+        resultTTL: seconds finished jobs are kept to be read (JOB_RESULT_TTL, one hour by default).
+        leaseSeconds: seconds a running job stays claimed without being renewed (JOB_LEASE_SECONDS, 60 by default).
+            Leases are renewed every third of it while the process is alive.
+        startWorkers: whether to start the worker threads right away.
+        """
+        load_dotenv()
+        self.path = path or os.environ.get("JOB_QUEUE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_queue.sqlite3"))
+        self.workers = workers or int(os.environ.get("JOB_WORKERS", 8))
+        self.resultTTL = resultTTL or float(os.environ.get("JOB_RESULT_TTL", 3600))
+        self.leaseSeconds = leaseSeconds or float(os.environ.get("JOB_LEASE_SECONDS", 60))
+        # Identifies this process in the owner column
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.handlers = {}
+        # job ID -> callbacks called with the job once it has finished
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.stats = {"submitted": 0, "deduplicated": 0, "done": 0, "failed": 0}
+
+        # Autocommit: the claims open their own BEGIN IMMEDIATE transactions
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                user_id INTEGER,
+                input_hash TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT DEFAULT NULL,
+                error TEXT DEFAULT NULL,
+                created_at REAL NOT NULL,
+                started_at REAL DEFAULT NULL,
+                finished_at REAL DEFAULT NULL,
+                owner TEXT DEFAULT NULL,
+                lease_until REAL DEFAULT NULL
+            )
+        """)
+        # Files created before the leases
+        columns = {row[1] for row in self.connection.execute("PRAGMA table_info(jobs)").fetchall()}
+        for column, definition in (("owner", "TEXT DEFAULT NULL"), ("lease_until", "REAL DEFAULT NULL")):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_jobs_inflight ON jobs (endpoint, user_id, input_hash, status)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)")
+
+        self.threads = []
+        if startWorkers:
+            self.start()
+
+    def register(self, endpoint: str, handler) -> None:
+        """
+        Register the function that runs the jobs of an endpoint.
+
+        Arguments:
+        endpoint: Name of the endpoint, as used in submit().
+        handler: Callable that receives the JSON payload and returns a JSON serializable result.
+            A None result, or a dict with "status": "error", marks the job as failed.
+        """
+        self.handlers[endpoint] = handler
+
+    def start(self) -> None:
+        """
+        Start the worker threads.
+        """
+        if not self.threads:
+            threading.Thread(target=self.renewLeases, name="job-leases", daemon=True).start()
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.run, name=f"job-worker-{len(self.threads)}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def renewLeases(self) -> None:
+        """
+        Heartbeat: extend the lease of the jobs this process is running, so no other process takes them over.
+        """
+        while True:
+            time.sleep(self.leaseSeconds / 3)
+            try:
+                with self.lock:
+                    self.connection.execute("UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'running'",
+                                            (time.time() + self.leaseSeconds, self.owner))
+            except Exception as e:
+                logger.error(f"Error renewing the job leases: {e}")
+
+    @staticmethod
+    def inputHash(payload: dict) -> str:
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+    def submit(self, endpoint: str, userId: int, payload: dict) -> dict:
+        """
+        Queue a job, unless an identical one is already queued or running.
+
+        Arguments:
+        endpoint: Name of a registered endpoint.
+        userId: ID of the user the job belongs to.
+        payload: JSON input of the handler.
+
+        Returns:
+        Dictionary with the jobId, its status and whether an existing job was reused (deduplicated).
+        """
+        if endpoint not in self.handlers:
+            raise ValueError(f"Unknown job endpoint: {endpoint}")
+        inputHash = self.inputHash(payload)
+        with self.condition:
+            # The check and the insert are one write transaction, also against the other processes
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                existing = self.connection.execute(
+                    "SELECT job_id, status FROM jobs WHERE endpoint = ? AND user_id IS ? AND input_hash = ? AND status IN ('queued', 'running')",
+                    (endpoint, userId, inputHash)
+                ).fetchone()
+                if existing is None:
+                    jobId = uuid.uuid4().hex
+                    self.connection.execute(
+                        "INSERT INTO jobs (job_id, endpoint, user_id, input_hash, payload, status, created_at) VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+                        (jobId, endpoint, userId, inputHash, json.dumps(payload, ensure_ascii=False, default=str), time.time())
+                    )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            if existing:
+                self.stats["deduplicated"] += 1
+                return {"jobId": existing[0], "status": existing[1], "deduplicated": True}
+            self.stats["submitted"] += 1
+            self.condition.notify()
+        return {"jobId": jobId, "status": "queued", "deduplicated": False}
+
+    def get(self, jobId: str) -> dict:
+        """
+        Get the status of a job, and its result once it has finished.
+
+        Returns:
+        Dictionary with jobId, endpoint, userId, status, result, error and the seconds it waited and ran,
+        or None if the job does not exist or has expired.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT job_id, endpoint, status, result, error, created_at, started_at, finished_at, user_id FROM jobs WHERE job_id = ?",
+                (jobId,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = {"jobId": row[0], "endpoint": row[1], "userId": row[8], "status": row[2], "result": json.loads(row[3]) if row[3] else None, "error": row[4]}
+        if row[6] is not None:
+            job["queuedSeconds"] = round(row[6] - row[5], 3)
+        if row[7] is not None:
+            job["runSeconds"] = round(row[7] - row[6], 3)
+        return job
+
+    def subscribe(self, jobId: str, callback) -> None:
+        """
+        Call callback(job) once the job has finished, from the worker thread that ran it.
+        If the job has already finished, the callback is called right away.
+        """
+        with self.lock:
+            self.subscribers.setdefault(jobId, []).append(callback)
+        job = self.get(jobId)
+        if job is None or job["status"] in ("done", "failed"):
+            self.notifySubscribers(jobId, job)
+
+    def unsubscribe(self, jobId: str, callback) -> None:
+        with self.lock:
+            callbacks = self.subscribers.get(jobId, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.subscribers.pop(jobId, None)
+
+    def notifySubscribers(self, jobId: str, job: dict) -> None:
+        with self.lock:
+            callbacks = self.subscribers.pop(jobId, [])
+        for callback in callbacks:
+            try:
+                callback(job)
+            except Exception as e:
+                logger.error(f"Error notifying a subscriber of job {jobId}: {e}")
+
+    def takeJob(self) -> tuple:
+        """
+        Claim the oldest queued job, or a running one whose lease expired, and return it (None if there is none).
+        The claim is a conditional UPDATE in a BEGIN IMMEDIATE transaction, so two processes never take the same job.
+        Must be called with the lock held.
+        """
+        now = time.time()
+        claimable = "(status = 'queued' OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?)))"
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                f"SELECT job_id, endpoint, payload FROM jobs WHERE {claimable} ORDER BY created_at LIMIT 1", (now,)
+            ).fetchone()
+            if row is not None:
+                claimed = self.connection.execute(
+                    f"UPDATE jobs SET status = 'running', owner = ?, lease_until = ?, started_at = ? WHERE job_id = ? AND {claimable}",
+                    (self.owner, now + self.leaseSeconds, now, row[0], now)
+                ).rowcount
+                if claimed != 1:
+                    row = None
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        return row
+
+    def runJob(self, jobId: str, endpoint: str, payload: str) -> None:
+        """
+        Run the handler of a job and store its result.
+        """
+        result = None
+        error = None
+        try:
+            result = self.handlers[endpoint](json.loads(payload))
+            if result is None:
+                error = "The request could not be completed, please, try again"
+            elif isinstance(result, dict) and result.get("status") == "error":
+                # e.g. a menu that was generated but could not be saved
+                error = str(result.get("message"))
+        except Exception as e:
+            logger.error(f"Job {jobId} ({endpoint}) failed: {e}")
+            error = str(e)
+
+        status = "done" if error is None else "failed"
+        with self.lock:
+            # A job whose lease was taken over by another process is left to it
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_until = NULL WHERE job_id = ? AND owner = ?",
+                (status, json.dumps(result, ensure_ascii=False, default=str) if error is None else None, error, time.time(), jobId, self.owner)
+            )
+            self.stats[status] += 1
+        self.notifySubscribers(jobId, self.get(jobId))
+
+    def purgeExpired(self) -> None:
+        """
+        Delete the finished jobs older than resultTTL.
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (time.time() - self.resultTTL,))
+
+    def run(self) -> None:
+        """
+        Worker loop: run queued jobs, then wait for new ones.
+        """
+        lastPurge = 0.0
+        while True:
+            try:
+                with self.condition:
+                    job = self.takeJob()
+                    if job is None:
+                        self.condition.wait(1.0)
+                if job is not None:
+                    self.runJob(*job)
+                elif time.monotonic() - lastPurge > 60:
+                    self.purgeExpired()
+                    lastPurge = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error in the job worker: {e}")
+                time.sleep(1.0)
+
+    def getStats(self) -> dict:
+        """
+        Queue counters and number of jobs in each status.
+        """
+        with self.lock:
+            counts = dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            stats = dict(self.stats)
+        stats.update({status: counts.get(status, 0) for status in JOB_STATUSES})
+        stats["workers"] = self.workers
+        return stats
+
+
+jobQueue = JobQueue(startWorkers=False)
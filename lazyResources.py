@@ -0,0 +1,108 @@
+import time
+import threading
+from structuredLogging import getLogger
+
+"""
+Thread-safe lazy initialization of the external clients (LLM SDKs, vector database, indexing queue...).
+
+A LazyResource builds its value with a factory on first use. Concurrent first uses wait for a single
+initialization, later uses only read an attribute. The time every resource took to initialize is
+recorded, together with the startup phases reported by the application, in getStartupReport().
+
+LazyProxy lets a module-level singleton be lazy without changing its call sites: every attribute
+access is forwarded to the value of the resource.
+"""
+
+logger = getLogger(__name__)
+
+# Every resource created in this process, by name
+resources = {}
+# Startup phases reported with recordPhase, in order
+phases = []
+processStart = time.perf_counter()
+
+
+class LazyResource:
+    def __init__(self, name: str, factory):
+        """
+        name: name shown in the startup report.
+        factory: callable without arguments that builds the value.
+        """
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.initialized = False
+        self.initSeconds = None
+        self.initializedAt = None
+        self.lock = threading.Lock()
+        resources[name] = self
+
+    def get(self):
+        """
+        Get the value, building it on first use. If the factory raises, the error is propagated
+        and the next use tries again.
+        """
+        if self.initialized:
+            return self.value
+        with self.lock:
+            if not self.initialized:
+                start = time.perf_counter()
+                self.value = self.factory()
+                self.initSeconds = time.perf_counter() - start
+                self.initializedAt = time.perf_counter() - processStart
+                self.initialized = True
+                logger.info(f"Initialized {self.name} in {self.initSeconds * 1000:.0f} ms")
+        return self.value
+
+
+class LazyProxy:
+    def __init__(self, resource: LazyResource):
+        object.__setattr__(self, "_resource", resource)
+
+    def __getattr__(self, name):
+        return getattr(self._resource.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resource.get(), name, value)
+
+
+def lazy(name: str, factory) -> LazyProxy:
+    """
+    Create a lazy module-level singleton.
+
+    Arguments:
+    name: name shown in the startup report.
+    factory: callable without arguments that builds the singleton.
+
+    Returns:
+    A proxy that builds the singleton on its first attribute access.
+    """
+    return LazyProxy(LazyResource(name, factory))
+
+
+def recordPhase(name: str, seconds: float) -> None:
+    """
+    Add a startup phase (e.g. the imports of the application) to the startup report.
+    """
+    phases.append({"phase": name, "ms": round(seconds * 1000, 1)})
+
+
+def getStartupReport() -> dict:
+    """
+    Startup phases and the initialization time of every lazy resource.
+
+    Returns:
+    Dictionary with the startup phases, and for each resource whether it has been initialized,
+    how long it took and how many seconds after the process start it happened.
+    """
+    return {
+        "phases": list(phases),
+        "resources": {
+            name: {
+                "initialized": resource.initialized,
+                "ms": round(resource.initSeconds * 1000, 1) if resource.initSeconds is not None else None,
+                "atSecond": round(resource.initializedAt, 3) if resource.initializedAt is not None else None,
+            }
+            for name, resource in resources.items()
+        },
+    }
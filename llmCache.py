@@ -0,0 +1,145 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+"""
+Persistent cache of LLM responses, stored in a local SQLite file.
+
+Entries are content addressed: the key is a hash of the normalized prompt plus the provider
+and model that produced the response. Identical prompts (e.g. the same allergy/condition
+combination in getAISuggestion) are answered from disk without calling the LLM, also after a restart.
+Only calls made with getLLMResponse(useCache=True), the deterministic prompts, read and fill the cache:
+generated menus are never served from it.
+"""
+
+
+class LLMResponseCache:
+    def __init__(self, path: str = None, ttlSeconds: float = None, maxEntries: int = None):
+        """
+        path: SQLite file used to store the cache (LLM_CACHE_PATH, llm_cache.sqlite3 by default).
+        ttlSeconds: seconds an entry stays valid (LLM_CACHE_TTL, one week by default).
+        maxEntries: maximum number of entries, least recently used ones are evicted (LLM_CACHE_MAX_ENTRIES, 5000 by default).
+        """
+        load_dotenv()
+        self.path = path or os.environ.get("LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm_cache.sqlite3"))
+        self.ttlSeconds = ttlSeconds or float(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 3600))
+        self.maxEntries = maxEntries or int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 5000))
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0}
+
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                cache_key TEXT PRIMARY KEY,
+                provider TEXT NOT NULL,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)")
+        self.connection.commit()
+
+    @staticmethod
+    def makeKey(prompt: str, provider: str, model: str) -> str:
+        """
+        Build the cache key of a prompt. Whitespace differences do not change the key.
+
+        Arguments:
+        prompt: The rendered prompt.
+        provider: Name of the provider.
+        model: Name of the model.
+
+        Returns:
+        SHA-256 hex digest identifying the entry.
+        """
+        normalizedPrompt = re.sub(r"\s+", " ", prompt).strip()
+        return hashlib.sha256(f"{provider}\x00{model}\x00{normalizedPrompt}".encode("utf-8")).hexdigest()
+
+    def get(self, prompt: str, provider: str, model: str) -> object:
+        """
+        Look up a cached response.
+
+        Arguments:
+        prompt: The rendered prompt.
+        provider: Name of the provider.
+        model: Name of the model.
+
+        Returns:
+        The cached parsed JSON response, or None if there is no valid entry.
+        """
+        key = self.makeKey(prompt, provider, model)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT response, created_at FROM llm_cache WHERE cache_key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            if now - row[1] > self.ttlSeconds:
+                self.connection.execute("DELETE FROM llm_cache WHERE cache_key = ?", (key,))
+                self.connection.commit()
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.connection.execute("UPDATE llm_cache SET last_access = ? WHERE cache_key = ?", (now, key))
+            self.connection.commit()
+            self.stats["hits"] += 1
+        return json.loads(row[0])
+
+    def set(self, prompt: str, provider: str, model: str, response: object) -> None:
+        """
+        Store a response, evicting the least recently used entries if the cache is full.
+
+        Arguments:
+        prompt: The rendered prompt.
+        provider: Name of the provider.
+        model: Name of the model.
+        response: The parsed JSON response.
+        """
+        key = self.makeKey(prompt, provider, model)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (cache_key, provider, model, response, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, provider, model, json.dumps(response, ensure_ascii=False, default=str), now, now)
+            )
+            self.stats["stores"] += 1
+            count = self.connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if count > self.maxEntries:
+                overflow = count - self.maxEntries
+                self.connection.execute(
+                    "DELETE FROM llm_cache WHERE cache_key IN (SELECT cache_key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,)
+                )
+                self.stats["evictions"] += overflow
+            self.connection.commit()
+
+    def clear(self) -> None:
+        """
+        Remove every entry from the cache.
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM llm_cache")
+            self.connection.commit()
+
+    def getStats(self) -> dict:
+        """
+        Cache counters.
+
+        Returns:
+        Dictionary with hits, misses, stores, evictions, expirations, hit ratio and current size.
+        """
+        with self.lock:
+            size = self.connection.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hitRatio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["size"] = size
+        return stats
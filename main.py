@@ -1,14 +1,36 @@
-from fastapi import FastAPI, Query,HTTPException
+import time
+importStart = time.perf_counter()
+from fastapi import FastAPI, Query,HTTPException, WebSocket, WebSocketDisconnect, Request, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field, EmailStr
 from typing import Annotated
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
+import os
+import hmac
+import json
+import asyncio
+import threading
 from enum import Enum
 from dotenv import load_dotenv
 
-from dbQueries import DBConnect, signUpUser,signInUser, updateBasicInformation,getAISuggestion,updateAdditionalInformation, getDetailedReport, getWeeklyMenus, getDailyModifiedMenu, loadUserMenu, loadUserChatHistory
+from dbQueries import DBConnect, signUpUser,signInUser, updateBasicInformation,getAISuggestion,updateAdditionalInformation, getDetailedReport, getWeeklyMenus, getWeeklyMenusStream, getDailyModifiedMenu, loadUserMenu, loadUserChatHistory, viewUserById, checkMenuNutrition, AIAgent, indexingQueue, userProfileCache
 from models import User, UserLogin, BasicInformationUser,AdditionalInformationUser, ModifyDailyMenuRequest, UserFeedback
+from executionPools import executionPools
+from promptRegistry import promptRegistry
+from menuBatchRunner import menuBatchRunner
+from jobQueue import jobQueue
+from singleFlight import singleFlight
+from lazyResources import recordPhase, getStartupReport
+from passwordHasher import passwordHasher
+from sessionTokens import sessionTokens
+from recipeLibrary import recipeLibrary
+from nutritionEngine import parseAllergies
+from structuredLogging import getLogger, logPayload, getLoggingSettings, setLogLevel, setPayloadLogging, setSampleRate
+
+logger = getLogger(__name__)
+
+recordPhase("imports", time.perf_counter() - importStart)
 
 load_dotenv()
 app=FastAPI()
@@ -21,14 +43,116 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-#Initialize connection with the database
-mydb=DBConnect()
+#Admin-only endpoints (batch jobs, logging settings) require the header "X-Admin-Token: <ADMIN_TOKEN>".
+#Without ADMIN_TOKEN they are disabled
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN to enable them")
+    token = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin credential")
+
+#Blocking work runs in bounded executors (see executionPools.py) so the event loop stays free
+@app.on_event("shutdown")
+def shutdown_execution_pools():
+    executionPools.shutdown()
+    passwordHasher.shutdown()
+
+#Long LLM requests can also be submitted as jobs and collected later (see jobQueue.py)
+#Jobs share the single-flight keys of the endpoints, so a job and an identical request in flight run once
+jobQueue.register("getWeeklyMenus", lambda payload: singleFlight.do(
+    singleFlight.makeKey("getWeeklyMenus", payload.get("id"), payload.get("userFeedback"), payload.get("engine")),
+    getWeeklyMenus, payload.get("id"), payload.get("userFeedback"), payload.get("engine")))
+jobQueue.register("getDetailedReport", lambda payload: singleFlight.do(
+    singleFlight.makeKey("getDetailedReport", payload.get("id")),
+    getDetailedReport, payload.get("id")))
+jobQueue.register("getAISuggestion", lambda payload: singleFlight.do(
+    singleFlight.makeKey("getAISuggestion", payload.get("id"), payload),
+    getAISuggestion, AdditionalInformationUser(**payload)))
+jobQueue.register("modifyDailyMenu", lambda payload: singleFlight.do(
+    singleFlight.makeKey("modifyDailyMenu", payload["id"], payload["day"], payload["userRequest"]),
+    getDailyModifiedMenu, payload["id"], payload["day"], payload["userRequest"]))
+jobQueue.start()
+
+#The database pool and the clients are created on first use. Warming them up in the background
+#keeps the startup fast, and starts indexing the chat messages left by a previous run
+@app.on_event("startup")
+def warm_up_resources():
+    recordPhase("application ready", time.perf_counter() - importStart)
+    logger.info("Startup report", extra={"fields": getStartupReport()})
+    def warm_up():
+        start = time.perf_counter()
+        if DBConnect() is None:
+            logger.error("Database connection failed. Please check your environment variables and database configuration.")
+        recordPhase("database pool", time.perf_counter() - start)
+        try:
+            indexingQueue.start()
+        except Exception as e:
+            logger.error(f"Error starting the indexing queue: {e}")
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+#Sessions are signed tokens (see sessionTokens.py), sent in the session cookie or as "Authorization: Bearer <token>"
+#Every request about a user needs that user's session. SESSION_REQUIRED=false is a migration-only opt-out:
+#requests without a session then still trust the user ID they send, so clients from before sessions keep working
+SESSION_COOKIE = "session"
+SESSION_REQUIRED = os.environ.get("SESSION_REQUIRED", "true").lower() == "true"
+if not SESSION_REQUIRED:
+    logger.warning("SESSION_REQUIRED=false: requests without a session are trusted, only use it while clients migrate")
+elif sessionTokens.generatedSecret:
+    #Each worker would sign with its own random secret and reject the sessions of the others
+    logger.error("SESSION_REQUIRED is true but SESSION_SECRET is not set, refusing to start")
+    raise RuntimeError("SESSION_SECRET must be set when SESSION_REQUIRED is true")
+
+def get_session_token(request: Request):
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        return authorization[len("Bearer "):]
+    return request.cookies.get(SESSION_COOKIE)
+
+def require_session(request: Request) -> int:
+    #Returns the ID of the user of the session, without touching the database
+    userId = sessionTokens.verify(get_session_token(request))
+    if userId is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired session")
+    return userId
+
+def authorize_user(request: Request, userId):
+    #A request about a user must come from that user's session (or, with the SESSION_REQUIRED=false opt-out, send no session at all)
+    token = get_session_token(request)
+    if token is None and not SESSION_REQUIRED:
+        return
+    sessionUserId = require_session(request)
+    if userId is not None and str(sessionUserId) != str(userId):
+        raise HTTPException(status_code=403, detail="The session does not belong to this user")
+
+MENU_ENGINES = ("llm", "planner", "auto")
+
+def check_menu_engine(engine):
+    #None uses the MENU_ENGINE default, anything else must be one of the known engines
+    if engine is not None and (not isinstance(engine, str) or engine.lower() not in MENU_ENGINES):
+        raise HTTPException(status_code=400, detail=f"Unknown menu engine: {engine}, expected one of {', '.join(MENU_ENGINES)}")
+
+def split_words(words: str):
+    #"chicken, rice" -> ["chicken", "rice"], for the comma-separated query parameters
+    return [word.strip() for word in words.split(",") if word.strip()] if words else None
+
+#Menu batch jobs interrupted by a restart continue where they stopped
+@app.on_event("startup")
+def resume_menu_batch_jobs():
+    def resume():
+        try:
+            menuBatchRunner.resumeUnfinished()
+        except Exception as e:
+            logger.error(f"Error resuming menu batch jobs: {e}")
+    threading.Thread(target=resume, name="menu-batch-resume", daemon=True).start()
 
 @app.get("/")
 
 @app.post("/signUp")
 async def signUp(user: User):
-    response=signUpUser(user)
+    response=await executionPools.runCPU(signUpUser, user)
     if response.get("user"):
         response.update({"status": 201})
         return response
@@ -37,17 +161,21 @@ async def signUp(user: User):
     
 
 @app.post("/signIn")
-async def signIn(userLogin: UserLogin):
-    response=signInUser(userLogin)
+async def signIn(userLogin: UserLogin, httpResponse: Response):
+    response=await executionPools.runCPU(signInUser, userLogin)
     if response.get("user"):
-        response.update({"status": 200})
+        #Later requests prove the identity with the session token instead of the password
+        session = sessionTokens.issue(response["user"]["id"])
+        httpResponse.set_cookie(SESSION_COOKIE, session["token"], max_age=sessionTokens.ttlSeconds, httponly=True, samesite="lax")
+        response.update({"status": 200, "token": session["token"], "expiresAt": session["expiresAt"]})
         return response
     else:
         return  {"status": 400, "error": response.get("error")}
     
 @app.post("/updateBasicInformation")
-async def update_basic_information(basicUser: BasicInformationUser):
-    response = updateBasicInformation(basicUser)
+async def update_basic_information(basicUser: BasicInformationUser, httpRequest: Request):
+    authorize_user(httpRequest, basicUser.id)
+    response = await executionPools.runCPU(updateBasicInformation, basicUser)
     if response.get("user"):
         response.update({"status": 200})
         return response
@@ -55,54 +183,218 @@ async def update_basic_information(basicUser: BasicInformationUser):
         return {"status": 400, "error": response.get("error")}
     
 @app.post("/getAISuggestion")
-async def get_AI_Suggestion(additionalInformationUser: AdditionalInformationUser):
-    response= getAISuggestion(additionalInformationUser)
+async def get_AI_Suggestion(additionalInformationUser: AdditionalInformationUser, httpRequest: Request):
+    authorize_user(httpRequest, additionalInformationUser.id)
+    #Identical requests in flight (double clicks, repeated calls of the frontend) share a single LLM call
+    response= await singleFlight.doAsync(
+        singleFlight.makeKey("getAISuggestion", additionalInformationUser.id, additionalInformationUser.model_dump()),
+        lambda: executionPools.runLLM(getAISuggestion, additionalInformationUser))
     if response:
         return response
     else:
         return None
 
 @app.post("/updateAdditionalInformation")
-async def update_additional_information(additionalInformationUser: AdditionalInformationUser):
-    response = updateAdditionalInformation(additionalInformationUser)
+async def update_additional_information(additionalInformationUser: AdditionalInformationUser, httpRequest: Request):
+    authorize_user(httpRequest, additionalInformationUser.id)
+    response = await executionPools.runDB(updateAdditionalInformation, additionalInformationUser)
     if response:
-        print(response)
+        logPayload(logger, "Additional information updated", response=response)
         return response
     else:
         return None
     
 @app.post("/getDetailedReport")
-async def get_detailed_report(id:int):
-    response= getDetailedReport(id)
+async def get_detailed_report(id:int, httpRequest: Request):
+    authorize_user(httpRequest, id)
+    response= await singleFlight.doAsync(singleFlight.makeKey("getDetailedReport", id),
+        lambda: executionPools.runLLM(getDetailedReport, id))
     if response:
-        print(response)
+        logPayload(logger, "Detailed report", response=response)
         return response
     else:
         return None
     
 @app.post("/getWeeklyMenus") 
-async def get_weekly_menus(request: dict):
+async def get_weekly_menus(request: dict, httpRequest: Request):
     id = request.get("id")
+    authorize_user(httpRequest, id)
     userFeedback = request.get("userFeedback")
-    response=getWeeklyMenus(id, userFeedback)
+    #"engine": "planner" or "auto" builds the menu locally, without the LLM (see menuPlanner.py)
+    engine = request.get("engine")
+    check_menu_engine(engine)
+    response=await singleFlight.doAsync(singleFlight.makeKey("getWeeklyMenus", id, userFeedback, engine),
+        lambda: executionPools.runLLM(getWeeklyMenus, id, userFeedback, engine))
+    if response and response.get("status") == "error":
+        raise HTTPException(status_code=500, detail=response["message"])
     if response:
-        print(response)
+        logPayload(logger, "Weekly menus", response=response)
         return response
     else:
         raise HTTPException(status_code=400, detail="Failed to obtain menus, please, try again")
 
+@app.post("/getWeeklyMenusStream")
+async def get_weekly_menus_stream(request: dict, httpRequest: Request):
+    #Streams one NDJSON line per day as soon as it is generated, then a final "done" or "error" line
+    id = request.get("id")
+    authorize_user(httpRequest, id)
+    userFeedback = request.get("userFeedback")
+    events = getWeeklyMenusStream(id, userFeedback)
+    #A generator cannot be closed while a step runs in another thread, so steps and close take turns
+    eventsLock = threading.Lock()
+
+    def next_event():
+        with eventsLock:
+            return next(events, None)
+
+    def close_events():
+        with eventsLock:
+            events.close()
+
+    async def ndjson_events():
+        try:
+            while True:
+                #Each step of the generator blocks on the LLM, so it runs in the LLM executor
+                event = await executionPools.runLLM(next_event)
+                if event is None:
+                    break
+                yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
+        finally:
+            #When the client disconnects, closing the generator stops the LLM stream instead of letting it run (and bill) to the end.
+            #Not awaited: the task may be cancelled, and close waits for the step in progress
+            executionPools.llmExecutor.submit(close_events)
+
+    return StreamingResponse(ndjson_events(), media_type="application/x-ndjson")
+
+@app.post("/batch/weeklyMenus")
+async def create_weekly_menus_batch(request: dict, httpRequest: Request):
+    #Regenerating menus clears the users' chat history and spends LLM budget, so only admins can start a batch
+    require_admin(httpRequest)
+    #Generates the menus of many users in the background. Without "userIds", every user with a nutritional assessment
+    userIds = request.get("userIds")
+    useProviderBatch = bool(request.get("useProviderBatch", False))
+    jobId = await executionPools.runDB(menuBatchRunner.createJob, userIds)
+    menuBatchRunner.start(jobId, useProviderBatch)
+    return {"jobId": jobId}
+
+@app.get("/batch/weeklyMenus/{jobId}")
+async def get_weekly_menus_batch(jobId: int, httpRequest: Request):
+    require_admin(httpRequest)
+    report = await executionPools.runDB(menuBatchRunner.getReport, jobId)
+    if report is None:
+        raise HTTPException(status_code=404, detail=f"Batch job {jobId} not found")
+    return report
+
 @app.post("/modifyDailyMenu")
-async def modify_daily_menu(modifyRequest: ModifyDailyMenuRequest):
+async def modify_daily_menu(modifyRequest: ModifyDailyMenuRequest, httpRequest: Request):
+    authorize_user(httpRequest, modifyRequest.id)
     #Lets send id, day and request to the function
-    response=getDailyModifiedMenu(modifyRequest.id, modifyRequest.day, modifyRequest.userRequest)
+    response=await singleFlight.doAsync(
+        singleFlight.makeKey("modifyDailyMenu", modifyRequest.id, modifyRequest.day, modifyRequest.userRequest),
+        lambda: executionPools.runLLM(getDailyModifiedMenu, modifyRequest.id, modifyRequest.day, modifyRequest.userRequest))
     if response:
         return response
     else:
         return None
 
+@app.post("/nutrition/check")
+async def check_menu_nutrition(request: dict, httpRequest: Request):
+    #Recomputes the macros of a menu ({"day1": [...], ...}) and, unless "repair" is false, rescales the days outside the bands
+    id = request.get("id")
+    authorize_user(httpRequest, id)
+    menu, report = await executionPools.runCPU(checkMenuNutrition, id, request.get("menu"), bool(request.get("repair", True)))
+    if report is None:
+        raise HTTPException(status_code=400, detail="The menu could not be checked, the nutritional assessment may not be completed")
+    return {"menu": menu, "report": report}
+
+@app.get("/recipes")
+async def get_recipes(
+    type: str = None, cuisine: str = None,
+    minCalories: int = None, maxCalories: int = None, minProtein: int = None, maxProtein: int = None,
+    minFats: int = None, maxFats: int = None, minCarbohydrates: int = None, maxCarbohydrates: int = None,
+    excludeAllergens: str = None, includeIngredients: str = None, excludeIngredients: str = None,
+    limit: Annotated[int, Query(ge=1, le=200)] = 50,
+):
+    #Searches the recipe library, e.g. /recipes?type=lunch&minProtein=40&excludeAllergens=peanuts,dairy. Lists are comma-separated
+    bounds = {"calories": (minCalories, maxCalories), "protein": (minProtein, maxProtein), "fats": (minFats, maxFats), "carbohydrates": (minCarbohydrates, maxCarbohydrates)}
+    ranges = {macro: bound for macro, bound in bounds.items() if bound != (None, None)}
+    try:
+        recipes = await executionPools.runDB(
+            recipeLibrary.query, type, ranges, parseAllergies(excludeAllergens), split_words(includeIngredients),
+            split_words(excludeIngredients), cuisine, False, limit,
+        )
+    except Exception as e:
+        logger.error(f"Error querying the recipe library: {e}")
+        raise HTTPException(status_code=503, detail="The recipe library is not available")
+    return {"recipes": recipes, "count": len(recipes)}
+
+@app.post("/jobs/{endpoint}", status_code=202)
+async def submit_job(endpoint: str, request: dict, httpRequest: Request):
+    #Returns the job ID right away, the result is read from /jobs/{jobId} or pushed through /ws/jobs/{jobId}
+    authorize_user(httpRequest, request.get("id"))
+    if endpoint not in jobQueue.handlers:
+        raise HTTPException(status_code=404, detail=f"Unknown job endpoint: {endpoint}")
+    try:
+        if endpoint == "modifyDailyMenu":
+            request = ModifyDailyMenuRequest(**request).model_dump()
+        elif endpoint == "getAISuggestion":
+            request = AdditionalInformationUser(**request).model_dump()
+        elif endpoint == "getWeeklyMenus":
+            check_menu_engine(request.get("engine"))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return await executionPools.runDB(jobQueue.submit, endpoint, request.get("id"), request)
+
+@app.get("/jobs/{jobId}")
+async def get_job(jobId: str, httpRequest: Request):
+    job = await executionPools.runDB(jobQueue.get, jobId)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {jobId} not found")
+    #Results hold menus and health data, only the user that submitted the job can read them
+    authorize_user(httpRequest, job.pop("userId"))
+    return job
+
+@app.websocket("/ws/jobs/{jobId}")
+async def job_updates(websocket: WebSocket, jobId: str):
+    #Sends the current status of the job, then the finished job as soon as it is available
+    job = await executionPools.runDB(jobQueue.get, jobId)
+    if job is not None:
+        #Same check as GET /jobs/{jobId}, with the session of the handshake (cookie or Authorization header)
+        try:
+            authorize_user(websocket, job.pop("userId"))
+        except HTTPException:
+            await websocket.close(code=1008)
+            return
+    await websocket.accept()
+    if job is None:
+        await websocket.send_json({"jobId": jobId, "status": "not_found"})
+        await websocket.close()
+        return
+    await websocket.send_json(job)
+    if job["status"] in ("done", "failed"):
+        await websocket.close()
+        return
+
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    def on_finished(finishedJob):
+        if finishedJob is not None:
+            finishedJob.pop("userId", None)
+        loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(finishedJob))
+    jobQueue.subscribe(jobId, on_finished)
+    try:
+        await websocket.send_text(json.dumps(await finished, ensure_ascii=False, default=str))
+        await websocket.close()
+    except (WebSocketDisconnect, RuntimeError):
+        #The client left before the job finished
+        pass
+    finally:
+        jobQueue.unsubscribe(jobId, on_finished)
+
 @app.get("/loadUserMenu")
-async def load_user_menu(id:int):
-    result = loadUserMenu(id)
+async def load_user_menu(id:int, httpRequest: Request):
+    authorize_user(httpRequest, id)
+    result = await executionPools.runDB(loadUserMenu, id)
     if result:
         response, creationDate = result
         return response, creationDate
@@ -110,10 +402,104 @@ async def load_user_menu(id:int):
         return None
 
 @app.get("/loadUserChatHistory")
-async def load_user_chat_history(id:int):
-    response=loadUserChatHistory(id)
+async def load_user_chat_history(id:int, httpRequest: Request):
+    authorize_user(httpRequest, id)
+    response=await executionPools.runDB(loadUserChatHistory, id)
     if response:
         return response
     else:
         return None
 
+@app.get("/verify-session")
+async def verify_session(httpRequest: Request):
+    #Page loads check the session here instead of signing in again. The profile comes from the user cache
+    userId = require_session(httpRequest)
+    user = await executionPools.runDB(viewUserById, userId)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Invalid or expired session")
+    return user
+
+@app.get("/user/me")
+async def get_current_user(httpRequest: Request):
+    userId = require_session(httpRequest)
+    user = await executionPools.runDB(viewUserById, userId)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+@app.post("/logout")
+async def logout(httpRequest: Request, httpResponse: Response):
+    revoked = sessionTokens.revoke(get_session_token(httpRequest))
+    httpResponse.delete_cookie(SESSION_COOKIE)
+    return {"status": 200, "revoked": revoked}
+
+@app.get("/metrics/prompts")
+async def prompt_metrics():
+    return promptRegistry.getStats()
+
+@app.get("/metrics/llmCache")
+async def llm_cache_metrics():
+    if AIAgent.cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **AIAgent.cache.getStats()}
+
+@app.get("/metrics/indexingQueue")
+async def indexing_queue_metrics():
+    return await executionPools.runDB(indexingQueue.getStats)
+
+@app.get("/metrics/jobs")
+async def job_metrics():
+    return await executionPools.runDB(jobQueue.getStats)
+
+@app.get("/metrics/singleFlight")
+async def single_flight_metrics():
+    return singleFlight.getStats()
+
+@app.get("/admin/logging")
+async def get_logging_settings(httpRequest: Request):
+    require_admin(httpRequest)
+    return getLoggingSettings()
+
+@app.post("/admin/logging")
+async def update_logging_settings(request: dict, httpRequest: Request):
+    #Payload logging writes prompts and profiles (health data) to the logs, so only admins can switch it on
+    require_admin(httpRequest)
+    #Switch the level, the sampling and the payload logging at runtime, e.g. {"level": "DEBUG", "payloads": true}
+    try:
+        if "level" in request:
+            setLogLevel(request["level"])
+        if "sampleRate" in request:
+            setSampleRate(request["sampleRate"])
+        if "payloads" in request:
+            setPayloadLogging(request["payloads"])
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return getLoggingSettings()
+
+@app.get("/metrics/startup")
+async def startup_metrics():
+    return getStartupReport()
+
+@app.get("/metrics/rateLimits")
+async def rate_limit_metrics():
+    return {name: limiter.getStats() for name, limiter in AIAgent.rateLimiters.items()}
+
+@app.get("/metrics/llm")
+async def llm_metrics():
+    return AIAgent.getStats()
+
+@app.get("/metrics/userCache")
+async def user_cache_metrics():
+    return userProfileCache.getStats()
+
+@app.get("/metrics/passwordHashing")
+async def password_hashing_metrics():
+    return passwordHasher.getStats()
+
+@app.get("/metrics/sessions")
+async def session_metrics():
+    return sessionTokens.getStats()
+
+@app.get("/metrics/recipes")
+async def recipe_metrics():
+    return recipeLibrary.getStats()
@@ -0,0 +1,401 @@
+import os
+import time
+import uuid
+import socket
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+from dbPool import dbPool
+from dbQueries import AIAgent, getWeeklyMenus, buildWeeklyMenusPrompt, saveWeeklyMenus, checkMenuNutrition
+from structuredLogging import getLogger
+
+"""
+Batch generation of the weekly menus of many users (e.g. the weekly regeneration of every user).
+
+A job is a list of users stored in MySQL. Every user is an item whose status is checkpointed as it
+progresses (pending -> running -> done/failed), so a job interrupted by a crash or a restart resumes
+where it stopped: resumeUnfinished() runs every job that has not finished yet.
+
+Items run through getWeeklyMenus with bounded concurrency. Calls to the providers go through the rate
+limiters of AIAgent (LLM_RATE_LIMIT). Optionally, the prompts are first sent to the OpenAI Batch API,
+and the users it could not answer fall back to the normal path.
+
+Item statuses:
+- pending: waiting to be generated.
+- batched: sent to the OpenAI Batch API, waiting for its results.
+- running: being generated by the worker in owner, until leaseUntil.
+- done / failed: finished.
+
+Several workers may run the runner (main.py resumes the unfinished jobs in every worker). A job is run
+by the worker that holds its lease, and every item is claimed with a conditional UPDATE on its status, so
+a menu is never generated twice at the same time. Leases are renewed by a heartbeat while the worker is
+alive: only the items and jobs of a worker that stopped renewing them (crash, restart) are taken over.
+"""
+
+logger = getLogger(__name__)
+
+ITEM_STATUSES = ("pending", "batched", "running", "done", "failed")
+
+
+class WeeklyMenuBatchRunner:
+    def __init__(self, concurrency: int = None, maxAttempts: int = None, pollInterval: float = None, leaseSeconds: float = None):
+        """
+        concurrency: users generated at the same time (MENU_BATCH_CONCURRENCY, 8 by default).
+        maxAttempts: attempts per user before it is marked as failed (MENU_BATCH_MAX_ATTEMPTS, 3 by default).
+        pollInterval: seconds between two checks of an OpenAI batch (MENU_BATCH_POLL_INTERVAL, 60 by default).
+        leaseSeconds: seconds a worker owns a job or an item without renewing it (MENU_BATCH_LEASE_SECONDS, 120 by default).
+            Leases are renewed every third of it, so a stopped worker's items are taken over after at most this long.
+        """
+        load_dotenv()
+        self.concurrency = concurrency or int(os.environ.get("MENU_BATCH_CONCURRENCY", 8))
+        self.maxAttempts = maxAttempts or int(os.environ.get("MENU_BATCH_MAX_ATTEMPTS", 3))
+        self.pollInterval = pollInterval or float(os.environ.get("MENU_BATCH_POLL_INTERVAL", 60))
+        self.leaseSeconds = leaseSeconds or float(os.environ.get("MENU_BATCH_LEASE_SECONDS", 120))
+        # Identifies this worker in the owner columns
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="menu-batch")
+        self.tablesCreated = False
+        # Jobs being run by this process, a job is never run twice at the same time
+        self.runningJobs = set()
+        self.lock = threading.Lock()
+
+    def createTables(self) -> None:
+        """
+        Create the checkpoint tables if they don't exist.
+        """
+        if self.tablesCreated:
+            return
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS menu_batch_jobs (
+                    job_id INT PRIMARY KEY AUTO_INCREMENT,
+                    provider_batch_id VARCHAR(100) DEFAULT NULL,
+                    creationDate DATETIME NOT NULL,
+                    startedAt DATETIME DEFAULT NULL,
+                    finishedAt DATETIME DEFAULT NULL,
+                    owner VARCHAR(100) DEFAULT NULL,
+                    leaseUntil DATETIME DEFAULT NULL,
+                    INDEX idx_finished (finishedAt)
+                );
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS menu_batch_items (
+                    job_id INT NOT NULL,
+                    user_id INT NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                    attempts INT NOT NULL DEFAULT 0,
+                    last_error TEXT DEFAULT NULL,
+                    startedAt DATETIME DEFAULT NULL,
+                    finishedAt DATETIME DEFAULT NULL,
+                    durationMs INT DEFAULT NULL,
+                    owner VARCHAR(100) DEFAULT NULL,
+                    leaseUntil DATETIME DEFAULT NULL,
+                    PRIMARY KEY (job_id, user_id),
+                    FOREIGN KEY (job_id) REFERENCES menu_batch_jobs(job_id)
+                        ON DELETE CASCADE,
+                    INDEX idx_job_status (job_id, status)
+                );
+            """)
+            # Tables created before the leases
+            for table in ("menu_batch_jobs", "menu_batch_items"):
+                cursor.execute(f"SHOW COLUMNS FROM {table} LIKE 'owner'")
+                if not cursor.fetchall():
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN owner VARCHAR(100) DEFAULT NULL, ADD COLUMN leaseUntil DATETIME DEFAULT NULL")
+        self.tablesCreated = True
+
+    def getLeaseUntil(self) -> datetime:
+        return datetime.now() + timedelta(seconds=self.leaseSeconds)
+
+    def claimJob(self, jobId: int) -> bool:
+        """
+        Take the lease of an unfinished job, unless another live worker holds it.
+
+        Returns:
+        True if this worker now runs the job.
+        """
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("""
+                UPDATE menu_batch_jobs SET owner = %s, leaseUntil = %s, startedAt = COALESCE(startedAt, %s)
+                WHERE job_id = %s AND finishedAt IS NULL AND (owner IS NULL OR owner = %s OR leaseUntil IS NULL OR leaseUntil < %s)
+            """, (self.owner, self.getLeaseUntil(), datetime.now(), jobId, self.owner, datetime.now()))
+            return cursor.rowcount == 1
+
+    def renewLeases(self, jobId: int, stopped: threading.Event) -> None:
+        """
+        Heartbeat of a running job: renew the lease of the job and of the items this worker is generating.
+        """
+        while not stopped.wait(self.leaseSeconds / 3):
+            try:
+                with dbPool.transaction() as (mydb, cursor):
+                    leaseUntil = self.getLeaseUntil()
+                    cursor.execute("UPDATE menu_batch_jobs SET leaseUntil = %s WHERE job_id = %s AND owner = %s", (leaseUntil, jobId, self.owner))
+                    cursor.execute("UPDATE menu_batch_items SET leaseUntil = %s WHERE job_id = %s AND owner = %s AND status = 'running'",
+                                   (leaseUntil, jobId, self.owner))
+            except Exception as e:
+                logger.error(f"Error renewing the leases of menu batch job {jobId}: {e}")
+
+    def createJob(self, userIds: list = None) -> int:
+        """
+        Create a job.
+
+        Arguments:
+        userIds: users whose menus are generated. By default, every user that completed the nutritional assessment.
+
+        Returns:
+        The job ID.
+        """
+        self.createTables()
+        with dbPool.transaction() as (mydb, cursor):
+            if userIds is None:
+                cursor.execute("SELECT id FROM users WHERE recommended_daily_calories IS NOT NULL")
+                userIds = [row[0] for row in cursor.fetchall()]
+            cursor.execute("INSERT INTO menu_batch_jobs (creationDate) VALUES (%s)", (datetime.now(),))
+            jobId = cursor.lastrowid
+            if userIds:
+                cursor.executemany("INSERT IGNORE INTO menu_batch_items (job_id, user_id) VALUES (%s, %s)",
+                                   [(jobId, int(userId)) for userId in userIds])
+        logger.info(f"Created menu batch job {jobId} with {len(userIds)} users")
+        return jobId
+
+    def start(self, jobId: int, useProviderBatch: bool = False) -> None:
+        """
+        Run a job in a background thread.
+        """
+        threading.Thread(target=self.run, args=(jobId, useProviderBatch), name=f"menu-batch-job-{jobId}", daemon=True).start()
+
+    def run(self, jobId: int, useProviderBatch: bool = False) -> dict:
+        """
+        Run a job until every user is done or failed. Safe to call again on an interrupted job.
+
+        Arguments:
+        jobId: The job to run.
+        useProviderBatch: whether to send the pending users to the OpenAI Batch API first.
+
+        Returns:
+        The report of the job, see getReport.
+        """
+        with self.lock:
+            if jobId in self.runningJobs:
+                logger.warning(f"Menu batch job {jobId} is already running")
+                return self.getReport(jobId)
+            self.runningJobs.add(jobId)
+        stopped = threading.Event()
+        try:
+            self.createTables()
+            if not self.claimJob(jobId):
+                logger.info(f"Menu batch job {jobId} is finished or run by another worker")
+                return self.getReport(jobId)
+            threading.Thread(target=self.renewLeases, args=(jobId, stopped), name=f"menu-batch-lease-{jobId}", daemon=True).start()
+
+            self.recoverInterruptedItems(jobId)
+            if useProviderBatch or self.countItems(jobId, "batched"):
+                try:
+                    self.runProviderBatch(jobId)
+                except Exception as e:
+                    logger.error(f"OpenAI batch of job {jobId} failed, generating its users one by one: {e}")
+                    self.setItemsStatus(jobId, "batched", "pending")
+
+            while True:
+                pendingUsers = self.getUsersByStatus(jobId, "pending")
+                if not pendingUsers:
+                    break
+                # Retried users are picked up again by the next pass
+                list(self.executor.map(lambda userId: self.processItem(jobId, userId), pendingUsers))
+
+            # Items still running elsewhere (a lease taken over from this worker) keep the job open
+            if not self.countItems(jobId, "running"):
+                with dbPool.transaction() as (mydb, cursor):
+                    cursor.execute("UPDATE menu_batch_jobs SET finishedAt = %s, owner = NULL, leaseUntil = NULL WHERE job_id = %s AND owner = %s",
+                                   (datetime.now(), jobId, self.owner))
+            report = self.getReport(jobId)
+            logger.info(f"Menu batch job {jobId} finished", extra={"fields": report})
+            return report
+        finally:
+            stopped.set()
+            with self.lock:
+                self.runningJobs.discard(jobId)
+
+    def resumeUnfinished(self) -> list:
+        """
+        Run every job that was interrupted before finishing, one after the other. Jobs whose lease is held
+        by another live worker are skipped (see claimJob), so every worker can call this at startup.
+
+        Returns:
+        The IDs of the resumed jobs.
+        """
+        self.createTables()
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("SELECT job_id FROM menu_batch_jobs WHERE finishedAt IS NULL AND startedAt IS NOT NULL ORDER BY job_id")
+            jobIds = [row[0] for row in cursor.fetchall()]
+        for jobId in jobIds:
+            logger.info(f"Resuming menu batch job {jobId}")
+            self.run(jobId)
+        return jobIds
+
+    def recoverInterruptedItems(self, jobId: int) -> None:
+        """
+        Items left running by a worker whose lease expired are done if their menu was saved after they started,
+        otherwise they are generated again. Items of live workers are left alone.
+        """
+        now = datetime.now()
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("""
+                UPDATE menu_batch_items i SET i.status = 'done', i.finishedAt = %s, i.owner = NULL, i.leaseUntil = NULL
+                WHERE i.job_id = %s AND i.status = 'running' AND (i.leaseUntil IS NULL OR i.leaseUntil < %s) AND EXISTS (
+                    SELECT 1 FROM menu_versions v WHERE v.user_id = i.user_id AND v.creationDate >= i.startedAt
+                )
+            """, (now, jobId, now))
+            cursor.execute("""
+                UPDATE menu_batch_items SET status = 'pending', owner = NULL, leaseUntil = NULL
+                WHERE job_id = %s AND status = 'running' AND (leaseUntil IS NULL OR leaseUntil < %s)
+            """, (jobId, now))
+
+    def processItem(self, jobId: int, userId: int) -> None:
+        """
+        Generate and save the menu of one user, checkpointing the result. The item is claimed first:
+        if another worker took it since it was listed as pending, nothing is done.
+        """
+        startedAt = datetime.now()
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("""
+                UPDATE menu_batch_items SET status = 'running', owner = %s, leaseUntil = %s, attempts = attempts + 1, startedAt = %s
+                WHERE job_id = %s AND user_id = %s AND status = 'pending'
+            """, (self.owner, self.getLeaseUntil(), startedAt, jobId, userId))
+            claimed = cursor.rowcount == 1
+        if not claimed:
+            logger.debug(f"Menu batch job {jobId}: user {userId} was claimed by another worker")
+            return
+
+        start = time.perf_counter()
+        error = None
+        # Users without a nutritional assessment will not succeed by retrying
+        permanent = False
+        try:
+            # getWeeklyMenus saves the menu itself, and returns MENU_SAVE_ERROR when the save failed:
+            # the item then goes back to pending, like any other retryable error
+            response = getWeeklyMenus(userId)
+            if response is None:
+                error = "No menu was generated"
+            elif response.get("status") == "error":
+                error = str(response.get("message"))
+            elif not all(f"day{day}" in response for day in range(1, 8)):
+                error = str(response.get("message") or response.get("error") or "Incomplete menu")
+                permanent = "missing_fields" in response
+        except Exception as e:
+            error = str(e)
+        durationMs = int((time.perf_counter() - start) * 1000)
+
+        with dbPool.transaction() as (mydb, cursor):
+            if error is None:
+                cursor.execute("""
+                    UPDATE menu_batch_items SET status = 'done', last_error = NULL, finishedAt = %s, durationMs = %s, owner = NULL, leaseUntil = NULL
+                    WHERE job_id = %s AND user_id = %s AND owner = %s
+                """, (datetime.now(), durationMs, jobId, userId, self.owner))
+            else:
+                cursor.execute("""
+                    UPDATE menu_batch_items SET status = IF(attempts >= %s OR %s, 'failed', 'pending'),
+                    last_error = %s, finishedAt = %s, durationMs = %s, owner = NULL, leaseUntil = NULL
+                    WHERE job_id = %s AND user_id = %s AND owner = %s
+                """, (self.maxAttempts, permanent, error, datetime.now(), durationMs, jobId, userId, self.owner))
+                logger.error(f"Menu batch job {jobId}: user {userId} failed: {error}")
+
+    def runProviderBatch(self, jobId: int) -> None:
+        """
+        Send the pending users to the OpenAI Batch API, wait for the results and save them.
+        Users without a valid result go back to pending. The batch ID is checkpointed, so a resumed
+        job keeps waiting for the same batch instead of submitting it again.
+        """
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("SELECT provider_batch_id FROM menu_batch_jobs WHERE job_id = %s", (jobId,))
+            batchID = cursor.fetchone()[0]
+
+        if batchID is None or not self.countItems(jobId, "batched"):
+            prompts = {}
+            for userId in self.getUsersByStatus(jobId, "pending"):
+                prompt, errorResponse = buildWeeklyMenusPrompt(userId)
+                if prompt is None:
+                    self.setItemStatus(jobId, userId, "failed", (errorResponse or {}).get("message", f"No user found with ID {userId}"))
+                else:
+                    prompts[userId] = prompt
+            if not prompts:
+                return
+            batchID = AIAgent.submitOpenAIBatch(prompts)
+            with dbPool.transaction() as (mydb, cursor):
+                cursor.execute("UPDATE menu_batch_jobs SET provider_batch_id = %s WHERE job_id = %s", (batchID, jobId))
+                cursor.executemany("UPDATE menu_batch_items SET status = 'batched', startedAt = %s WHERE job_id = %s AND user_id = %s",
+                                   [(datetime.now(), jobId, userId) for userId in prompts])
+
+        status, results = AIAgent.getOpenAIBatchResults(batchID)
+        while results is None:
+            time.sleep(self.pollInterval)
+            status, results = AIAgent.getOpenAIBatchResults(batchID)
+        logger.info(f"OpenAI batch {batchID} of job {jobId} ended with status {status} and {len(results)} results")
+
+        for userId in self.getUsersByStatus(jobId, "batched"):
+            menu, nutritionReport = checkMenuNutrition(userId, results.get(str(userId)))
+            if menu and all(f"day{day}" in menu for day in range(1, 8)) and saveWeeklyMenus(menu, userId)["status"] == "success":
+                self.setItemStatus(jobId, userId, "done")
+            else:
+                self.setItemStatus(jobId, userId, "pending", "No valid result in the OpenAI batch")
+
+    def countItems(self, jobId: int, status: str) -> int:
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("SELECT COUNT(*) FROM menu_batch_items WHERE job_id = %s AND status = %s", (jobId, status))
+            return cursor.fetchone()[0]
+
+    def getUsersByStatus(self, jobId: int, status: str) -> list:
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("SELECT user_id FROM menu_batch_items WHERE job_id = %s AND status = %s ORDER BY user_id", (jobId, status))
+            return [row[0] for row in cursor.fetchall()]
+
+    def setItemStatus(self, jobId: int, userId: int, status: str, error: str = None) -> None:
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("UPDATE menu_batch_items SET status = %s, last_error = %s, finishedAt = %s WHERE job_id = %s AND user_id = %s",
+                           (status, error, datetime.now(), jobId, userId))
+
+    def setItemsStatus(self, jobId: int, fromStatus: str, toStatus: str) -> None:
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("UPDATE menu_batch_items SET status = %s WHERE job_id = %s AND status = %s", (toStatus, jobId, fromStatus))
+
+    def getReport(self, jobId: int) -> dict:
+        """
+        Progress and throughput of a job.
+
+        Returns:
+        Dictionary with the number of users in each status, elapsed seconds, users done per minute,
+        average and p95 generation time, estimated seconds left and the rate limiter counters of the providers.
+        None if the job does not exist.
+        """
+        self.createTables()
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            cursor.execute("SELECT job_id, provider_batch_id, creationDate, startedAt, finishedAt FROM menu_batch_jobs WHERE job_id = %s", (jobId,))
+            job = cursor.fetchone()
+            if job is None:
+                return None
+            cursor.execute("SELECT status, COUNT(*) AS users FROM menu_batch_items WHERE job_id = %s GROUP BY status", (jobId,))
+            counts = {status: 0 for status in ITEM_STATUSES}
+            counts.update({row["status"]: row["users"] for row in cursor.fetchall()})
+            cursor.execute("SELECT durationMs FROM menu_batch_items WHERE job_id = %s AND status = 'done' AND durationMs IS NOT NULL ORDER BY durationMs", (jobId,))
+            durations = [row["durationMs"] for row in cursor.fetchall()]
+
+        elapsed = ((job["finishedAt"] or datetime.now()) - job["startedAt"]).total_seconds() if job["startedAt"] else 0
+        usersPerMinute = counts["done"] / elapsed * 60 if elapsed else 0.0
+        remaining = counts["pending"] + counts["batched"] + counts["running"]
+        return {
+            "jobId": job["job_id"],
+            "providerBatchId": job["provider_batch_id"],
+            "finished": job["finishedAt"] is not None,
+            "users": sum(counts.values()),
+            **counts,
+            "elapsedSeconds": round(elapsed, 1),
+            "usersPerMinute": round(usersPerMinute, 2),
+            "averageMs": int(sum(durations) / len(durations)) if durations else None,
+            "p95Ms": durations[int(len(durations) * 0.95) - 1] if len(durations) >= 20 else None,
+            "etaSeconds": round(remaining / usersPerMinute * 60) if usersPerMinute and remaining else None,
+            "rateLimits": {name: limiter.getStats() for name, limiter in AIAgent.rateLimiters.items()},
+        }
+
+
+menuBatchRunner = WeeklyMenuBatchRunner()
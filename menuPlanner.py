@@ -0,0 +1,457 @@
+import os
+import random
+import numpy as np
+from dotenv import load_dotenv
+from nutritionEngine import nutritionEngine, MACROS, MACRO_TOLERANCES, findAllergens
+from structuredLogging import getLogger
+
+"""
+Weekly menu planner that does not call the LLM.
+
+Meals are picked from a local meal library with a greedy search and repaired with the nutrition engine:
+1. Every day, each slot (lunch, dinner, breakfast, snack) takes the meal whose macro profile, scaled to
+   the share of the day of that slot, is closest to the targets, among the meals allowed by the variety rules.
+2. The portions of the day are rescaled to fit the macro bands (see nutritionEngine.py). If the day still
+   does not fit, the meals are swapped one at a time for the next best candidates of their slot.
+
+The variety rules are those of the getWeeklyMenus prompt: a main protein at most MAX_PROTEIN_USES times a week,
+never on consecutive days nor twice the same day, and at most twice in the same slot; rice, pasta, bread and
+potatoes at most MAX_STARCH_USES times a week and never on consecutive days; no meal on consecutive days.
+When no meal of a slot satisfies every rule, the rules are relaxed one level at a time, allergies never.
+
+The output has the "dayN" schema of the LLM menus, so saveWeeklyMenus and the frontend use it unchanged.
+"""
+
+logger = getLogger(__name__)
+
+# Slots of a day in the order they are filled (largest first), with their share of the daily targets.
+# Above HIGH_CALORIE_TARGET calories a second snack is added, so portions do not have to grow too much
+DAY_SLOTS = [("lunch", 0.35), ("dinner", 0.30), ("breakfast", 0.25), ("snack", 0.10)]
+HIGH_CALORIE_DAY_SLOTS = [("lunch", 0.32), ("dinner", 0.28), ("breakfast", 0.22), ("snack", 0.09), ("snack", 0.09)]
+HIGH_CALORIE_TARGET = 2600
+SLOT_ORDER = ["breakfast", "lunch", "snack", "dinner"]
+SLOT_HOURS = {
+    "breakfast": ["07:30", "08:00", "07:00", "08:30", "07:45", "09:00", "08:15"],
+    "lunch": ["13:00", "13:30", "12:30", "14:00", "13:15", "13:45", "12:45"],
+    "snack": ["17:00", "16:30", "17:30", "16:00", "17:15", "16:45", "18:00"],
+    "dinner": ["20:00", "20:30", "19:30", "21:00", "19:45", "20:15", "19:00"],
+}
+# Starches limited by the variety rules, the other carbohydrate sources are free
+LIMITED_STARCHES = {"rice", "pasta", "bread", "potato"}
+
+# (type, name, main protein, starch, ingredients, instructions)
+MEAL_LIBRARY = [
+    ("breakfast", "Oatmeal with banana and almonds", "dairy", None,
+     ["70g rolled oats", "250 ml milk", "1 banana", "15g almonds", "1 tsp cinnamon"],
+     ["Bring the milk to a simmer in a small pot.", "Add the oats and cook for 5 minutes, stirring often, until creamy.",
+      "Slice the banana and chop the almonds.", "Serve the oatmeal topped with the banana, the almonds and the cinnamon."]),
+    ("breakfast", "Scrambled eggs on whole wheat toast", "eggs", "bread",
+     ["3 eggs", "2 slices whole wheat bread", "5g butter", "50g spinach", "Salt and pepper"],
+     ["Toast the bread.", "Melt the butter in a non-stick pan over medium heat and wilt the spinach for 1 minute.",
+      "Beat the eggs with salt and pepper, pour them into the pan and stir gently until just set.", "Serve the eggs on the toast."]),
+    ("breakfast", "Greek yogurt parfait with granola and blueberries", "dairy", None,
+     ["200g greek yogurt", "40g granola", "100g blueberries", "1 tsp honey"],
+     ["Spoon half of the yogurt into a glass or bowl.", "Add half of the blueberries and half of the granola.",
+      "Repeat the layers and drizzle the honey on top."]),
+    ("breakfast", "Avocado and turkey toast", "turkey", "bread",
+     ["2 slices whole wheat bread", "1/2 avocado", "60g turkey breast", "1 tomato", "Salt and pepper"],
+     ["Toast the bread.", "Mash the avocado with a fork and season it with salt and pepper.",
+      "Spread the avocado on the toast, top with the turkey and the sliced tomato."]),
+    ("breakfast", "Spinach and feta omelette with an orange", "eggs", None,
+     ["3 eggs", "50g spinach", "30g feta", "1 tsp olive oil", "1 orange"],
+     ["Beat the eggs in a bowl.", "Heat the oil in a non-stick pan and wilt the spinach for 1 minute.",
+      "Pour in the eggs, crumble the feta on top and cook over low heat until set, then fold the omelette.",
+      "Serve with the orange, peeled and cut into segments."]),
+    ("breakfast", "Cottage cheese bowl with pineapple, oats and chia", "dairy", None,
+     ["200g cottage cheese", "150g pineapple", "30g rolled oats", "10g chia seeds"],
+     ["Cut the pineapple into small cubes.", "Put the cottage cheese in a bowl.", "Top with the pineapple, the oats and the chia seeds."]),
+    ("breakfast", "Banana protein pancakes", "whey", None,
+     ["40g rolled oats", "1 egg", "30g whey protein", "1 banana", "100 ml milk"],
+     ["Blend the oats, the egg, the protein, half of the banana and the milk until smooth.",
+      "Cook small pancakes in a non-stick pan over medium heat, about 2 minutes per side.",
+      "Serve with the rest of the banana, sliced."]),
+    ("breakfast", "Tofu scramble with corn tortillas", "tofu", None,
+     ["150g tofu", "1/2 bell pepper", "1/2 onion", "2 corn tortillas", "1 tsp olive oil", "1/2 tsp paprika"],
+     ["Dice the pepper and the onion and cook them in the oil for 5 minutes.",
+      "Crumble the tofu into the pan, add the paprika and cook for 5 more minutes, stirring.",
+      "Warm the tortillas in a dry pan and fill them with the scramble."]),
+    ("breakfast", "Smoked salmon and cream cheese toast", "salmon", "bread",
+     ["2 slices whole grain bread", "30g cream cheese", "70g salmon", "1/2 cucumber", "1 tsp lemon juice"],
+     ["Toast the bread.", "Spread the cream cheese on the toast.",
+      "Top with the salmon and thin slices of cucumber, and season with a few drops of lemon."]),
+    ("breakfast", "Arepa with egg, cheese and avocado", "eggs", None,
+     ["1 arepa", "1 egg", "30g fresh cheese", "1/2 avocado"],
+     ["Warm the arepa in a pan for 3 minutes per side.", "Fry the egg in a non-stick pan.",
+      "Open the arepa and fill it with the egg, the crumbled cheese and slices of avocado."]),
+    ("breakfast", "Chia pudding with mango and yogurt", "dairy", None,
+     ["25g chia seeds", "200 ml almond milk", "150g greek yogurt", "150g mango"],
+     ["Mix the chia seeds with the almond milk and leave them in the fridge overnight.",
+      "Stir in the yogurt.", "Serve topped with the mango, cut into cubes."]),
+    ("breakfast", "Peanut butter and banana toast with milk", "dairy", "bread",
+     ["2 slices whole wheat bread", "20g peanut butter", "1 banana", "250 ml skim milk"],
+     ["Toast the bread.", "Spread the peanut butter and top with slices of banana.", "Serve with the glass of milk."]),
+    ("breakfast", "Overnight oats with skim milk and berries", "dairy", None,
+     ["70g rolled oats", "250 ml skim milk", "120g strawberries", "1 tsp honey"],
+     ["Mix the oats with the milk in a jar and leave them in the fridge overnight.",
+      "In the morning, stir and top with the sliced strawberries and the honey."]),
+    ("breakfast", "Honey and banana toast with a fruit salad", None, "bread",
+     ["2 slices whole wheat bread", "1 tsp honey", "1 banana", "100g mango", "100g pineapple"],
+     ["Toast the bread and spread the honey on it.", "Top with half of the banana, sliced.",
+      "Cut the rest of the banana, the mango and the pineapple into cubes and serve them as a salad."]),
+
+    ("lunch", "Grilled chicken with rice and broccoli", "chicken", "rice",
+     ["150g chicken breast", "180g rice", "150g broccoli", "1 tbsp olive oil", "1 garlic clove", "Salt and pepper"],
+     ["Season the chicken with salt, pepper and the minced garlic.", "Grill it for 6 to 7 minutes per side until cooked through.",
+      "Steam the broccoli for 5 minutes.", "Serve the chicken with the rice and the broccoli, drizzled with the oil."]),
+    ("lunch", "Beef and vegetable quinoa stir-fry", "beef", None,
+     ["140g beef", "180g quinoa", "1 bell pepper", "100g green beans", "1 tbsp olive oil", "1 garlic clove"],
+     ["Cut the beef into thin strips and the pepper into slices.", "Stir-fry the beef in the hot oil for 3 minutes and set it aside.",
+      "Stir-fry the vegetables and the garlic for 5 minutes.", "Return the beef, add the quinoa and cook for 2 more minutes."]),
+    ("lunch", "Baked salmon with sweet potato and spinach", "salmon", None,
+     ["140g salmon", "250g sweet potato", "80g spinach", "1 tsp olive oil", "1 lemon"],
+     ["Cut the sweet potato into wedges and roast it at 200°C for 25 minutes.",
+      "Add the salmon to the tray, season it with lemon and bake for 12 more minutes.",
+      "Saute the spinach in the oil for 2 minutes and serve everything together."]),
+    ("lunch", "Lentil and vegetable stew with bread", "legumes", "bread",
+     ["250g lentils", "1 carrot", "1/2 onion", "1 tomato", "1 tbsp olive oil", "1 slice whole wheat bread", "1 tsp cumin"],
+     ["Dice the carrot, the onion and the tomato.", "Cook them in the oil for 5 minutes with the cumin.",
+      "Add the lentils and a glass of water and simmer for 15 minutes.", "Serve with the bread."]),
+    ("lunch", "Turkey and avocado wrap", "turkey", None,
+     ["1 tortilla", "120g turkey breast", "1/2 avocado", "30g lettuce", "1 tomato", "50g greek yogurt"],
+     ["Warm the tortilla in a dry pan.", "Spread the yogurt on it and add the lettuce, the sliced tomato and the avocado.",
+      "Add the turkey, roll the wrap tightly and cut it in half."]),
+    ("lunch", "Tuna pasta salad", "tuna", "pasta",
+     ["1 can tuna", "200g pasta", "1 tomato", "1/2 cucumber", "1 tbsp olive oil", "1 tsp lemon juice"],
+     ["Cook the pasta, drain it and let it cool.", "Dice the tomato and the cucumber.",
+      "Mix the pasta with the tuna, the vegetables, the oil and the lemon juice."]),
+    ("lunch", "Chickpea and quinoa bowl", "legumes", None,
+     ["200g chickpeas", "150g quinoa", "1/2 cucumber", "1 tomato", "30g feta", "1 tbsp olive oil", "1 tsp lemon juice"],
+     ["Rinse and drain the chickpeas.", "Dice the cucumber and the tomato.",
+      "Combine the quinoa, the chickpeas and the vegetables, crumble the feta on top and dress with the oil and the lemon."]),
+    ("lunch", "Pork loin with potatoes and green beans", "pork", "potato",
+     ["150g pork loin", "250g potato", "150g green beans", "1 tbsp olive oil", "1 tsp oregano"],
+     ["Cut the potatoes into cubes and roast them with half of the oil at 200°C for 30 minutes.",
+      "Season the pork with the oregano and sear it in the rest of the oil, 5 minutes per side.",
+      "Boil the green beans for 6 minutes and serve everything together."]),
+    ("lunch", "Garlic shrimp with rice and peas", "shrimp", "rice",
+     ["180g shrimp", "180g rice", "80g peas", "1 tbsp olive oil", "2 garlic cloves"],
+     ["Saute the sliced garlic in the oil for 1 minute.", "Add the shrimp and cook for 3 minutes until pink.",
+      "Add the peas and the rice and cook for 2 more minutes, stirring."]),
+    ("lunch", "Chicken, black bean and corn bowl", "chicken", None,
+     ["150g chicken breast", "150g black beans", "100g corn", "1/2 avocado", "1 tomato", "1 lime"],
+     ["Grill the chicken for 6 to 7 minutes per side and slice it.", "Warm the beans and the corn in a pan.",
+      "Serve in a bowl with the diced tomato and avocado and a squeeze of lime."]),
+    ("lunch", "Beef bolognese pasta", "beef", "pasta",
+     ["120g lean ground beef", "180g pasta", "150g tomato", "1/2 onion", "1 carrot", "10g parmesan"],
+     ["Dice the onion and the carrot and cook them for 5 minutes in a pan.", "Add the beef and brown it for 5 minutes.",
+      "Add the crushed tomato and simmer for 15 minutes.", "Serve over the pasta with the parmesan."]),
+    ("lunch", "White fish tacos", "white fish", None,
+     ["180g white fish", "3 corn tortillas", "50g lettuce", "1/2 avocado", "50g greek yogurt", "1 lime"],
+     ["Season the fish with lime and bake it at 200°C for 12 minutes, then flake it.", "Warm the tortillas in a dry pan.",
+      "Fill them with the fish, the shredded lettuce and the avocado, and top with the yogurt."]),
+    ("lunch", "Tofu and vegetable stir-fry with brown rice", "tofu", "rice",
+     ["180g tofu", "180g brown rice", "1 bell pepper", "100g broccoli", "1 tbsp olive oil", "1 garlic clove"],
+     ["Cut the tofu into cubes and brown it in the oil for 6 minutes.", "Add the garlic and the vegetables and stir-fry for 5 minutes.",
+      "Serve over the brown rice."]),
+    ("lunch", "Spanish potato omelette with salad", "eggs", "potato",
+     ["3 eggs", "250g potato", "1/2 onion", "1 tbsp olive oil", "50g lettuce", "1 tomato"],
+     ["Slice the potatoes and the onion thinly and cook them in the oil over low heat for 20 minutes.",
+      "Beat the eggs, mix them with the potatoes and cook the omelette for 4 minutes per side.", "Serve with the lettuce and tomato salad."]),
+    ("lunch", "Chicken rice bowl with beans and corn", "chicken", "rice",
+     ["120g chicken breast", "220g rice", "100g black beans", "80g corn", "1 tomato", "1 lime"],
+     ["Grill the chicken for 6 to 7 minutes per side and cut it into cubes.", "Warm the beans and the corn in a pan.",
+      "Serve everything over the rice with the diced tomato and a squeeze of lime."]),
+    ("lunch", "Pasta with tomato sauce and tuna", "tuna", "pasta",
+     ["250g pasta", "1 can tuna", "200g tomato", "1/2 onion", "1 tsp olive oil", "1 tsp oregano"],
+     ["Cook the chopped onion in the oil for 4 minutes.", "Add the crushed tomato and the oregano and simmer for 10 minutes.",
+      "Stir in the tuna and serve over the pasta."]),
+
+    ("dinner", "Baked white fish with quinoa and zucchini", "white fish", None,
+     ["180g white fish", "150g quinoa", "200g zucchini", "1 tbsp olive oil", "1 lemon"],
+     ["Slice the zucchini and roast it with half of the oil at 200°C for 15 minutes.",
+      "Season the fish with lemon and the rest of the oil and bake it for 12 minutes.", "Serve with the quinoa."]),
+    ("dinner", "Roasted chicken thighs with potatoes and carrots", "chicken", "potato",
+     ["150g chicken thigh", "200g potato", "2 carrots", "1 tsp olive oil", "1 tsp paprika"],
+     ["Cut the potatoes and the carrots into chunks.", "Season everything with the oil and the paprika.",
+      "Roast at 200°C for 35 minutes, turning once."]),
+    ("dinner", "Turkey meatballs in tomato sauce with pasta", "turkey", "pasta",
+     ["150g turkey breast", "150g pasta", "200g tomato", "1/2 onion", "1 garlic clove", "10g parmesan"],
+     ["Mince the turkey, shape it into small balls and brown them in a non-stick pan.",
+      "Add the chopped onion, the garlic and the crushed tomato and simmer for 15 minutes.", "Serve over the pasta with the parmesan."]),
+    ("dinner", "Salmon with brown rice and broccoli", "salmon", "rice",
+     ["130g salmon", "150g brown rice", "150g broccoli", "1 tsp lemon juice"],
+     ["Bake the salmon at 200°C for 12 minutes.", "Steam the broccoli for 5 minutes.",
+      "Serve the salmon with the rice and the broccoli and a few drops of lemon."]),
+    ("dinner", "Beef stuffed peppers with rice", "beef", "rice",
+     ["120g lean ground beef", "120g rice", "2 bell peppers", "100g tomato", "20g mozzarella"],
+     ["Cut the tops off the peppers and remove the seeds.", "Brown the beef, then mix it with the rice and the tomato.",
+      "Fill the peppers, top with the mozzarella and bake at 190°C for 25 minutes."]),
+    ("dinner", "Shrimp and zucchini pasta", "shrimp", "pasta",
+     ["150g shrimp", "150g pasta", "150g zucchini", "1 tbsp olive oil", "1 garlic clove"],
+     ["Cook the pasta and drain it.", "Saute the garlic and the sliced zucchini in the oil for 4 minutes.",
+      "Add the shrimp and cook for 3 minutes, then toss with the pasta."]),
+    ("dinner", "Tofu and chickpea curry with rice", "tofu", "rice",
+     ["150g tofu", "100g chickpeas", "150g rice", "100 ml coconut milk", "1/2 onion", "1 tsp cumin"],
+     ["Cook the chopped onion with the cumin for 4 minutes.", "Add the tofu, cut into cubes, the chickpeas and the coconut milk.",
+      "Simmer for 10 minutes and serve with the rice."]),
+    ("dinner", "Pork tenderloin with sweet potato mash", "pork", None,
+     ["150g pork loin", "250g sweet potato", "100g green beans", "5g butter"],
+     ["Boil the sweet potato for 15 minutes and mash it with the butter.", "Sear the pork for 5 minutes per side and let it rest.",
+      "Boil the green beans for 6 minutes and serve everything together."]),
+    ("dinner", "Chickpea and spinach stew with bread", "legumes", "bread",
+     ["250g chickpeas", "100g spinach", "150g tomato", "1 tbsp olive oil", "1 slice whole wheat bread", "1 tsp paprika"],
+     ["Cook the crushed tomato with the oil and the paprika for 5 minutes.", "Add the chickpeas and simmer for 10 minutes.",
+      "Stir in the spinach until wilted and serve with the bread."]),
+    ("dinner", "Vegetable frittata with toast", "eggs", "bread",
+     ["3 eggs", "1/2 bell pepper", "80g mushrooms", "30g feta", "1 slice whole wheat bread", "1 tsp olive oil"],
+     ["Cook the sliced pepper and mushrooms in the oil for 5 minutes.", "Pour in the beaten eggs, crumble the feta on top.",
+      "Cook over low heat with a lid for 8 minutes and serve with the toast."]),
+    ("dinner", "Grilled chicken salad with avocado and quinoa", "chicken", None,
+     ["140g chicken breast", "120g quinoa", "1/2 avocado", "60g mixed greens", "1 tomato", "1 tsp olive oil"],
+     ["Grill the chicken for 6 to 7 minutes per side and slice it.", "Toss the greens, the tomato and the quinoa with the oil.",
+      "Top the salad with the chicken and the sliced avocado."]),
+    ("dinner", "Seared tuna with baby potatoes and salad", "tuna", "potato",
+     ["150g tuna", "200g potato", "60g lettuce", "1 tomato", "1 tbsp olive oil"],
+     ["Boil the potatoes for 15 minutes.", "Sear the tuna in a very hot pan for 2 minutes per side.",
+      "Serve with the potatoes and the salad dressed with the oil."]),
+    ("dinner", "Beef steak with sweet potato and salad", "beef", None,
+     ["150g beef", "200g sweet potato", "60g mixed greens", "1 tsp olive oil"],
+     ["Roast the sweet potato, cut into wedges, at 200°C for 25 minutes.", "Sear the steak for 3 to 4 minutes per side and let it rest.",
+      "Serve with the sweet potato and the greens dressed with the oil."]),
+    ("dinner", "Black bean and cheese quesadillas", "legumes", None,
+     ["2 tortillas", "150g black beans", "40g cheese", "1/2 bell pepper", "50g greek yogurt"],
+     ["Mash the beans lightly and dice the pepper.", "Spread the beans on a tortilla, add the pepper and the cheese and cover with the other one.",
+      "Cook in a dry pan for 3 minutes per side and serve with the yogurt."]),
+    ("dinner", "Potato and vegetable soup with bread and turkey", "turkey", "potato",
+     ["300g potato", "2 carrots", "1/2 onion", "100g green beans", "80g turkey breast", "1 slice whole wheat bread"],
+     ["Dice the potatoes, the carrots and the onion.", "Cover them with water, season and simmer for 25 minutes with the green beans.",
+      "Serve the soup with the turkey, cut into strips, and the bread."]),
+    ("dinner", "Sweet potato and black bean bowl", "legumes", None,
+     ["300g sweet potato", "150g black beans", "80g corn", "1 tomato", "50g greek yogurt", "1 tsp cumin"],
+     ["Cut the sweet potato into cubes and roast it with the cumin at 200°C for 25 minutes.", "Warm the beans and the corn.",
+      "Serve everything in a bowl with the diced tomato and the yogurt."]),
+    ("dinner", "Shrimp fried rice with vegetables", "shrimp", "rice",
+     ["120g shrimp", "220g rice", "80g peas", "1 carrot", "1 egg", "1 tsp olive oil"],
+     ["Stir-fry the diced carrot and the peas in the oil for 4 minutes.", "Add the shrimp and cook for 3 minutes.",
+      "Push everything aside, scramble the egg, then add the rice and stir-fry for 3 more minutes."]),
+
+    ("snack", "Apple with peanut butter", None, None,
+     ["1 apple", "20g peanut butter"],
+     ["Core the apple and cut it into slices.", "Serve with the peanut butter for dipping."]),
+    ("snack", "Greek yogurt with honey and walnuts", "dairy", None,
+     ["170g greek yogurt", "1 tsp honey", "15g walnuts"],
+     ["Put the yogurt in a bowl.", "Top with the chopped walnuts and drizzle the honey."]),
+    ("snack", "Hummus with carrot and cucumber sticks", None, None,
+     ["60g hummus", "1 carrot", "1/2 cucumber"],
+     ["Cut the carrot and the cucumber into sticks.", "Serve with the hummus."]),
+    ("snack", "Banana and almonds", None, None,
+     ["1 banana", "20g almonds"],
+     ["Peel the banana.", "Serve with the almonds."]),
+    ("snack", "Cottage cheese with strawberries", "dairy", None,
+     ["150g cottage cheese", "120g strawberries"],
+     ["Wash and slice the strawberries.", "Serve them over the cottage cheese."]),
+    ("snack", "Banana protein shake", "whey", None,
+     ["30g whey protein", "1 banana", "250 ml almond milk"],
+     ["Blend the protein, the banana and the almond milk until smooth.", "Serve cold."]),
+    ("snack", "Orange and walnuts", None, None,
+     ["1 orange", "15g walnuts"],
+     ["Peel the orange and separate it into segments.", "Serve with the walnuts."]),
+    ("snack", "Boiled eggs with cherry tomatoes", "eggs", None,
+     ["2 eggs", "150g tomato"],
+     ["Boil the eggs for 10 minutes, cool them in cold water and peel them.", "Serve with the tomatoes and a pinch of salt."]),
+    ("snack", "Mango with yogurt", "dairy", None,
+     ["150g mango", "125g yogurt"],
+     ["Cut the mango into cubes.", "Serve over the yogurt."]),
+    ("snack", "Dark chocolate and strawberries", None, None,
+     ["20g dark chocolate", "150g strawberries"],
+     ["Wash the strawberries.", "Serve with the chocolate."]),
+    ("snack", "Tropical fruit cup", None, None,
+     ["150g mango", "150g pineapple", "1 banana"],
+     ["Cut the fruit into cubes.", "Serve chilled."]),
+    ("snack", "Oat and banana milk smoothie", "dairy", None,
+     ["30g rolled oats", "1 banana", "250 ml skim milk", "1 tsp honey"],
+     ["Blend the oats, the banana, the milk and the honey until smooth.", "Serve cold."]),
+]
+
+
+class MenuPlanner:
+    def __init__(self, maxProteinUses: int = None, maxStarchUses: int = None, swapCandidates: int = None, repeatPenalty: float = None):
+        """
+        maxProteinUses: times a main protein may appear in a week (MENU_PLANNER_MAX_PROTEIN_USES, 4 by default).
+        maxStarchUses: times a limited starch may appear in a week (MENU_PLANNER_MAX_STARCH_USES, 4 by default).
+        swapCandidates: alternatives tried for each meal when a day does not fit the bands (MENU_PLANNER_SWAP_CANDIDATES, 5 by default).
+        repeatPenalty: score added to a meal for every time it was already planned this week, so repeats
+            come last (MENU_PLANNER_REPEAT_PENALTY, 2.0 by default).
+        """
+        load_dotenv()
+        self.maxProteinUses = maxProteinUses or int(os.environ.get("MENU_PLANNER_MAX_PROTEIN_USES", 4))
+        self.maxStarchUses = maxStarchUses or int(os.environ.get("MENU_PLANNER_MAX_STARCH_USES", 4))
+        self.swapCandidates = swapCandidates or int(os.environ.get("MENU_PLANNER_SWAP_CANDIDATES", 5))
+        self.repeatPenalty = repeatPenalty or float(os.environ.get("MENU_PLANNER_REPEAT_PENALTY", 2.0))
+        self.meals = [
+            {"type": mealType, "name": name, "protein": protein, "starch": starch, "ingredients": ingredients, "instructions": instructions}
+            for mealType, name, protein, starch, ingredients, instructions in MEAL_LIBRARY
+        ]
+        self.macros = self.computeMacros(self.meals)
+
+    @staticmethod
+    def computeMacros(meals: list) -> np.ndarray:
+        """
+        Macros of the base portion of every meal, computed from its ingredients in a single pass.
+        """
+        return nutritionEngine.analyzeDay(meals)["computed"] if meals else np.zeros((0, len(MACROS)))
+
+    def getCandidates(self, extraMeals: list = None):
+        """
+        The meals the planner can choose from: the built-in library, plus the given meals
+        (e.g. from the recipe library) with the same keys.
+
+        Returns:
+        (meals, macros) with the macros of the base portion of every meal.
+        """
+        if not extraMeals:
+            return self.meals, self.macros
+        return self.meals + extraMeals, np.vstack([self.macros, self.computeMacros(extraMeals)])
+
+    def isAllowed(self, meal: dict, mealIndex: int, slot: str, day: int, state: dict, dayMeals: list, relaxation: int) -> bool:
+        """
+        Whether a meal respects the variety rules, given the meals already planned.
+        relaxation 0 applies every rule, 1 drops the per-slot and meal repetition limits,
+        2 also allows consecutive days and 3 only keeps the weekly limits of each meal.
+        """
+        if state["mealUses"].get(mealIndex, 0) >= 2 or mealIndex in (chosen[0] for chosen in dayMeals):
+            return False
+        if relaxation >= 3:
+            return True
+        protein, starch = meal.get("protein"), meal.get("starch")
+        previousDay = state["days"].get(day - 1, {"meals": set(), "proteins": set(), "starches": set()})
+        if protein:
+            if state["proteinUses"].get(protein, 0) >= self.maxProteinUses or protein in (chosen[1] for chosen in dayMeals):
+                return False
+            if relaxation < 1 and state["proteinSlotUses"].get((protein, slot), 0) >= 2:
+                return False
+            if relaxation < 2 and protein in previousDay["proteins"]:
+                return False
+        if starch in LIMITED_STARCHES:
+            if state["starchUses"].get(starch, 0) >= self.maxStarchUses:
+                return False
+            if relaxation < 2 and (starch in previousDay["starches"] or starch in (chosen[2] for chosen in dayMeals)):
+                return False
+        if relaxation < 1 and mealIndex in previousDay["meals"]:
+            return False
+        return True
+
+    def rankCandidates(self, macros: np.ndarray, candidates: list, slotTargets: np.ndarray, targets: np.ndarray, state: dict, rng) -> list:
+        """
+        Candidates of a slot, best first. A meal is scored by the distance of its macros to the slot targets,
+        in units of the tolerance of each macro, once its portion is scaled to the calories of the slot.
+        Meals already planned this week are penalized.
+        """
+        candidateMacros = macros[candidates]
+        scales = np.clip(slotTargets[0] / np.maximum(candidateMacros[:, 0], 1e-9), nutritionEngine.minScale, nutritionEngine.maxScale)
+        tolerances = np.array([MACRO_TOLERANCES[macro] for macro in MACROS]) * targets
+        errors = (((candidateMacros * scales[:, None] - slotTargets) / tolerances) ** 2).sum(axis=1)
+        errors = errors + self.repeatPenalty * np.array([state["mealUses"].get(index, 0) for index in candidates])
+        # A small random term varies the weeks of users with the same targets
+        errors = errors + rng.random(len(candidates)) * 0.5
+        return [candidates[index] for index in np.argsort(errors)]
+
+    def toMenuMeal(self, meal: dict, slot: str, day: int) -> dict:
+        return {
+            "type": slot,
+            "hour": SLOT_HOURS[slot][(day - 1) % len(SLOT_HOURS[slot])],
+            "ingredients": list(meal["ingredients"]),
+            "instructions": list(meal["instructions"]),
+        }
+
+    def planDay(self, day: int, meals: list, macros: np.ndarray, targets: dict, allowed: np.ndarray, state: dict, rng) -> tuple:
+        """
+        Choose and repair the meals of one day.
+
+        Returns:
+        (dayMeals, report, chosen): the meals in the menu schema, the nutrition report of the day and
+        the (mealIndex, protein, starch, slot) of every chosen meal.
+        """
+        targetValues = np.array([targets[macro] for macro in MACROS])
+        chosen, ranked = [], []
+        for slot, share in (HIGH_CALORIE_DAY_SLOTS if targets["calories"] > HIGH_CALORIE_TARGET else DAY_SLOTS):
+            slotMeals = [index for index in range(len(meals)) if allowed[index] and meals[index]["type"] == slot]
+            candidates = []
+            for relaxation in range(4):
+                candidates = [index for index in slotMeals if self.isAllowed(meals[index], index, slot, day, state, chosen, relaxation)]
+                if candidates:
+                    break
+            if not candidates:
+                continue
+            ranked.append(self.rankCandidates(macros, candidates, targetValues * share, targetValues, state, rng))
+            best = ranked[-1][0]
+            chosen.append((best, meals[best].get("protein"), meals[best].get("starch"), slot))
+
+        def evaluate(choice):
+            ordered = sorted(choice, key=lambda item: SLOT_ORDER.index(item[3]))
+            dayMeals = [self.toMenuMeal(meals[index], slot, day) for index, protein, starch, slot in ordered]
+            dayMeals, report = nutritionEngine.checkDay(dayMeals, targets)
+            return dayMeals, report, ordered
+
+        best = evaluate(chosen)
+        # Repair: swap one meal at a time for the next candidates of its slot until the day fits the bands
+        if not best[1]["withinBands"]:
+            bestDistance = self.bandDistance(best[1], targetValues)
+            for position, (index, protein, starch, slot) in enumerate(chosen):
+                for alternative in ranked[position][1:self.swapCandidates + 1]:
+                    others = chosen[:position] + chosen[position + 1:]
+                    if not self.isAllowed(meals[alternative], alternative, slot, day, state, others, 3):
+                        continue
+                    choice = others + [(alternative, meals[alternative].get("protein"), meals[alternative].get("starch"), slot)]
+                    candidate = evaluate(choice)
+                    distance = self.bandDistance(candidate[1], targetValues)
+                    if distance < bestDistance:
+                        best, bestDistance = candidate, distance
+                    if candidate[1]["withinBands"]:
+                        return candidate
+        return best
+
+    @staticmethod
+    def bandDistance(report: dict, targets: np.ndarray) -> float:
+        totals = np.array([report["totals"][macro] for macro in MACROS])
+        tolerances = np.array([MACRO_TOLERANCES[macro] for macro in MACROS]) * targets
+        return float(np.maximum(np.abs(totals - targets) - tolerances, 0).sum() / tolerances.sum())
+
+    def planWeek(self, targets: dict, allergies: list = None, extraMeals: list = None, seed=None, days: int = 7) -> tuple:
+        """
+        Plan a weekly menu.
+
+        Arguments:
+        targets: Daily target of each macro, {"calories": ..., "protein": ..., "fats": ..., "carbohydrates": ...}.
+        allergies: Allergen names to exclude (see nutritionEngine.parseAllergies).
+        extraMeals: Additional meals to choose from, with the keys of the library (type, name, protein, starch, ingredients, instructions).
+        seed: Seed of the tie-breaking between close candidates, e.g. the user ID and the week.
+        days: Number of days to plan.
+
+        Returns:
+        (menu, report): the menu with the "dayN" schema, and the nutrition report of every day.
+        """
+        meals, macros = self.getCandidates(extraMeals)
+        allowed = np.array([not findAllergens(meal["ingredients"], allergies) for meal in meals]) if allergies else np.ones(len(meals), dtype=bool)
+        allowed &= macros[:, 0] > 0
+        rng = np.random.default_rng(random.Random(str(seed)).getrandbits(32) if seed is not None else None)
+        state = {"mealUses": {}, "proteinUses": {}, "proteinSlotUses": {}, "starchUses": {}, "days": {}}
+        menu, report = {}, {}
+        for day in range(1, days + 1):
+            dayMeals, dayReport, chosen = self.planDay(day, meals, macros, targets, allowed, state, rng)
+            menu[f"day{day}"], report[f"day{day}"] = dayMeals, dayReport
+            state["days"][day] = {"meals": set(), "proteins": set(), "starches": set()}
+            for index, protein, starch, slot in chosen:
+                state["mealUses"][index] = state["mealUses"].get(index, 0) + 1
+                state["days"][day]["meals"].add(index)
+                if protein:
+                    state["proteinUses"][protein] = state["proteinUses"].get(protein, 0) + 1
+                    state["proteinSlotUses"][(protein, slot)] = state["proteinSlotUses"].get((protein, slot), 0) + 1
+                    state["days"][day]["proteins"].add(protein)
+                if starch in LIMITED_STARCHES:
+                    state["starchUses"][starch] = state["starchUses"].get(starch, 0) + 1
+                    state["days"][day]["starches"].add(starch)
+        return menu, report
+
+
+menuPlanner = MenuPlanner()
@@ -54,7 +54,7 @@ class User(BaseModel):
 
 class BasicInformationUser(BaseModel):
     name: str =Field(default="User", min_length=6, max_length=25)
-    password: str = Field(min_length=8, max_length=30)
+    password: str|None = Field(default=None, min_length=8, max_length=30)
     age: int = Field(ge=18, le=100)
     id:int|None = Field(default=None)
     sex: Sex
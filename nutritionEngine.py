@@ -0,0 +1,536 @@
+import os
+import re
+import copy
+import unicodedata
+from functools import lru_cache
+import numpy as np
+from dotenv import load_dotenv
+from structuredLogging import getLogger
+
+"""
+Local, deterministic nutrition engine used to check and repair the menus generated by the LLM.
+
+The macros the LLM reports for each meal are not trusted: every ingredient string ("200g chicken breast",
+"1 tbsp olive oil", "2 huevos") is parsed into grams of a food of the composition table below, and the
+macros of every meal of a day are recomputed at once with NumPy. Each day is then checked against the same
+tolerance bands as the prompts of getWeeklyMenus and modifyDailyMenu (calories ±5%, protein ±10%,
+fats ±15%, carbohydrates ±20%). A day outside the bands is repaired by rescaling the portions of its meals,
+without calling the LLM again.
+
+A meal whose ingredients are mostly unknown to the table keeps the macros reported by the LLM. Its
+portions can still be rescaled, and its macros are then scaled by the same factor.
+"""
+
+logger = getLogger(__name__)
+
+MACROS = ["calories", "protein", "fats", "carbohydrates"]
+
+# Relative tolerance of each daily target, as in the getWeeklyMenus and modifyDailyMenu prompts
+MACRO_TOLERANCES = {"calories": 0.05, "protein": 0.10, "fats": 0.15, "carbohydrates": 0.20}
+
+# Profile column holding the daily target of each macro
+MACRO_TARGET_COLUMNS = {
+    "calories": "recommended_daily_calories",
+    "protein": "recommended_protein_intake",
+    "fats": "recommended_fats_intake",
+    "carbohydrates": "recommended_carbohydrates_intake",
+}
+
+# Composition per 100 g: (aliases, kcal, protein g, fats g, carbohydrates g, grams of one piece/slice/scoop, density g/ml)
+# The first alias is the name of the food. Aliases include the Spanish and Portuguese names, since menus
+# are written in the language of the user's country.
+FOOD_TABLE = [
+    (["chicken breast", "chicken", "pechuga de pollo", "pollo", "peito de frango", "frango"], 120, 22.5, 2.6, 0, 170, 1.0),
+    (["chicken thigh", "muslo de pollo", "coxa de frango"], 177, 18.6, 10.9, 0, 120, 1.0),
+    (["turkey breast", "turkey", "pavo", "peru"], 135, 30, 1, 0, 150, 1.0),
+    (["lean ground beef", "ground beef", "carne molida", "carne picada", "carne moida"], 176, 20, 10, 0, 120, 1.0),
+    (["beef", "steak", "sirloin", "carne de res", "ternera", "bife", "carne bovina"], 158, 21, 8, 0, 200, 1.0),
+    (["pork loin", "pork", "lomo de cerdo", "cerdo", "porco", "lombo"], 143, 21, 6, 0, 150, 1.0),
+    (["ham", "jamon", "presunto"], 145, 21, 6, 1.5, 28, 1.0),
+    (["bacon", "tocino", "panceta"], 541, 37, 42, 1.4, 12, 1.0),
+    (["salmon", "salmao"], 208, 20, 13, 0, 150, 1.0),
+    (["tuna", "atun", "atum"], 116, 26, 1, 0, 120, 1.0),
+    (["white fish", "cod", "hake", "tilapia", "merluza", "bacalao", "bacalhau", "pescado blanco", "peixe branco"], 82, 18, 0.7, 0, 150, 1.0),
+    (["shrimp", "prawns", "prawn", "camarones", "gambas", "camarao"], 85, 20, 0.5, 0, 12, 1.0),
+    (["egg white", "clara de huevo", "clara de ovo"], 52, 11, 0.2, 0.7, 33, 1.03),
+    (["egg", "huevo", "ovo"], 143, 12.6, 9.5, 0.7, 50, 1.03),
+    (["tofu"], 144, 17, 9, 3, 120, 1.0),
+    (["lentils", "lentil", "lentejas", "lentilhas"], 116, 9, 0.4, 20, 200, 0.8),
+    (["chickpeas", "chickpea", "garbanzos", "grao de bico"], 164, 8.9, 2.6, 27.4, 160, 0.7),
+    (["black beans", "beans", "bean", "frijoles", "feijao", "alubias"], 132, 8.9, 0.5, 23.7, 170, 0.7),
+    (["brown rice", "arroz integral"], 123, 2.7, 1, 25.6, 190, 0.8),
+    (["dry rice", "uncooked rice", "raw rice", "arroz crudo"], 365, 7, 0.7, 80, 185, 0.85),
+    (["rice", "arroz"], 130, 2.7, 0.3, 28, 190, 0.8),
+    (["dry pasta", "uncooked pasta", "pasta seca"], 371, 13, 1.5, 75, 100, 0.45),
+    (["pasta", "spaghetti", "penne", "macarrones", "espaguetis", "macarrao"], 158, 5.8, 0.9, 31, 140, 0.6),
+    (["quinoa", "quinua"], 120, 4.4, 1.9, 21.3, 185, 0.8),
+    (["oats", "oat", "oatmeal", "rolled oats", "avena", "aveia"], 389, 16.9, 6.9, 66, 40, 0.34),
+    (["whole wheat bread", "whole grain bread", "pan integral", "pao integral"], 247, 13, 3.4, 41, 30, 0.3),
+    (["bread", "toast", "pan", "pao"], 265, 9, 3.2, 49, 28, 0.3),
+    (["corn tortilla", "tortilla de maiz"], 218, 5.7, 2.9, 44.6, 26, 1.0),
+    (["tortilla", "wrap", "tortilla de trigo"], 304, 8, 8, 50, 45, 1.0),
+    (["arepa"], 219, 4.5, 3.5, 43, 90, 1.0),
+    (["sweet potato", "batata", "camote", "boniato", "batata doce"], 86, 1.6, 0.1, 20, 130, 0.7),
+    (["potato", "papa", "patata"], 77, 2, 0.1, 17, 170, 0.7),
+    (["skim milk", "leche desnatada", "leche descremada", "leite desnatado"], 34, 3.4, 0.1, 5, 244, 1.03),
+    (["almond milk", "leche de almendras", "leite de amendoa"], 15, 0.6, 1.2, 0.6, 240, 1.0),
+    (["milk", "leche", "leite"], 50, 3.3, 2, 4.8, 244, 1.03),
+    (["greek yogurt", "yogur griego", "iogurte grego"], 59, 10, 0.4, 3.6, 170, 1.05),
+    (["yogurt", "yoghurt", "yogur", "iogurte"], 61, 3.5, 3.3, 4.7, 170, 1.05),
+    (["cottage cheese", "requeson", "queso cottage"], 98, 11, 4.3, 3.4, 110, 0.95),
+    (["cream cheese", "queso crema"], 342, 6, 34, 4, 15, 1.0),
+    (["mozzarella"], 280, 28, 17, 3, 28, 0.45),
+    (["feta"], 264, 14, 21, 4, 28, 0.45),
+    (["parmesan", "parmesano", "parmesao"], 431, 38, 29, 4, 5, 0.4),
+    (["fresh cheese", "queso fresco", "queijo minas", "queijo fresco"], 264, 18, 20, 3, 30, 0.45),
+    (["cheese", "cheddar", "queso", "queijo"], 403, 25, 33, 1.3, 20, 0.45),
+    (["sour cream", "crema agria"], 193, 2.4, 19, 4.6, 15, 1.0),
+    (["butter", "mantequilla", "manteiga"], 717, 0.9, 81, 0.1, 14, 0.95),
+    (["olive oil", "oil", "aceite de oliva", "aceite", "azeite", "oleo"], 884, 0, 100, 0, 14, 0.92),
+    (["coconut milk", "leche de coco", "leite de coco"], 230, 2.3, 24, 6, 240, 1.0),
+    (["avocado", "aguacate", "palta", "abacate"], 160, 2, 14.7, 8.5, 150, 0.9),
+    (["peanut butter", "mantequilla de mani", "mantequilla de cacahuete", "pasta de amendoim"], 588, 25, 50, 20, 16, 1.08),
+    (["almonds", "almond", "almendras", "amendoas"], 579, 21, 50, 22, 1.2, 0.6),
+    (["walnuts", "walnut", "nuts", "nueces", "nozes", "frutos secos"], 654, 15, 65, 14, 4, 0.5),
+    (["peanuts", "peanut", "mani", "cacahuetes", "amendoim"], 567, 26, 49, 16, 1, 0.6),
+    (["chia seeds", "chia", "semillas de chia", "sementes de chia"], 486, 17, 31, 42, 12, 0.65),
+    (["hummus"], 166, 7.9, 9.6, 14.3, 30, 1.0),
+    (["whey protein", "protein powder", "proteina en polvo", "whey"], 400, 80, 6, 8, 30, 0.4),
+    (["granola"], 471, 10, 20, 64, 50, 0.45),
+    (["dark chocolate", "chocolate negro", "chocolate amargo", "chocolate"], 546, 4.9, 31, 61, 10, 1.0),
+    (["honey", "miel", "mel"], 304, 0.3, 0, 82, 21, 1.42),
+    (["sugar", "azucar", "acucar"], 387, 0, 0, 100, 4, 0.85),
+    (["flour", "harina", "farinha"], 364, 10, 1, 76, 8, 0.53),
+    (["banana", "platano", "guineo"], 89, 1.1, 0.3, 22.8, 118, 0.6),
+    (["apple", "manzana", "maca"], 52, 0.3, 0.2, 13.8, 182, 0.6),
+    (["orange", "naranja", "laranja"], 47, 0.9, 0.1, 11.8, 130, 0.6),
+    (["strawberries", "strawberry", "fresas", "frutillas", "morangos"], 32, 0.7, 0.3, 7.7, 12, 0.6),
+    (["blueberries", "blueberry", "berries", "arandanos", "mirtilos", "frutos rojos", "frutas vermelhas"], 57, 0.7, 0.3, 14.5, 1.5, 0.6),
+    (["mango", "manga"], 60, 0.8, 0.4, 15, 200, 0.65),
+    (["pineapple", "pina", "abacaxi"], 50, 0.5, 0.1, 13, 80, 0.65),
+    (["broccoli", "brocoli", "brocolis"], 34, 2.8, 0.4, 6.6, 150, 0.4),
+    (["spinach", "espinaca", "espinafre"], 23, 2.9, 0.4, 3.6, 30, 0.13),
+    (["lettuce", "salad greens", "mixed greens", "lechuga", "alface"], 15, 1.4, 0.2, 2.9, 10, 0.2),
+    (["tomato", "tomate"], 18, 0.9, 0.2, 3.9, 120, 0.7),
+    (["onion", "cebolla", "cebola"], 40, 1.1, 0.1, 9.3, 110, 0.65),
+    (["carrot", "zanahoria", "cenoura"], 41, 0.9, 0.2, 9.6, 60, 0.55),
+    (["bell pepper", "pepper", "pimiento", "pimenton", "pimentao"], 31, 1, 0.3, 6, 120, 0.5),
+    (["zucchini", "calabacin", "abobrinha"], 17, 1.2, 0.3, 3.1, 200, 0.5),
+    (["cucumber", "pepino"], 15, 0.7, 0.1, 3.6, 300, 0.55),
+    (["mushrooms", "mushroom", "champinones", "hongos", "cogumelos"], 22, 3.1, 0.3, 3.3, 18, 0.3),
+    (["green beans", "judias verdes", "ejotes", "vagens"], 31, 1.8, 0.2, 7, 5, 0.45),
+    (["corn", "maiz", "milho", "elote", "choclo"], 86, 3.3, 1.4, 19, 100, 0.65),
+    (["peas", "guisantes", "arvejas", "ervilhas"], 81, 5.4, 0.4, 14.5, 0.2, 0.6),
+    (["garlic", "ajo", "alho"], 149, 6.4, 0.5, 33, 3, 0.6),
+    (["lemon", "lime", "limon", "lima", "limao"], 29, 1.1, 0.3, 9.3, 60, 1.0),
+    # Seasonings are recognized so they count as known ingredients, but their macros are negligible
+    (["salt", "black pepper", "spices", "herbs", "oregano", "cumin", "paprika", "cinnamon", "vinegar", "sal", "pimienta",
+      "especias", "hierbas", "comino", "canela", "vinagre", "pimenta", "cominho", "ervas"], 0, 0, 0, 0, 1, 0.6),
+]
+
+# Grams (or millilitres, converted with the density of the food) of each unit of measure
+MASS_UNITS = {
+    "g": 1, "gr": 1, "grs": 1, "gram": 1, "grams": 1, "gramos": 1, "gramas": 1,
+    "kg": 1000, "kilo": 1000, "kilos": 1000,
+    "oz": 28.35, "ounce": 28.35, "ounces": 28.35, "onzas": 28.35,
+    "lb": 453.6, "lbs": 453.6, "pound": 453.6, "pounds": 453.6, "libra": 453.6, "libras": 453.6,
+}
+VOLUME_UNITS = {
+    "ml": 1, "milliliters": 1, "mililitros": 1,
+    "l": 1000, "liter": 1000, "liters": 1000, "litro": 1000, "litros": 1000,
+    "cup": 240, "cups": 240, "taza": 240, "tazas": 240, "xicara": 240, "xicaras": 240,
+    "tbsp": 15, "tablespoon": 15, "tablespoons": 15, "cucharada": 15, "cucharadas": 15, "colher de sopa": 15, "colheres de sopa": 15,
+    "tsp": 5, "teaspoon": 5, "teaspoons": 5, "cucharadita": 5, "cucharaditas": 5, "colher de cha": 5, "colheres de cha": 5,
+}
+PIECE_UNITS = {
+    "slice", "slices", "rebanada", "rebanadas", "fatia", "fatias", "rodaja", "rodajas",
+    "piece", "pieces", "pieza", "piezas", "unit", "units", "unidad", "unidades", "unidade",
+    "scoop", "scoops", "clove", "cloves", "diente", "dientes", "dente", "dentes", "can", "cans", "lata", "latas",
+    "fillet", "fillets", "filete", "filetes", "file",
+}
+SIZE_FACTORS = {"small": 0.75, "medium": 1.0, "large": 1.3, "pequeno": 0.75, "pequena": 0.75, "mediano": 1.0, "mediana": 1.0, "medio": 1.0, "media": 1.0, "grande": 1.3}
+
+QUANTITY_PATTERN = r"(\d+\s+\d+/\d+|\d+/\d+|\d+(?:[.,]\d+)?)"
+UNIT_PATTERN = "|".join(re.escape(unit) for unit in sorted([*MASS_UNITS, *VOLUME_UNITS, *PIECE_UNITS], key=len, reverse=True))
+MEASURE_RE = re.compile(rf"{QUANTITY_PATTERN}\s*(?:x\s*)?({UNIT_PATTERN})\b\.?")
+COUNT_RE = re.compile(rf"^\W*{QUANTITY_PATTERN}\s*(?:x\s+)?(?!\d)")
+SIZE_RE = re.compile(r"\b(" + "|".join(SIZE_FACTORS) + r")\b")
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercase a text and strip its accents, so "Plátano" and "platano" match the same food.
+    Fraction characters become plain fractions ("½" -> "1/2").
+    """
+    text = unicodedata.normalize("NFKD", text.lower()).replace("\u2044", "/")
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def parseQuantity(text: str) -> float:
+    """
+    Convert "200", "1.5", "1,5", "1/2" or "1 1/2" to a number.
+    """
+    text = text.strip()
+    if " " in text:
+        whole, fraction = text.split(None, 1)
+        return float(whole) + parseQuantity(fraction)
+    if "/" in text:
+        numerator, denominator = text.split("/")
+        return float(numerator) / float(denominator) if float(denominator) else 0.0
+    return float(text.replace(",", "."))
+
+
+def formatQuantity(value: float, original: str) -> str:
+    """
+    Write a rescaled quantity like the original one (decimal comma kept, integers without decimals).
+    """
+    text = f"{value:g}" if value != int(value) else str(int(value))
+    return text.replace(".", ",") if "," in original else text
+
+
+class NutritionEngine:
+    def __init__(self, minCoverage: float = None, minScale: float = None, maxScale: float = None):
+        """
+        minCoverage: fraction of the quantified ingredients of a meal that must be recognized for its
+            macros to be recomputed (NUTRITION_MIN_COVERAGE, 0.8 by default).
+        minScale, maxScale: limits of the portion rescaling of a meal (NUTRITION_MIN_SCALE 0.5 and
+            NUTRITION_MAX_SCALE 1.6 by default).
+        """
+        load_dotenv()
+        self.minCoverage = minCoverage or float(os.environ.get("NUTRITION_MIN_COVERAGE", 0.8))
+        self.minScale = minScale or float(os.environ.get("NUTRITION_MIN_SCALE", 0.5))
+        self.maxScale = maxScale or float(os.environ.get("NUTRITION_MAX_SCALE", 1.6))
+
+        self.foodNames = [aliases[0] for aliases, *_ in FOOD_TABLE]
+        # Macros per gram of every food, in the order of MACROS
+        self.composition = np.array([values[:4] for _, *values in FOOD_TABLE], dtype=float) / 100
+        self.pieceGrams = np.array([values[4] for _, *values in FOOD_TABLE], dtype=float)
+        self.densities = np.array([values[5] for _, *values in FOOD_TABLE], dtype=float)
+        self.aliasToFood = {}
+        for index, (aliases, *_) in enumerate(FOOD_TABLE):
+            for alias in aliases:
+                self.aliasToFood.setdefault(normalize(alias), index)
+        # Longest aliases first, so "chicken thigh" wins over "chicken"; plurals are accepted
+        self.foodRE = re.compile(r"\b(" + "|".join(re.escape(alias) for alias in sorted(self.aliasToFood, key=len, reverse=True)) + r")(?:e?s)?\b")
+        self.tolerances = np.array([MACRO_TOLERANCES[macro] for macro in MACROS])
+
+    @lru_cache(maxsize=8192)
+    def parseIngredient(self, ingredient: str) -> dict:
+        """
+        Parse an ingredient string into a quantity and a food of the composition table.
+
+        Arguments:
+        ingredient: The ingredient as written in the menu, e.g. "200g chicken breast" or "1 cucharada de aceite".
+
+        Returns:
+        Dictionary with the food index (None if unknown), the grams (None if there is no quantity),
+        and the position of the quantity in the string, used to rewrite it when the portion is rescaled.
+        """
+        text = normalize(ingredient)
+        foodMatches = list(self.foodRE.finditer(text))
+        food = max(foodMatches, key=lambda match: len(match.group(1)), default=None)
+        foodIndex = self.aliasToFood[food.group(1)] if food else None
+
+        parsed = {"food": foodIndex, "grams": None, "quantity": None, "span": None, "unit": None}
+        measure = MEASURE_RE.search(text)
+        if measure:
+            quantity, unit = parseQuantity(measure.group(1)), measure.group(2)
+            parsed.update(quantity=quantity, span=measure.span(1), unit=unit)
+            if unit in MASS_UNITS:
+                parsed["grams"] = quantity * MASS_UNITS[unit]
+            elif unit in VOLUME_UNITS:
+                parsed["grams"] = quantity * VOLUME_UNITS[unit] * (self.densities[foodIndex] if foodIndex is not None else 1.0)
+            elif foodIndex is not None:
+                parsed["grams"] = quantity * self.pieceGrams[foodIndex]
+            return parsed
+
+        count = COUNT_RE.search(text)
+        if count:
+            quantity = parseQuantity(count.group(1))
+            parsed.update(quantity=quantity, span=count.span(1), unit="piece")
+            if foodIndex is not None:
+                size = SIZE_RE.search(text)
+                parsed["grams"] = quantity * self.pieceGrams[foodIndex] * (SIZE_FACTORS[size.group(1)] if size else 1.0)
+        return parsed
+
+    def analyzeDay(self, meals: list) -> dict:
+        """
+        Recompute the macros of every meal of a day in a single vectorized pass.
+
+        Arguments:
+        meals: The meals of the day, with the schema of the menus (ingredients, calories, protein, fats, carbohydrates).
+
+        Returns:
+        Dictionary with:
+        - computed: (meals x 4) array of macros computed from the ingredients.
+        - reported: (meals x 4) array of macros reported in the menu (NaN when missing).
+        - trusted: boolean array, True for the meals whose ingredients are covered enough to use the computed macros.
+        - macros: (meals x 4) array of the macros used for each meal (computed if trusted, reported otherwise).
+        - unrecognized: the ingredients with a quantity that matched no food.
+        """
+        mealIndexes, foodIndexes, grams = [], [], []
+        quantified = np.zeros(len(meals))
+        recognized = np.zeros(len(meals))
+        unrecognized = []
+        for mealIndex, meal in enumerate(meals):
+            for ingredient in meal.get("ingredients") or []:
+                parsed = self.parseIngredient(str(ingredient))
+                if parsed["quantity"] is None:
+                    continue
+                quantified[mealIndex] += 1
+                if parsed["food"] is None or parsed["grams"] is None:
+                    unrecognized.append(str(ingredient))
+                    continue
+                recognized[mealIndex] += 1
+                mealIndexes.append(mealIndex)
+                foodIndexes.append(parsed["food"])
+                grams.append(parsed["grams"])
+
+        computed = np.zeros((len(meals), len(MACROS)))
+        if grams:
+            np.add.at(computed, np.array(mealIndexes), self.composition[np.array(foodIndexes)] * np.array(grams)[:, None])
+        reported = np.array([[self.toNumber(meal.get(macro)) for macro in MACROS] for meal in meals], dtype=float).reshape(len(meals), len(MACROS))
+        coverage = np.divide(recognized, quantified, out=np.zeros(len(meals)), where=quantified > 0)
+        trusted = (coverage >= self.minCoverage) & (computed[:, 0] > 0)
+        macros = np.where(trusted[:, None], computed, np.nan_to_num(reported))
+        return {"computed": computed, "reported": reported, "trusted": trusted, "macros": macros, "unrecognized": unrecognized}
+
+    @staticmethod
+    def toNumber(value) -> float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    @staticmethod
+    def getBands(targets: dict) -> dict:
+        """
+        Lower and upper bound of every daily target, with the tolerances of the prompts.
+
+        Arguments:
+        targets: Daily target of each macro, {"calories": ..., "protein": ..., "fats": ..., "carbohydrates": ...}.
+        """
+        return {macro: [round(targets[macro] * (1 - MACRO_TOLERANCES[macro]), 1), round(targets[macro] * (1 + MACRO_TOLERANCES[macro]), 1)]
+                for macro in MACROS}
+
+    def solveScales(self, macros: np.ndarray, targets: np.ndarray, adjustable: np.ndarray) -> np.ndarray:
+        """
+        Portion scale of every meal so the day totals get as close as possible to the targets.
+
+        Least squares on the relative error of each macro, weighted by its tolerance (calories weigh the most),
+        plus a penalty on the change of each portion, so the meals stay close to what was proposed. The scales
+        are bounded by minScale and maxScale with an active set: the scale furthest out of its bounds is fixed
+        there and the others are solved again, and a fixed scale is released when moving it back inside would
+        lower the error. The penalty is relaxed until the day fits the bands.
+        """
+        scales = np.ones(len(macros))
+        if not adjustable.any():
+            return scales
+        weights = 1 / (self.tolerances * targets)
+        weighted = macros.T * weights[:, None]
+        goal = targets * weights
+        for penalty in (1.0, 0.1, 0.01):
+            scales = np.ones(len(macros))
+            free = adjustable.copy()
+            # Every scale is fixed or released at most a few times, the loop ends even on ties
+            for _ in range(4 * len(macros) + 4):
+                if free.any():
+                    columns = weighted[:, free]
+                    residual = goal - weighted[:, ~free] @ scales[~free]
+                    regularization = np.sqrt(penalty) * np.eye(columns.shape[1])
+                    solution = np.linalg.lstsq(np.vstack([columns, regularization]),
+                                               np.concatenate([residual, np.sqrt(penalty) * np.ones(columns.shape[1])]), rcond=None)[0]
+                    violation = np.maximum(self.minScale - solution, solution - self.maxScale)
+                    if violation.max() > 1e-9:
+                        # Only the worst scale is fixed, the others may be out of bounds only because of it
+                        worst = np.argmax(violation)
+                        scales[free] = solution
+                        scales[np.flatnonzero(free)[worst]] = np.clip(solution[worst], self.minScale, self.maxScale)
+                        free[np.flatnonzero(free)[worst]] = False
+                        scales[free] = np.clip(scales[free], self.minScale, self.maxScale)
+                        continue
+                    scales[free] = solution
+                # Gradient of the objective for the fixed scales: release the one that gains the most from moving inside
+                gradient = weighted.T @ (weighted @ scales - goal) + penalty * (scales - 1)
+                releasable = adjustable & ~free & (((scales <= self.minScale) & (gradient < -1e-9)) | ((scales >= self.maxScale) & (gradient > 1e-9)))
+                if not releasable.any():
+                    break
+                free[np.argmax(np.where(releasable, np.abs(gradient), -1))] = True
+            if self.withinBands(scales @ macros, targets).all():
+                break
+        return scales
+
+    def weightedError(self, totals: np.ndarray, targets: np.ndarray) -> float:
+        """
+        Distance of the day totals to the targets, each macro relative to its tolerance (the error solveScales minimizes).
+        """
+        return float(np.linalg.norm((totals - targets) / (self.tolerances * targets)))
+
+    def withinBands(self, totals: np.ndarray, targets: np.ndarray) -> np.ndarray:
+        return np.abs(totals - targets) <= self.tolerances * targets + 1e-9
+
+    def rescaleMeal(self, meal: dict, scale: float) -> dict:
+        """
+        Copy of a meal with the quantity of every ingredient multiplied by scale, rounded to practical amounts
+        (5 g or ml steps, half units for spoons, cups and pieces).
+        """
+        meal = copy.deepcopy(meal)
+        ingredients = []
+        for ingredient in meal.get("ingredients") or []:
+            ingredient = str(ingredient)
+            parsed = self.parseIngredient(ingredient)
+            if parsed["quantity"] is None or parsed["quantity"] == 0:
+                ingredients.append(ingredient)
+                continue
+            quantity = parsed["quantity"] * scale
+            if parsed["unit"] in MASS_UNITS or parsed["unit"] in ("ml", "milliliters", "mililitros"):
+                quantity = round(quantity / 5) * 5 if quantity >= 20 else max(round(quantity), 1)
+            else:
+                quantity = max(round(quantity * 2) / 2, 0.5)
+            # The span was found in the normalized text, which keeps the positions of the original one
+            # unless it had fraction characters; those quantities are left as written
+            start, end = parsed["span"]
+            original = normalize(ingredient)[start:end]
+            if ingredient[start:end] == original:
+                ingredient = ingredient[:start] + formatQuantity(quantity, original) + ingredient[end:]
+            ingredients.append(ingredient)
+        meal["ingredients"] = ingredients
+        return meal
+
+    def checkDay(self, meals: list, targets: dict, repair: bool = True) -> tuple:
+        """
+        Check a day against the macro bands and rescale its portions if it is outside them.
+
+        Arguments:
+        meals: The meals of the day.
+        targets: Daily target of each macro.
+        repair: Whether to rescale the portions of a day outside the bands.
+
+        Returns:
+        (meals, report). The meals carry the recomputed macros (and the rescaled ingredients if repaired).
+        The report has the reported and final totals, the bands, whether the day fits them and the scales applied.
+        """
+        targetValues = np.array([float(targets[macro]) for macro in MACROS])
+        meals = originalMeals = [copy.deepcopy(meal) for meal in meals]
+        analysis = self.analyzeDay(meals)
+        macros = analysis["macros"]
+        totals = macros.sum(axis=0)
+        scales = np.ones(len(meals))
+        repaired = False
+        if repair and len(meals) and not self.withinBands(totals, targetValues).all():
+            scales = self.solveScales(macros, targetValues, macros[:, 0] > 0)
+            if not np.allclose(scales, 1):
+                meals = [self.rescaleMeal(meal, scale) if abs(scale - 1) > 1e-3 else meal for meal, scale in zip(meals, scales)]
+                # Rounding the quantities changes the portions a little: the trusted meals are recomputed
+                rescaled = self.analyzeDay(meals)
+                rescaledMacros = np.where(analysis["trusted"][:, None], rescaled["computed"], macros * scales[:, None])
+                # A repair that does not bring the day closer to the targets is not applied
+                if self.weightedError(rescaledMacros.sum(axis=0), targetValues) < self.weightedError(totals, targetValues):
+                    macros = rescaledMacros
+                    totals = macros.sum(axis=0)
+                    repaired = True
+                else:
+                    meals = originalMeals
+                    scales = np.ones(len(meals))
+
+        for meal, mealMacros in zip(meals, macros):
+            for macro, value in zip(MACROS, mealMacros):
+                meal[macro] = int(round(value))
+
+        reportedTotals = np.nan_to_num(analysis["reported"]).sum(axis=0)
+        report = {
+            "reported": {macro: int(round(value)) for macro, value in zip(MACROS, reportedTotals)},
+            "totals": {macro: int(round(value)) for macro, value in zip(MACROS, totals)},
+            "bands": self.getBands(targets),
+            "withinBands": bool(self.withinBands(totals, targetValues).all()),
+            "repaired": repaired,
+            "scales": [round(float(scale), 2) for scale in scales],
+            "recomputedMeals": int(analysis["trusted"].sum()),
+            "unrecognized": analysis["unrecognized"],
+        }
+        return meals, report
+
+    def checkMenu(self, menu: dict, targets: dict, repair: bool = True) -> tuple:
+        """
+        Check and repair every "dayN" of a menu.
+
+        Arguments:
+        menu: The menu, {"day1": [...], ...}. Other keys are kept unchanged.
+        targets: Daily target of each macro.
+        repair: Whether to rescale the portions of the days outside the bands.
+
+        Returns:
+        (menu, report), a copy of the menu and the report of every day.
+        """
+        checkedMenu = dict(menu)
+        report = {}
+        for key, meals in menu.items():
+            if re.fullmatch(r"day\d+", key) and isinstance(meals, list) and meals:
+                checkedMenu[key], report[key] = self.checkDay(meals, targets, repair)
+        return checkedMenu, report
+
+
+def getMacroTargets(userData: dict):
+    """
+    Daily macro targets of a user profile, or None if the nutritional assessment is not complete.
+    """
+    if not userData or any(userData.get(column) is None for column in MACRO_TARGET_COLUMNS.values()):
+        return None
+    return {macro: float(userData[column]) for macro, column in MACRO_TARGET_COLUMNS.items()}
+
+
+# Ingredient words that reveal each common allergen, in English, Spanish and Portuguese
+ALLERGEN_TERMS = {
+    "peanuts": ["peanut", "mani", "cacahuete", "amendoim"],
+    "tree nuts": ["almond", "walnut", "nuts", "cashew", "hazelnut", "pistachio", "pecan", "almendra", "nuez", "nueces", "amendoa", "nozes", "castanha"],
+    "dairy": ["milk", "yogurt", "yoghurt", "cheese", "butter", "cream", "whey", "feta", "mozzarella", "parmesan", "cottage",
+              "leche", "yogur", "queso", "mantequilla", "crema", "leite", "iogurte", "queijo", "manteiga", "requeson"],
+    "eggs": ["egg", "huevo", "ovo"],
+    "gluten": ["bread", "pasta", "spaghetti", "penne", "flour", "wheat", "toast", "wrap", "bagel", "granola", "oat",
+               "pan", "harina", "trigo", "avena", "pao", "farinha", "aveia", "macarr"],
+    "fish": ["salmon", "tuna", "fish", "cod", "hake", "tilapia", "atun", "pescado", "merluza", "bacalao", "salmao", "atum", "peixe", "bacalhau"],
+    "shellfish": ["shrimp", "prawn", "crab", "lobster", "mussel", "camaron", "gamba", "camarao", "marisco"],
+    "soy": ["soy", "tofu", "edamame", "soja"],
+}
+ALLERGEN_ALIASES = {"peanut": "peanuts", "nut": "tree nuts", "nuts": "tree nuts", "tree nut": "tree nuts", "lactose": "dairy",
+                    "milk": "dairy", "egg": "eggs", "wheat": "gluten", "celiac": "gluten", "seafood": "shellfish", "soya": "soy"}
+
+
+def parseAllergies(allergies) -> list:
+    """
+    Turn the allergies of a profile ('["Peanuts", "lactose"]', "peanuts, shellfish" or a list) into
+    allergen names of ALLERGEN_TERMS. Unknown allergies are kept as plain words to look for.
+    """
+    if not allergies:
+        return []
+    if isinstance(allergies, str):
+        allergies = normalize(allergies).translate(str.maketrans("", "", '[]"')).split(",")
+    parsed = []
+    for allergy in allergies:
+        allergy = normalize(str(allergy)).strip().removesuffix(" allergy")
+        if allergy and allergy not in ("none", "no", "n/a", "ninguna", "nenhuma"):
+            parsed.append(ALLERGEN_ALIASES.get(allergy, allergy))
+    return parsed
+
+
+def findAllergens(ingredients: list, allergens: list = None) -> set:
+    """
+    Allergens present in a list of ingredients.
+
+    Arguments:
+    ingredients: The ingredient strings of a meal.
+    allergens: The allergen names to look for (see parseAllergies), every allergen of ALLERGEN_TERMS by default.
+
+    Returns:
+    The set of allergen names found.
+    """
+    text = normalize(" ".join(str(ingredient) for ingredient in ingredients or []))
+    found = set()
+    for allergen in allergens if allergens is not None else ALLERGEN_TERMS:
+        terms = ALLERGEN_TERMS.get(allergen, [allergen])
+        if any(re.search(r"\b" + re.escape(term), text) for term in terms):
+            found.add(allergen)
+    return found
+
+
+nutritionEngine = NutritionEngine()
@@ -0,0 +1,168 @@
+import os
+import re
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from structuredLogging import getLogger
+
+"""
+Password hashing service used by signUpUser, signInUser and updateBasicInformation.
+
+bcrypt runs in a dedicated process pool (PASSWORD_HASH_WORKERS, number of cores by default), so a
+login storm only keeps those processes busy and never the event loop or the other executors.
+The cost factor is configurable (BCRYPT_ROUNDS, 12 by default). A hash made with another cost keeps
+working: it is detected with needsRehash and replaced the next time the user logs in.
+
+Latency (including the wait for a free worker) and throughput of every operation are kept in getStats().
+"""
+
+logger = getLogger(__name__)
+
+# "$2b$12$..." -> 12
+BCRYPT_COST_PATTERN = re.compile(r"^\$2[abxy]?\$(\d{2})\$")
+
+
+def hashPasswordWorker(password: bytes, rounds: int) -> bytes:
+    """
+    Hash a password. Runs in a worker process, so it must stay a module-level function.
+    """
+    import bcrypt
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+
+def checkPasswordWorker(password: bytes, storedHash: bytes) -> bool:
+    """
+    Check a password against its hash. Runs in a worker process, so it must stay a module-level function.
+    """
+    import bcrypt
+    return bcrypt.checkpw(password, storedHash)
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = None, workers: int = None):
+        """
+        rounds: bcrypt cost factor of the new hashes (4 to 31).
+        workers: number of processes hashing at the same time.
+        """
+        load_dotenv()
+        self.rounds = rounds or int(os.environ.get("BCRYPT_ROUNDS", 12))
+        if not 4 <= self.rounds <= 31:
+            raise ValueError(f"BCRYPT_ROUNDS must be between 4 and 31, got {self.rounds}")
+        self.workers = workers or int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 2))
+        # The pool is started on first use, so importing the module does not fork any process
+        self.executor = None
+        self.lock = threading.Lock()
+        self.startedAt = time.monotonic()
+        self.stats = {
+            operation: {"count": 0, "errors": 0, "totalSeconds": 0.0, "maxSeconds": 0.0}
+            for operation in ("hash", "verify")
+        }
+        self.stats["rehashed"] = 0
+        self.stats["rehashSkipped"] = 0
+
+    def getExecutor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def run(self, operation: str, func, *args):
+        """
+        Run func in the process pool and record its latency. A broken pool (e.g. a worker was
+        killed) is replaced and the call is tried once more.
+
+        Arguments:
+        operation: "hash" or "verify", the counter to update.
+        func: module-level function to run.
+        args: arguments forwarded to func, picklable.
+
+        Returns:
+        The value returned by func.
+        """
+        start = time.perf_counter()
+        try:
+            try:
+                result = self.getExecutor().submit(func, *args).result()
+            except BrokenProcessPool:
+                logger.warning("Password hashing pool broken, restarting it")
+                with self.lock:
+                    self.executor = None
+                result = self.getExecutor().submit(func, *args).result()
+        except Exception:
+            with self.lock:
+                self.stats[operation]["errors"] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            counters = self.stats[operation]
+            counters["count"] += 1
+            counters["totalSeconds"] += elapsed
+            counters["maxSeconds"] = max(counters["maxSeconds"], elapsed)
+        logger.debug(f"Password {operation} took {elapsed * 1000:.0f} ms")
+        return result
+
+    def hash(self, password: str) -> str:
+        """
+        Hash a password with the configured cost.
+
+        Returns:
+        The bcrypt hash, as a string ready to be stored.
+        """
+        return self.run("hash", hashPasswordWorker, password.encode("utf-8"), self.rounds).decode("utf-8")
+
+    def verify(self, password: str, storedHash: str) -> bool:
+        """
+        Check a password against a stored hash. A malformed stored hash does not match.
+        """
+        try:
+            return self.run("verify", checkPasswordWorker, password.encode("utf-8"), storedHash.encode("utf-8"))
+        except ValueError as e:
+            logger.warning(f"Stored password hash could not be checked: {e}")
+            return False
+
+    def needsRehash(self, storedHash: str) -> bool:
+        """
+        Whether a stored hash was made with another cost than the configured one (or is not a bcrypt hash).
+        """
+        match = BCRYPT_COST_PATTERN.match(storedHash or "")
+        return match is None or int(match.group(1)) != self.rounds
+
+    def recordRehash(self, skipped: bool = False) -> None:
+        """
+        Count a hash replaced at login, or a hash kept because the password had not changed.
+        """
+        with self.lock:
+            self.stats["rehashSkipped" if skipped else "rehashed"] += 1
+
+    def getStats(self) -> dict:
+        """
+        Counters, average and maximum latency in milliseconds and throughput (operations per second
+        since the service started) of hashing and verification.
+        """
+        with self.lock:
+            uptime = max(time.monotonic() - self.startedAt, 1e-9)
+            stats = {"rounds": self.rounds, "workers": self.workers, "rehashed": self.stats["rehashed"], "rehashSkipped": self.stats["rehashSkipped"]}
+            for operation in ("hash", "verify"):
+                counters = self.stats[operation]
+                stats[operation] = {
+                    "count": counters["count"],
+                    "errors": counters["errors"],
+                    "avgMs": round(counters["totalSeconds"] / counters["count"] * 1000, 1) if counters["count"] else None,
+                    "maxMs": round(counters["maxSeconds"] * 1000, 1),
+                    "perSecond": round(counters["count"] / uptime, 3),
+                }
+        return stats
+
+    def shutdown(self):
+        """
+        Stop the worker processes, waiting for the running operations to finish.
+        """
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+passwordHasher = PasswordHasher()
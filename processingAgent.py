@@ -1,28 +1,123 @@
-from openai import OpenAI
 import os
 from dotenv import load_dotenv
-import anthropic
-import google.generativeai as genai
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from rateLimiter import TokenBucket
+from lazyResources import LazyResource
+from structuredLogging import getLogger, logPayload
+
+logger = getLogger(__name__)
+
+# Model used by each provider
+PROVIDER_MODELS = {
+    "gemini_provider": "gemini-2.5-flash",
+    "openai_provider": "gpt-4",
+    "anthropic_provider": "claude-sonnet-4-20250514",
+}
+
+# Price in USD per million tokens (input, output) used to estimate the cost of a call
+PROVIDER_PRICING = {
+    "gemini_provider": (0.30, 2.50),
+    "openai_provider": (30.0, 60.0),
+    "anthropic_provider": (3.0, 15.0),
+}
+
+def getProviderSettings(prefix: str, cast=float) -> dict:
+    """
+    Per-provider settings from the environment: <prefix>_GEMINI, <prefix>_OPENAI, <prefix>_ANTHROPIC,
+    falling back to <prefix> for every provider.
+
+    Returns:
+    Dictionary of provider name -> value, without the providers that have no setting.
+    """
+    settings = {}
+    for name in PROVIDER_MODELS:
+        value = os.environ.get(f"{prefix}_{name.removesuffix('_provider').upper()}", os.environ.get(prefix))
+        if value:
+            settings[name] = cast(value)
+    return settings
 
 class MultiLLMService:
-    def __init__(self, providers: list, prompt:str=None):
+    def __init__(self, providers: list, prompt:str=None, strategy:str=None, hedgeDelayMs:int=None, providerTimeouts:dict=None, costCaps:dict=None, cache=None, rateLimits:dict=None):
         """
         providers: list of callable providers that accept a prompt and return a response.
+        strategy: how providers are combined (LLM_STRATEGY, "sequential" by default):
+            sequential: try each provider in order until one succeeds.
+            hedged: start the next provider if the current ones have not answered within hedgeDelayMs.
+            race: start every provider at once and keep the first valid JSON.
+        hedgeDelayMs: milliseconds to wait before hedging (LLM_HEDGE_DELAY_MS, 10000 by default).
+        providerTimeouts: dictionary of provider name -> timeout in seconds (LLM_PROVIDER_TIMEOUT, 90 by default).
+        costCaps: dictionary of provider name -> maximum estimated cost in USD of a single call (LLM_COST_CAP, no cap by default).
+        cache: optional LLMResponseCache checked before calling any provider.
+        rateLimits: dictionary of provider name -> maximum calls per minute (LLM_RATE_LIMIT, no limit by default).
+            The limits are shared by every request of the process, since provider quotas are per API key.
+        Timeouts, cost caps and rate limits can be set per provider with a suffix, e.g. LLM_PROVIDER_TIMEOUT_OPENAI=60
+        or LLM_COST_CAP_ANTHROPIC=0.05 (see getProviderSettings). The dictionaries take precedence over the environment.
+        With the hedged and race strategies the losing calls are not cancelled and are billed too:
+        LLM_CONCURRENT_COST_CAP bounds the estimated cost of the calls running at the same time (no cap by default).
         """
         self.providers = providers
         self.prompt=prompt
         load_dotenv()
 
+        self.strategy = strategy or os.environ.get("LLM_STRATEGY", "sequential")
+        if self.strategy not in ("sequential", "hedged", "race"):
+            raise ValueError(f"Unknown LLM strategy: {self.strategy}")
+        self.hedgeDelayMs = hedgeDelayMs if hedgeDelayMs is not None else int(os.environ.get("LLM_HEDGE_DELAY_MS", 10000))
+        self.defaultTimeout = float(os.environ.get("LLM_PROVIDER_TIMEOUT", 90))
+        self.providerTimeouts = {**getProviderSettings("LLM_PROVIDER_TIMEOUT"), **(providerTimeouts or {})}
+        self.costCaps = {**getProviderSettings("LLM_COST_CAP"), **(costCaps or {})}
+        concurrentCostCap = os.environ.get("LLM_CONCURRENT_COST_CAP")
+        self.concurrentCostCap = float(concurrentCostCap) if concurrentCostCap else None
+        self.stats = {"abandoned": {}}
+        self.statsLock = threading.Lock()
+        self.maxOutputTokens = 8192
+        self.cache = cache
+        rateLimits = {**getProviderSettings("LLM_RATE_LIMIT"), **(rateLimits or {})}
+        self.rateLimiters = {name: TokenBucket(limit) for name, limit in rateLimits.items()}
+        # Shared by hedged and race calls. Threads of providers that lost a race finish in the background (and are billed)
+        self.executor = ThreadPoolExecutor(max_workers=int(os.environ.get("LLM_PROVIDER_WORKERS", 32)), thread_name_prefix="llm-provider")
+
         self.openai_api_key = os.environ.get("OPENAI_API_KEY")
         self.anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
         self.gemini_api_key = os.environ.get("GEMINI_API_KEY")
 
-        self.openai_client = OpenAI(api_key=self.openai_api_key) if self.openai_api_key else None
-        self.anthropic_client = anthropic.Anthropic(api_key=self.anthropic_api_key) if self.anthropic_api_key else None
-        if self.gemini_api_key: 
-            genai.configure(api_key=self.gemini_api_key)
-            self.gemini_client = genai
+        # The SDKs are imported and their clients built on first use, so importing this module stays cheap
+        self.openai_resource = LazyResource("openai client", self.createOpenAIClient)
+        self.anthropic_resource = LazyResource("anthropic client", self.createAnthropicClient)
+        self.gemini_resource = LazyResource("gemini client", self.createGeminiClient)
+
+    def createOpenAIClient(self):
+        if not self.openai_api_key:
+            return None
+        from openai import OpenAI
+        return OpenAI(api_key=self.openai_api_key)
+
+    def createAnthropicClient(self):
+        if not self.anthropic_api_key:
+            return None
+        import anthropic
+        return anthropic.Anthropic(api_key=self.anthropic_api_key)
+
+    def createGeminiClient(self):
+        if not self.gemini_api_key:
+            return None
+        import google.generativeai as genai
+        genai.configure(api_key=self.gemini_api_key)
+        return genai
+
+    @property
+    def openai_client(self):
+        return self.openai_resource.get()
+
+    @property
+    def anthropic_client(self):
+        return self.anthropic_resource.get()
+
+    @property
+    def gemini_client(self):
+        return self.gemini_resource.get()
 
     def ensureJSONFormat(self, response: str) -> object:
         """
@@ -44,35 +139,254 @@ class MultiLLMService:
         try:
             return json.loads(response)
         except json.JSONDecodeError:
-            print("Response is not valid JSON.")
+            logger.warning("Response is not valid JSON.")
             return None
 
-    def getLLMResponse(self, prompt: str) -> object:
+    def getProviderTimeout(self, provider) -> float:
+        """
+        Timeout in seconds for a single call to the given provider.
+        """
+        return self.providerTimeouts.get(provider.__name__, self.defaultTimeout)
+
+    def estimateCost(self, provider, prompt: str) -> float:
         """
-        Try each provider in order until one succeeds.
+        Estimate the worst case cost in USD of sending the prompt to the provider.
+        Uses roughly 4 characters per token and the maximum number of output tokens.
 
         Arguments:
+        provider: The provider to estimate.
+        prompt: The input prompt.
+
+        Returns:
+        The estimated cost in USD, 0 if the provider has no known pricing.
+        """
+        inputPrice, outputPrice = PROVIDER_PRICING.get(provider.__name__, (0.0, 0.0))
+        inputTokens = len(prompt) / 4
+        return (inputTokens * inputPrice + self.maxOutputTokens * outputPrice) / 1_000_000
+
+    def acquireRateLimit(self, provider) -> bool:
+        """
+        Wait for the rate limiter of the provider, at most for its timeout.
+
+        Returns:
+        True if the provider can be called, False if its rate limit did not free up in time.
+        """
+        limiter = self.rateLimiters.get(provider.__name__)
+        if limiter is None or limiter.acquire(timeout=self.getProviderTimeout(provider)):
+            return True
+        logger.warning(f"Skipping provider {provider.__name__}: rate limit reached")
+        return False
+
+    def getEligibleProviders(self, prompt: str) -> list:
+        """
+        Providers whose estimated cost for the prompt is within their cost cap.
+        """
+        eligible = []
+        for provider in self.providers:
+            cap = self.costCaps.get(provider.__name__)
+            if cap is not None and self.estimateCost(provider, prompt) > cap:
+                logger.warning(f"Skipping provider {provider.__name__}: estimated cost exceeds cap of {cap} USD")
+                continue
+            eligible.append(provider)
+        return eligible
+
+    def callProvider(self, provider, prompt: str, useCache: bool = False) -> object:
+        """
+        Call a single provider and validate its response.
+
+        Arguments:
+        provider: The provider to call.
         prompt: The input prompt to send to the LLM.
+        useCache: whether to store the response in the cache.
+
+        Returns:
+        The parsed JSON object, or None if the provider failed or returned invalid JSON.
+        """
+        try:
+            if not self.acquireRateLimit(provider):
+                return None
+            logger.debug(f"Using provider: {provider.__name__}")
+            response = provider(prompt)
+            logPayload(logger, f"Response of {provider.__name__}", response=response)
+
+            formatted_response = self.ensureJSONFormat(response)
+            if formatted_response:
+                if useCache and self.cache is not None:
+                    self.cache.set(prompt, provider.__name__, PROVIDER_MODELS.get(provider.__name__, ""), formatted_response)
+                return formatted_response
+            else:
+                logger.warning(f"Provider {provider.__name__} returned invalid JSON.")
+        
+        except Exception as e:
+            logger.error(f"Provider {provider.__name__} failed: {e}")
+        return None
+
+    def getCachedResponse(self, prompt: str, providers: list) -> object:
+        """
+        Look up the prompt in the cache, for each provider in order of preference.
+
+        Returns:
+        The cached parsed JSON object, or None on a miss.
+        """
+        for provider in providers:
+            cached_response = self.cache.get(prompt, provider.__name__, PROVIDER_MODELS.get(provider.__name__, ""))
+            if cached_response is not None:
+                logger.debug(f"Cache hit for provider {provider.__name__}")
+                return cached_response
+        return None
+
+    def getLLMResponse(self, prompt: str, useCache: bool = False) -> object:
+        """
+        Get a response using the configured strategy.
+
+        Arguments:
+        prompt: The input prompt to send to the LLM.
+        useCache: whether a cached response for the same prompt may be returned, and the new one stored.
+            Only for deterministic prompts (getAISuggestion, getDetailedReport): a menu asked again must be a new one.
 
         Returns:
         The parsed JSON object from the first successful provider, or None if all fail.
         """
-        for provider in self.providers:
-            try:
-                print(f"Using provider: {provider.__name__}")
-                response = provider(prompt)
-                print(f"Response: {response}")
+        providers = self.getEligibleProviders(prompt)
+        if useCache and self.cache is not None:
+            cached_response = self.getCachedResponse(prompt, providers)
+            if cached_response is not None:
+                return cached_response
+
+        if self.strategy == "race":
+            return self.getConcurrentLLMResponse(prompt, providers, hedgeDelay=0, useCache=useCache)
+        if self.strategy == "hedged":
+            return self.getConcurrentLLMResponse(prompt, providers, hedgeDelay=self.hedgeDelayMs / 1000, useCache=useCache)
+
+        # Try each provider in order until one succeeds
+        for provider in providers:
+            formatted_response = self.callProvider(provider, prompt, useCache)
+            if formatted_response:
+                return formatted_response
+        return None
+
+    def getConcurrentLLMResponse(self, prompt: str, providers: list, hedgeDelay: float, useCache: bool = False) -> object:
+        """
+        Run providers concurrently and return the first valid JSON.
+        Providers are started in order: the next one starts when every running provider has failed,
+        or when none of them answered within hedgeDelay seconds. A hedgeDelay of 0 starts all of them at once.
+
+        The HTTP calls of the providers that lose cannot be cancelled: they run to completion in the background
+        and are billed like the winner. Their estimated cost is counted in getStats(), and with a concurrent
+        cost cap (LLM_CONCURRENT_COST_CAP) a provider is only started alongside the running ones while the
+        estimated cost of all of them stays within the cap; otherwise it waits for them to fail.
+
+        Arguments:
+        prompt: The input prompt to send to the LLM.
+        providers: The providers to use, in order of preference.
+        hedgeDelay: Seconds to wait before starting the next provider.
+        useCache: whether to store the response in the cache.
+
+        Returns:
+        The parsed JSON object from the first successful provider, or None if all fail.
+        """
+        pending = list(providers)
+        running = {}
+
+        def launch():
+            provider = pending.pop(0)
+            running[self.executor.submit(self.callProvider, provider, prompt, useCache)] = provider
+
+        def canRunConcurrently():
+            if not pending:
+                return False
+            if self.concurrentCostCap is None or not running:
+                return True
+            committed = sum(self.estimateCost(provider, prompt) for provider in running.values())
+            return committed + self.estimateCost(pending[0], prompt) <= self.concurrentCostCap
 
-                formatted_response = self.ensureJSONFormat(response)
+        if pending:
+            launch()
+        while running:
+            while hedgeDelay == 0 and canRunConcurrently():
+                launch()
+            hedging = canRunConcurrently()
+            done, _ = wait(running, timeout=hedgeDelay if hedging else None, return_when=FIRST_COMPLETED)
+            if not done:
+                logger.info(f"No provider answered within {hedgeDelay}s, hedging with {pending[0].__name__}")
+                launch()
+                continue
+            for future in done:
+                provider = running.pop(future)
+                formatted_response = future.result()
                 if formatted_response:
+                    self.recordAbandoned(list(running.values()), prompt)
+                    logger.info(f"Provider {provider.__name__} won with strategy {self.strategy}")
                     return formatted_response
-                else:
-                    print(f"Provider {provider.__name__} returned invalid JSON.")    
-            
-            except Exception as e:
-                print(f"Provider {provider.__name__} failed: {e}")
+                # The provider failed, fall back to the next one right away
+                if pending:
+                    launch()
         return None
 
+    def recordAbandoned(self, providers: list, prompt: str) -> None:
+        """
+        Count the calls still running when another provider won. They are not cancelled and are still billed.
+        """
+        if not providers:
+            return
+        with self.statsLock:
+            for provider in providers:
+                counters = self.stats["abandoned"].setdefault(provider.__name__, {"calls": 0, "estimatedCostUSD": 0.0})
+                counters["calls"] += 1
+                counters["estimatedCostUSD"] += self.estimateCost(provider, prompt)
+        logger.info(f"Providers still running after the winner, billed anyway: {[provider.__name__ for provider in providers]}")
+
+    def getStats(self) -> dict:
+        """
+        Strategy, provider settings, and calls (with their estimated cost) that lost a hedged or race call.
+        """
+        with self.statsLock:
+            abandoned = {name: {"calls": counters["calls"], "estimatedCostUSD": round(counters["estimatedCostUSD"], 4)}
+                         for name, counters in self.stats["abandoned"].items()}
+        return {
+            "strategy": self.strategy,
+            "providerTimeouts": {name: self.providerTimeouts.get(name, self.defaultTimeout) for name in PROVIDER_MODELS},
+            "costCaps": self.costCaps,
+            "concurrentCostCap": self.concurrentCostCap,
+            "abandoned": abandoned,
+        }
+
+    def getLLMResponseStream(self, prompt: str):
+        """
+        Stream the raw text of the response, chunk by chunk.
+        Falls back to the next provider only if the current one fails before producing any text,
+        because chunks that were already yielded cannot be taken back.
+
+        Arguments:
+        prompt: The input prompt to send to the LLM.
+
+        Yields:
+        Text chunks of the response as they are produced by the provider.
+        """
+        streamingProviders = {
+            "gemini_provider": self.gemini_stream_provider,
+            "openai_provider": self.openai_stream_provider,
+            "anthropic_provider": self.anthropic_stream_provider,
+        }
+        for provider in self.getEligibleProviders(prompt):
+            # Providers without streaming support produce the whole response as a single chunk
+            streamingProvider = streamingProviders.get(provider.__name__, lambda prompt, provider=provider: iter([provider(prompt)]))
+            producedText = False
+            if not self.acquireRateLimit(provider):
+                continue
+            try:
+                logger.debug(f"Streaming with provider: {provider.__name__}")
+                for chunk in streamingProvider(prompt):
+                    if chunk:
+                        producedText = True
+                        yield chunk
+                return
+            except Exception as e:
+                logger.error(f"Provider {provider.__name__} failed while streaming: {e}")
+                if producedText:
+                    raise
+        raise RuntimeError("Every provider failed to stream a response")
+
     def openai_provider(self, prompt:str) -> str:
         """
         Call OpenAI API with the given prompt and return the response as a string.
@@ -85,13 +399,14 @@ class MultiLLMService:
         """
         # Make API call
         response = self.openai_client.chat.completions.create(
-            model="gpt-4",
+            model=PROVIDER_MODELS["openai_provider"],
             messages=[{"role" : "user", "content" : prompt}],
-            temperature=0.4  # Low temperature for consistent output
+            temperature=0.4,  # Low temperature for consistent output
+            timeout=self.getProviderTimeout(self.openai_provider)
         )
         # Parse the response as JSON
         result = response.choices[0].message.content.strip()
-        print("OpenAI response successful: ")
+        logger.debug("OpenAI response successful")
         return result
 
     def anthropic_provider(self, prompt: str) -> str:
@@ -105,15 +420,16 @@ class MultiLLMService:
             str: The response from the Anthropic API.
         """
         response = self.anthropic_client.messages.create(
-            model="claude-sonnet-4-20250514",
+            model=PROVIDER_MODELS["anthropic_provider"],
             temperature=0.4,
-            max_tokens=8192,
+            max_tokens=self.maxOutputTokens,
             messages=[
                 {"role" : "user", "content" : prompt}
-            ]
+            ],
+            timeout=self.getProviderTimeout(self.anthropic_provider)
         )
         result = response.content[0].text.strip()
-        print("Anthropic response successful: ")
+        logger.debug("Anthropic response successful")
         return result
 
     def gemini_provider(self, prompt: str) -> str:
@@ -126,10 +442,201 @@ class MultiLLMService:
         Returns:
             str: The response from the gemini API.
         """
-        model = self.gemini_client.GenerativeModel("gemini-2.5-flash")
-        response = model.generate_content(prompt, generation_config={"temperature": 0.4})
+        model = self.gemini_client.GenerativeModel(PROVIDER_MODELS["gemini_provider"])
+        response = model.generate_content(
+            prompt,
+            generation_config={"temperature": 0.4},
+            request_options={"timeout": self.getProviderTimeout(self.gemini_provider)}
+        )
         result = response.text
-        print("Gemini response successful: ")
+        logger.debug("Gemini response successful")
         return result
 
+    def openai_stream_provider(self, prompt: str):
+        """
+        Stream the OpenAI response for the given prompt.
 
+        Args:
+            prompt (str): The input prompt to send to the LLM.
+
+        Yields:
+            str: Text chunks of the response.
+        """
+        stream = self.openai_client.chat.completions.create(
+            model=PROVIDER_MODELS["openai_provider"],
+            messages=[{"role" : "user", "content" : prompt}],
+            temperature=0.4,
+            stream=True,
+            timeout=self.getProviderTimeout(self.openai_provider)
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def anthropic_stream_provider(self, prompt: str):
+        """
+        Stream the Anthropic response for the given prompt.
+
+        Args:
+            prompt (str): The input prompt to send to the LLM.
+
+        Yields:
+            str: Text chunks of the response.
+        """
+        with self.anthropic_client.messages.stream(
+            model=PROVIDER_MODELS["anthropic_provider"],
+            temperature=0.4,
+            max_tokens=self.maxOutputTokens,
+            messages=[
+                {"role" : "user", "content" : prompt}
+            ],
+            timeout=self.getProviderTimeout(self.anthropic_provider)
+        ) as stream:
+            for text in stream.text_stream:
+                yield text
+
+    def gemini_stream_provider(self, prompt: str):
+        """
+        Stream the gemini response for the given prompt.
+
+        Args:
+            prompt (str): The input prompt to send to the LLM.
+
+        Yields:
+            str: Text chunks of the response.
+        """
+        model = self.gemini_client.GenerativeModel(PROVIDER_MODELS["gemini_provider"])
+        response = model.generate_content(
+            prompt,
+            generation_config={"temperature": 0.4},
+            request_options={"timeout": self.getProviderTimeout(self.gemini_provider)},
+            stream=True
+        )
+        for chunk in response:
+            yield chunk.text
+
+    def submitOpenAIBatch(self, prompts: dict) -> str:
+        """
+        Submit several prompts to the OpenAI Batch API. Batches are cheaper than single calls and don't
+        count against the rate limit of the synchronous API, but may take up to 24 hours.
+
+        Args:
+            prompts (dict): custom id -> prompt.
+
+        Returns:
+            str: ID of the OpenAI batch, used to collect the results with getOpenAIBatchResults.
+        """
+        if self.openai_client is None:
+            raise RuntimeError("OpenAI batches need OPENAI_API_KEY")
+        lines = []
+        for customID, prompt in prompts.items():
+            lines.append(json.dumps({
+                "custom_id": str(customID),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": PROVIDER_MODELS["openai_provider"],
+                    "messages": [{"role": "user", "content": prompt}],
+                    "temperature": 0.4,
+                },
+            }, ensure_ascii=False))
+        batchFile = self.openai_client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = self.openai_client.batches.create(input_file_id=batchFile.id, endpoint="/v1/chat/completions", completion_window="24h")
+        logger.info(f"Submitted OpenAI batch {batch.id} with {len(prompts)} prompts")
+        return batch.id
+
+    def getOpenAIBatchResults(self, batchID: str) -> tuple:
+        """
+        Check an OpenAI batch and collect its results once it has finished.
+
+        Args:
+            batchID (str): ID returned by submitOpenAIBatch.
+
+        Returns:
+            tuple: (status, results). status is the OpenAI batch status. results is None until the batch
+            has finished, then a dictionary of custom id -> parsed JSON response (None if it was not valid JSON).
+            Prompts that failed inside the batch are left out.
+        """
+        batch = self.openai_client.batches.retrieve(batchID)
+        if batch.status not in ("completed", "failed", "expired", "cancelled"):
+            return batch.status, None
+
+        results = {}
+        if batch.output_file_id:
+            output = self.openai_client.files.content(batch.output_file_id).text
+            for line in output.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                body = (record.get("response") or {}).get("body") or {}
+                choices = body.get("choices") or []
+                if choices:
+                    results[record["custom_id"]] = self.ensureJSONFormat(choices[0]["message"]["content"].strip())
+        return batch.status, results
+
+
+class PartialJSONObjectParser:
+    def __init__(self):
+        """
+        Incremental parser for a JSON object that arrives in chunks, such as an LLM token stream.
+        Every top level member whose value is an object or an array is returned as soon as its
+        closing bracket arrives. Text before the opening brace (e.g. a ```json fence) is ignored.
+        """
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.inString = False
+        self.escaped = False
+        self.stringStart = None
+        self.lastKey = None
+        self.currentKey = None
+        self.valueStart = None
+        self.members = {}
+
+    def feed(self, text: str) -> list:
+        """
+        Add a chunk of text to the parser.
+
+        Arguments:
+        text: The next chunk of the stream.
+
+        Returns:
+        List of (key, value) tuples for the members completed by this chunk.
+        """
+        self.buffer += text
+        completed = []
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.inString:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.inString = False
+                    # Strings directly inside the top level object are member keys (or scalar values, which are ignored)
+                    if self.depth == 1 and self.valueStart is None:
+                        try:
+                            self.lastKey = json.loads(self.buffer[self.stringStart:self.position + 1])
+                        except json.JSONDecodeError:
+                            self.lastKey = None
+            elif char == '"':
+                self.inString = True
+                self.stringStart = self.position
+            elif char in "{[":
+                if self.depth == 1 and self.valueStart is None:
+                    self.valueStart = self.position
+                    self.currentKey = self.lastKey
+                self.depth += 1
+            elif char in "}]" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 1 and self.valueStart is not None:
+                    try:
+                        value = json.loads(self.buffer[self.valueStart:self.position + 1])
+                        self.members[self.currentKey] = value
+                        completed.append((self.currentKey, value))
+                    except json.JSONDecodeError:
+                        logger.warning(f"Member {self.currentKey} of the streamed response is not valid JSON.")
+                    self.valueStart = None
+            self.position += 1
+        return completed
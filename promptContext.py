@@ -0,0 +1,170 @@
+import os
+import json
+from dotenv import load_dotenv
+
+"""
+Assembly of the variable context injected in the prompts (previous menus, chat history...).
+
+Every piece of context is a section with a priority. Sections are added to the prompt from the most
+to the least important one until the token budget of the provider is used up: the section that does
+not fit anymore is truncated, and the less important ones are left out.
+
+Tokens are counted with tiktoken when it is installed, otherwise estimated as 4 characters per token,
+the same estimate MultiLLMService uses for costs.
+"""
+
+# Maximum number of input tokens of a whole prompt (template plus context) for each provider
+PROVIDER_PROMPT_BUDGETS = {
+    "gemini_provider": 12000,
+    "openai_provider": 6000,
+    "anthropic_provider": 12000,
+}
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+
+def countTokens(text: str) -> int:
+    """
+    Count the tokens of a text.
+
+    Arguments:
+    text: The text to count.
+
+    Returns:
+    The number of tokens, exact with tiktoken and estimated otherwise.
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def truncateToTokens(text: str, maxTokens: int) -> str:
+    """
+    Cut a text to at most maxTokens, at a line boundary when possible.
+    """
+    if maxTokens <= 0:
+        return ""
+    if countTokens(text) <= maxTokens:
+        return text
+    # Room for the truncation marker
+    maxTokens = max(maxTokens - 2, 0)
+    if _encoding is not None:
+        cut = _encoding.decode(_encoding.encode(text, disallowed_special=())[:maxTokens])
+    else:
+        cut = text[:maxTokens * 4]
+    lineEnd = cut.rfind("\n")
+    if lineEnd > len(cut) // 2:
+        cut = cut[:lineEnd]
+    return cut.rstrip() + " [...]"
+
+
+def getPromptBudget(providers: list) -> int:
+    """
+    Token budget of a prompt that may be sent to any of the providers, so a fallback never
+    receives a prompt larger than its own budget.
+
+    Arguments:
+    providers: list of provider callables, as in MultiLLMService.
+
+    Returns:
+    The smallest budget of the providers. PROMPT_TOKEN_BUDGET overrides every provider budget.
+    """
+    load_dotenv()
+    if os.environ.get("PROMPT_TOKEN_BUDGET"):
+        return int(os.environ["PROMPT_TOKEN_BUDGET"])
+    budgets = [PROVIDER_PROMPT_BUDGETS[provider.__name__] for provider in providers if provider.__name__ in PROVIDER_PROMPT_BUDGETS]
+    return min(budgets) if budgets else min(PROVIDER_PROMPT_BUDGETS.values())
+
+
+def summarizeMeal(meal: dict) -> str:
+    """
+    One line description of a meal: type, hour, ingredients and macros, without instructions.
+    """
+    ingredients = ", ".join(str(ingredient) for ingredient in meal.get("ingredients") or [])
+    return (f"{meal.get('type', '')} {meal.get('hour', '')} ({ingredients}) "
+            f"{meal.get('calories')}kcal/{meal.get('protein')}p/{meal.get('fats')}f/{meal.get('carbohydrates')}c").strip()
+
+
+def summarizeMenu(menu: dict) -> str:
+    """
+    Compact summary of a menu in the dayN schema, one line per day.
+
+    Arguments:
+    menu: Dictionary of "dayN" -> list of meals (or None).
+
+    Returns:
+    The summary, or an empty string if the menu has no meals.
+    """
+    lines = []
+    for day in sorted(menu, key=lambda key: int(key[3:]) if key[3:].isdigit() else 0):
+        if menu[day]:
+            lines.append(f"{day}: " + "; ".join(summarizeMeal(meal) for meal in menu[day]))
+    return "\n".join(lines)
+
+
+def compactJSON(value) -> str:
+    """
+    JSON without indentation or whitespace between separators.
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class PromptContextBuilder:
+    def __init__(self, budget: int, reservedText: str = ""):
+        """
+        budget: maximum number of tokens of the whole prompt.
+        reservedText: fixed part of the prompt (the template and the user request), counted before any section.
+        """
+        self.budget = budget
+        self.reservedTokens = countTokens(reservedText)
+        self.sections = []
+
+    def addSection(self, name: str, parts, priority: int, separator: str = "\n", maxPartTokens: int = None) -> None:
+        """
+        Add a piece of context.
+
+        Arguments:
+        name: Name used to get the section back from build().
+        parts: The text of the section, or a list of entries (e.g. chat messages) ordered from the most
+            to the least relevant. Lists are truncated by leaving out whole entries.
+        priority: Lower values are added first and truncated last.
+        separator: Text between the entries of a list, in the built section.
+        maxPartTokens: optional maximum number of tokens of each entry of a list, longer entries are truncated.
+        """
+        if maxPartTokens is not None and not isinstance(parts, str):
+            parts = [truncateToTokens(part, maxPartTokens) for part in parts]
+        self.sections.append({"name": name, "parts": parts, "priority": priority, "separator": separator})
+
+    def build(self) -> dict:
+        """
+        Fit the sections in the budget.
+
+        Returns:
+        Dictionary of section name -> text, an empty string for the sections that did not fit.
+        """
+        remaining = self.budget - self.reservedTokens
+        built = {}
+        for section in sorted(self.sections, key=lambda section: section["priority"]):
+            parts = section["parts"]
+            if isinstance(parts, str):
+                text = truncateToTokens(parts, remaining)
+            else:
+                kept = []
+                separatorTokens = countTokens(section["separator"])
+                for part in parts:
+                    partTokens = countTokens(part) + (separatorTokens if kept else 0)
+                    if partTokens > remaining:
+                        break
+                    kept.append(part)
+                    remaining -= partTokens
+                built[section["name"]] = section["separator"].join(kept)
+                continue
+            remaining -= countTokens(text)
+            built[section["name"]] = text
+        return built
@@ -0,0 +1,179 @@
+import os
+import time
+import threading
+from string import Template
+from structuredLogging import getLogger
+
+"""
+Registry of the prompt templates stored in the prompts folder.
+
+All templates are read, parsed and validated once at startup and served from memory.
+A file is only read again when its modification time changes, so prompts can still be
+edited without restarting the service.
+"""
+
+logger = getLogger(__name__)
+
+PROMPTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+
+# Placeholders that each template must contain, and the only ones it may contain
+REQUIRED_PLACEHOLDERS = {
+    "getAISuggestion": {"additionalInformationUser_str"},
+    "getDetailedReport": {
+        "userSex", "userAge", "userObjective", "userWeight", "userHeight",
+        "userAllergies", "userSportiveDescription", "userMedicalConditions", "foodPreferences"
+    },
+    "getWeeklyMenus": {
+        "recommendedDailyCalories", "lowerRecommendedDailyCalories", "upperRecommendedDailyCalories",
+        "recommendedProteinIntake", "lowerRecommendedProteinIntake", "upperRecommendedProteinIntake",
+        "recommendedFatsIntake", "lowerRecommendedFatsIntake", "upperRecommendedFatsIntake",
+        "recommendedCarbohydratesIntake", "lowerRecommendedCarbohydratesIntake", "upperRecommendedCarbohydratesIntake",
+        "userMedicalConditions", "userSportiveDescription", "userAllergies", "foodPreferences", "country",
+        "satisfactionLevel", "portionSizeFeedback", "ingredientsFeedback", "moodFeedback",
+        "varietyFeedback", "physicalChangesFeedback", "lastWeekMenu"
+    },
+    "modifyDailyMenu": {
+        "recommendedDailyCalories", "lowerRecommendedDailyCalories", "upperRecommendedDailyCalories",
+        "recommendedProteinIntake", "lowerRecommendedProteinIntake", "upperRecommendedProteinIntake",
+        "recommendedFatsIntake", "lowerRecommendedFatsIntake", "upperRecommendedFatsIntake",
+        "recommendedCarbohydratesIntake", "lowerRecommendedCarbohydratesIntake", "upperRecommendedCarbohydratesIntake",
+        "userMedicalConditions", "userSportiveDescription", "userAllergies", "foodPreferences", "country",
+        "menuOfTheDay", "userRequest", "chatHistory", "semanticallyRelatedChatHistory", "userName", "dayKey"
+    },
+}
+
+
+class PromptRegistry:
+    def __init__(self, promptsDirectory: str = PROMPTS_DIRECTORY, requiredPlaceholders: dict = REQUIRED_PLACEHOLDERS, checkInterval: float = 1.0):
+        """
+        promptsDirectory: folder that contains the <name>.md templates.
+        requiredPlaceholders: dictionary of template name -> set of placeholders it must use.
+        checkInterval: minimum number of seconds between two modification time checks of the same file.
+        """
+        self.promptsDirectory = promptsDirectory
+        self.requiredPlaceholders = requiredPlaceholders
+        self.checkInterval = checkInterval
+        self.templates = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.loadAll()
+
+    def templatePath(self, name: str) -> str:
+        return os.path.join(self.promptsDirectory, f"{name}.md")
+
+    def loadAll(self) -> None:
+        """
+        Load and validate every registered template.
+
+        Raises:
+        ValueError if a template is missing a required placeholder or uses an unknown one.
+        """
+        for name in self.requiredPlaceholders:
+            self.templates[name] = self.loadTemplate(name)
+            self.stats[name] = {"renders": 0, "totalMs": 0.0, "maxMs": 0.0, "lastMs": 0.0, "reloads": 0}
+        logger.info(f"Loaded {len(self.templates)} prompt templates from {self.promptsDirectory}")
+
+    def loadTemplate(self, name: str) -> dict:
+        """
+        Read, parse and validate a single template.
+
+        Arguments:
+        name: name of the template, without the .md extension.
+
+        Returns:
+        Dictionary with the compiled Template and the modification time of the file.
+        """
+        path = self.templatePath(name)
+        modificationTime = os.stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as f:
+            template = Template(f.read())
+
+        placeholders = set()
+        for match in template.pattern.finditer(template.template):
+            placeholder = match.group("named") or match.group("braced")
+            if placeholder:
+                placeholders.add(placeholder)
+            elif match.group("invalid") is not None:
+                raise ValueError(f"Prompt template {name} contains an invalid placeholder")
+
+        required = self.requiredPlaceholders.get(name, set())
+        missing = required - placeholders
+        unknown = placeholders - required
+        if missing:
+            raise ValueError(f"Prompt template {name} is missing the placeholders: {sorted(missing)}")
+        if unknown:
+            raise ValueError(f"Prompt template {name} uses unknown placeholders: {sorted(unknown)}")
+
+        return {"template": template, "mtime": modificationTime, "checkedAt": time.monotonic()}
+
+    def getTemplate(self, name: str) -> Template:
+        """
+        Get the compiled template, reloading it only if the file was modified.
+        If the modified file is not valid, the previous version keeps being served.
+
+        Arguments:
+        name: name of the template, without the .md extension.
+
+        Returns:
+        The compiled Template.
+        """
+        entry = self.templates[name]
+        now = time.monotonic()
+        if now - entry["checkedAt"] < self.checkInterval:
+            return entry["template"]
+
+        with self.lock:
+            entry = self.templates[name]
+            entry["checkedAt"] = now
+            try:
+                if os.stat(self.templatePath(name)).st_mtime != entry["mtime"]:
+                    entry = self.loadTemplate(name)
+                    self.templates[name] = entry
+                    self.stats[name]["reloads"] += 1
+                    logger.info(f"Reloaded prompt template {name}")
+            except Exception as e:
+                logger.error(f"Error when reloading prompt template {name}, keeping the previous version: {e}")
+        return entry["template"]
+
+    def render(self, name: str, **values) -> str:
+        """
+        Render a template with the given values and record how long it took.
+
+        Arguments:
+        name: name of the template, without the .md extension.
+        values: value for each placeholder of the template.
+
+        Returns:
+        The rendered prompt.
+        """
+        start = time.perf_counter()
+        prompt = self.getTemplate(name).substitute(**values)
+        elapsedMs = (time.perf_counter() - start) * 1000
+
+        stats = self.stats[name]
+        stats["renders"] += 1
+        stats["totalMs"] += elapsedMs
+        stats["lastMs"] = elapsedMs
+        stats["maxMs"] = max(stats["maxMs"], elapsedMs)
+        return prompt
+
+    def getStats(self) -> dict:
+        """
+        Render timing of every template.
+
+        Returns:
+        Dictionary of template name -> renders, average, last and max render time in milliseconds and number of reloads.
+        """
+        report = {}
+        for name, stats in self.stats.items():
+            report[name] = {
+                "renders": stats["renders"],
+                "averageMs": round(stats["totalMs"] / stats["renders"], 4) if stats["renders"] else 0.0,
+                "lastMs": round(stats["lastMs"], 4),
+                "maxMs": round(stats["maxMs"], 4),
+                "reloads": stats["reloads"],
+            }
+        return report
+
+
+promptRegistry = PromptRegistry()
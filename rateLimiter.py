@@ -0,0 +1,68 @@
+import time
+import threading
+
+"""
+Token bucket used to keep the calls to each LLM provider within its rate limit.
+
+The bucket holds up to `burst` tokens and refills at ratePerMinute / 60 tokens per second.
+Every call takes one token, waiting for the refill when the bucket is empty.
+"""
+
+
+class TokenBucket:
+    def __init__(self, ratePerMinute: float, burst: int = None):
+        """
+        ratePerMinute: sustained number of calls allowed per minute.
+        burst: maximum number of calls that can be made at once after a quiet period (1 second of rate by default, at least 1).
+        """
+        self.ratePerSecond = ratePerMinute / 60
+        self.capacity = burst or max(1, int(self.ratePerSecond))
+        self.tokens = float(self.capacity)
+        self.updatedAt = time.monotonic()
+        self.lock = threading.Lock()
+        self.stats = {"acquired": 0, "rejected": 0, "waitedSeconds": 0.0}
+
+    def refill(self, now: float) -> None:
+        """
+        Add the tokens produced since the last update. Must be called with the lock held.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updatedAt) * self.ratePerSecond)
+        self.updatedAt = now
+
+    def acquire(self, timeout: float = None) -> bool:
+        """
+        Take one token, waiting until one is available.
+
+        Arguments:
+        timeout: maximum seconds to wait, None to wait as long as needed.
+
+        Returns:
+        True if a token was taken, False if the timeout expired first.
+        """
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.stats["acquired"] += 1
+                    self.stats["waitedSeconds"] += now - start
+                    return True
+                wait = (1 - self.tokens) / self.ratePerSecond
+                if deadline is not None and now + wait > deadline:
+                    self.stats["rejected"] += 1
+                    return False
+            time.sleep(wait)
+
+    def getStats(self) -> dict:
+        """
+        Bucket counters and current number of available tokens.
+        """
+        with self.lock:
+            self.refill(time.monotonic())
+            stats = dict(self.stats)
+            stats["available"] = round(self.tokens, 2)
+        stats["ratePerMinute"] = self.ratePerSecond * 60
+        return stats
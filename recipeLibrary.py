@@ -0,0 +1,364 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+import numpy as np
+from dotenv import load_dotenv
+
+from dbPool import dbPool
+from nutritionEngine import nutritionEngine, normalize, findAllergens, MACROS, ALLERGEN_TERMS, MEASURE_RE, COUNT_RE
+from menuPlanner import DAY_SLOTS
+from structuredLogging import getLogger
+
+"""
+Library of the meals generated for every user, reused to build new menus without the LLM.
+
+Every meal saved by saveWeeklyMenus and saveModifiedDailyMenu is deduplicated and stored in the recipes table:
+two meals are the same recipe when they have the same type and the same ingredients, whatever their quantities.
+Each recipe keeps its macros, its allergens, the foods of its ingredients (see nutritionEngine.py), its main
+protein and starch, and its cuisine (the country of the user it was generated for).
+
+Queries such as "lunches of 550-650 kcal with at least 40 g of protein and no peanuts" are answered from an
+in-memory index: one sorted array per macro, so every range is two binary searches, plus bit masks of the
+allergens and a recipe x food matrix for the ingredients. The index is rebuilt from the table when this process
+added recipes, or when it is older than RECIPE_INDEX_TTL seconds (recipes added by other workers).
+"""
+
+logger = getLogger(__name__)
+
+ALLERGEN_BITS = {allergen: 1 << bit for bit, allergen in enumerate(ALLERGEN_TERMS)}
+
+# Main protein and limited starch of a recipe, by food of the composition table (same categories as menuPlanner.py)
+PROTEIN_CATEGORIES = {
+    "chicken breast": "chicken", "chicken thigh": "chicken", "turkey breast": "turkey", "lean ground beef": "beef", "beef": "beef",
+    "pork loin": "pork", "ham": "pork", "bacon": "pork", "salmon": "salmon", "tuna": "tuna", "white fish": "white fish",
+    "shrimp": "shrimp", "egg": "eggs", "egg white": "eggs", "tofu": "tofu", "lentils": "legumes", "chickpeas": "legumes",
+    "black beans": "legumes", "greek yogurt": "dairy", "yogurt": "dairy", "cottage cheese": "dairy", "milk": "dairy",
+    "skim milk": "dairy", "cheese": "dairy", "fresh cheese": "dairy", "whey protein": "whey",
+}
+STARCH_CATEGORIES = {
+    "rice": "rice", "brown rice": "rice", "dry rice": "rice", "pasta": "pasta", "dry pasta": "pasta",
+    "bread": "bread", "whole wheat bread": "bread", "potato": "potato",
+}
+
+
+def stripQuantity(ingredient: str) -> str:
+    """
+    The ingredient without its quantity and unit, normalized: "200g Chicken breast" -> "chicken breast".
+    """
+    text = normalize(ingredient)
+    match = MEASURE_RE.search(text) or COUNT_RE.search(text)
+    if match:
+        text = text[:match.start()] + text[match.end():]
+    return " ".join(word for word in text.replace("(", " ").replace(")", " ").split() if word not in ("de", "of"))
+
+
+def getRecipeHash(meal: dict) -> str:
+    """
+    Key used to deduplicate recipes: the type and the ingredients without their quantities.
+    """
+    ingredients = sorted(stripQuantity(str(ingredient)) for ingredient in meal.get("ingredients") or [])
+    return hashlib.sha256(json.dumps([str(meal.get("type", "")).lower(), ingredients], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class RecipeLibrary:
+    def __init__(self, indexTTL: float = None):
+        """
+        indexTTL: seconds before the in-memory index is rebuilt to include the recipes added by other workers
+            (RECIPE_INDEX_TTL, 300 by default).
+        """
+        load_dotenv()
+        self.indexTTL = indexTTL or float(os.environ.get("RECIPE_INDEX_TTL", 300))
+        self.tablesCreated = False
+        self.index = None
+        self.indexBuiltAt = 0.0
+        self.dirty = True
+        self.lock = threading.Lock()
+        self.stats = {"added": 0, "duplicates": 0, "queries": 0, "rebuilds": 0}
+
+    def createTables(self) -> None:
+        """
+        Create the recipes table if it doesn't exist.
+        """
+        if self.tablesCreated:
+            return
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS recipes (
+                    recipe_id INT PRIMARY KEY AUTO_INCREMENT,
+                    recipe_hash CHAR(64) NOT NULL,
+                    type VARCHAR(20) NOT NULL,
+                    cuisine VARCHAR(100) DEFAULT NULL,
+                    ingredients JSON NOT NULL,
+                    instructions JSON NOT NULL,
+                    calories INT NOT NULL,
+                    protein INT NOT NULL,
+                    fats INT NOT NULL,
+                    carbohydrates INT NOT NULL,
+                    computed BOOLEAN NOT NULL DEFAULT FALSE,
+                    allergens INT NOT NULL DEFAULT 0,
+                    main_protein VARCHAR(30) DEFAULT NULL,
+                    starch VARCHAR(30) DEFAULT NULL,
+                    uses INT NOT NULL DEFAULT 1,
+                    creationDate DATETIME NOT NULL,
+                    UNIQUE KEY uq_recipe_hash (recipe_hash),
+                    INDEX idx_type_calories (type, calories)
+                );
+            """)
+        self.tablesCreated = True
+
+    def describeMeal(self, meal: dict) -> dict:
+        """
+        Macros, allergens, foods, main protein and starch of a meal. computed is True when the macros
+        come from the ingredients, False when they are those reported by the LLM.
+        """
+        analysis = nutritionEngine.analyzeDay([meal])
+        proteinGrams, starchGrams = {}, {}
+        foods = set()
+        for ingredient in meal.get("ingredients") or []:
+            parsed = nutritionEngine.parseIngredient(str(ingredient))
+            if parsed["food"] is None:
+                continue
+            name = nutritionEngine.foodNames[parsed["food"]]
+            foods.add(name)
+            grams = parsed["grams"] or 0
+            if name in PROTEIN_CATEGORIES:
+                category = PROTEIN_CATEGORIES[name]
+                proteinGrams[category] = proteinGrams.get(category, 0) + grams * nutritionEngine.composition[parsed["food"], 1]
+            if name in STARCH_CATEGORIES:
+                category = STARCH_CATEGORIES[name]
+                starchGrams[category] = starchGrams.get(category, 0) + grams
+        allergens = findAllergens(meal.get("ingredients"))
+        return {
+            "macros": [int(round(value)) for value in analysis["macros"][0]],
+            "computed": bool(analysis["trusted"][0]),
+            "allergens": sum(ALLERGEN_BITS[allergen] for allergen in allergens),
+            "foods": foods,
+            "protein": max(proteinGrams, key=proteinGrams.get) if proteinGrams else None,
+            "starch": max(starchGrams, key=starchGrams.get) if starchGrams else None,
+        }
+
+    def addMeals(self, meals: list, cuisine: str = None) -> int:
+        """
+        Add meals to the library. A meal already in it only increases the number of uses of its recipe.
+
+        Arguments:
+        meals: Meals with the schema of the menus (type, ingredients, instructions, calories...).
+        cuisine: Cuisine of the meals, the country of the user they were generated for.
+
+        Returns:
+        The number of new recipes.
+        """
+        rows = {}
+        for meal in meals:
+            if not isinstance(meal, dict) or not meal.get("type") or not meal.get("ingredients"):
+                continue
+            description = self.describeMeal(meal)
+            if description["macros"][0] <= 0:
+                continue
+            recipeHash = getRecipeHash(meal)
+            rows[recipeHash] = (
+                recipeHash, str(meal["type"]).lower(), cuisine,
+                json.dumps(meal.get("ingredients"), ensure_ascii=False), json.dumps(meal.get("instructions") or [], ensure_ascii=False),
+                *description["macros"], description["computed"], description["allergens"], description["protein"], description["starch"], datetime.now(),
+            )
+        if not rows:
+            return 0
+        self.createTables()
+        with dbPool.transaction() as (mydb, cursor):
+            cursor.execute(f"SELECT recipe_hash FROM recipes WHERE recipe_hash IN ({', '.join(['%s'] * len(rows))})", tuple(rows))
+            existing = {row[0] for row in cursor.fetchall()}
+            cursor.executemany("""
+                INSERT INTO recipes (recipe_hash, type, cuisine, ingredients, instructions, calories, protein, fats, carbohydrates,
+                    computed, allergens, main_protein, starch, creationDate)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE uses = uses + 1
+            """, list(rows.values()))
+            mydb.commit()
+        added = len(rows) - len(existing)
+        with self.lock:
+            self.stats["added"] += added
+            self.stats["duplicates"] += len(existing)
+            if added:
+                self.dirty = True
+        return added
+
+    def addMenu(self, menu: dict, cuisine: str = None) -> int:
+        """
+        Add every meal of a menu ({"day1": [...], ...}) to the library. Errors are logged and ignored,
+        so saving a menu never fails because of the library.
+
+        Returns:
+        The number of new recipes.
+        """
+        try:
+            meals = [meal for key, dayMeals in (menu or {}).items() if key.startswith("day") and isinstance(dayMeals, list) for meal in dayMeals]
+            added = self.addMeals(meals, cuisine)
+            logger.debug(f"Indexed {len(meals)} meals in the recipe library, {added} new")
+            return added
+        except Exception as e:
+            logger.error(f"Error adding meals to the recipe library: {e}")
+            return 0
+
+    def buildIndex(self) -> dict:
+        """
+        Load every recipe and build the sorted arrays, allergen masks and food matrix used by query().
+        """
+        self.createTables()
+        with dbPool.transaction(dictionary=True) as (mydb, cursor):
+            cursor.execute("""
+                SELECT recipe_id, type, cuisine, ingredients, instructions, calories, protein, fats, carbohydrates,
+                    computed, allergens, main_protein, starch, uses
+                FROM recipes
+            """)
+            rows = cursor.fetchall()
+        foodPositions = {name: position for position, name in enumerate(nutritionEngine.foodNames)}
+        foodMatrix = np.zeros((len(rows), len(foodPositions)), dtype=bool)
+        recipes = []
+        for position, row in enumerate(rows):
+            ingredients = json.loads(row["ingredients"]) if isinstance(row["ingredients"], str) else row["ingredients"]
+            instructions = json.loads(row["instructions"]) if isinstance(row["instructions"], str) else row["instructions"]
+            for ingredient in ingredients:
+                food = nutritionEngine.parseIngredient(str(ingredient))["food"]
+                if food is not None:
+                    foodMatrix[position, food] = True
+            recipes.append({
+                "recipeId": row["recipe_id"], "type": row["type"], "cuisine": row["cuisine"],
+                "ingredients": ingredients, "instructions": instructions,
+                **{macro: row[macro] for macro in MACROS},
+                "mainProtein": row["main_protein"], "starch": row["starch"], "uses": row["uses"],
+            })
+        macros = np.array([[row[macro] for macro in MACROS] for row in rows], dtype=float).reshape(len(rows), len(MACROS))
+        order = np.argsort(macros, axis=0, kind="stable").T
+        index = {
+            "recipes": recipes,
+            "types": np.array([row["type"] for row in rows], dtype=object),
+            "cuisines": np.array([normalize(row["cuisine"] or "") for row in rows], dtype=object),
+            "computed": np.array([bool(row["computed"]) for row in rows], dtype=bool),
+            "allergens": np.array([row["allergens"] for row in rows], dtype=np.int64),
+            "uses": np.array([row["uses"] for row in rows], dtype=np.int64),
+            "order": order,
+            "sorted": np.take_along_axis(macros.T, order, axis=1) if len(rows) else macros.T,
+            "foods": foodMatrix,
+        }
+        with self.lock:
+            self.index = index
+            self.indexBuiltAt = time.monotonic()
+            self.dirty = False
+            self.stats["rebuilds"] += 1
+        logger.info(f"Recipe library index built with {len(recipes)} recipes")
+        return index
+
+    def getIndex(self) -> dict:
+        if self.index is None or self.dirty or time.monotonic() - self.indexBuiltAt > self.indexTTL:
+            return self.buildIndex()
+        return self.index
+
+    def query(self, mealType: str = None, ranges: dict = None, excludeAllergens: list = None, includeIngredients: list = None,
+              excludeIngredients: list = None, cuisine: str = None, computedOnly: bool = False, limit: int = 50) -> list:
+        """
+        Find recipes.
+
+        Arguments:
+        mealType: "breakfast", "lunch", "dinner" or "snack".
+        ranges: Range of each macro, {"calories": (550, 650), "protein": (40, None)}. None leaves a side open.
+        excludeAllergens: Allergens the recipes must not contain (see nutritionEngine.parseAllergies).
+        includeIngredients: Foods every recipe must contain, e.g. ["chicken", "rice"].
+        excludeIngredients: Foods no recipe may contain.
+        cuisine: Country the recipes were generated for.
+        computedOnly: Only the recipes whose macros were computed from their ingredients.
+        limit: Maximum number of recipes, the most used first.
+
+        Returns:
+        The recipes, with their type, cuisine, ingredients, instructions and macros.
+        """
+        index = self.getIndex()
+        with self.lock:
+            self.stats["queries"] += 1
+        count = len(index["recipes"])
+        mask = np.ones(count, dtype=bool)
+        if mealType:
+            mask &= index["types"] == mealType.lower()
+        if cuisine:
+            mask &= index["cuisines"] == normalize(cuisine)
+        if computedOnly:
+            mask &= index["computed"]
+        for macro, (low, high) in (ranges or {}).items():
+            column = MACROS.index(macro)
+            start = 0 if low is None else np.searchsorted(index["sorted"][column], low, side="left")
+            end = count if high is None else np.searchsorted(index["sorted"][column], high, side="right")
+            inRange = np.zeros(count, dtype=bool)
+            inRange[index["order"][column][start:end]] = True
+            mask &= inRange
+
+        # Known allergens and foods use the masks, other words are looked for in the ingredients of the matches
+        textAllergens, textIncluded, textExcluded = [], [], []
+        excludedBits = 0
+        for allergen in excludeAllergens or []:
+            if allergen in ALLERGEN_BITS:
+                excludedBits |= ALLERGEN_BITS[allergen]
+            else:
+                textAllergens.append(allergen)
+        if excludedBits:
+            mask &= (index["allergens"] & excludedBits) == 0
+        for words, textWords, keep in ((includeIngredients, textIncluded, True), (excludeIngredients, textExcluded, False)):
+            for word in words or []:
+                food = nutritionEngine.aliasToFood.get(normalize(word).strip())
+                if food is None:
+                    textWords.append(normalize(word).strip())
+                else:
+                    mask &= index["foods"][:, food] if keep else ~index["foods"][:, food]
+
+        matches = np.flatnonzero(mask)
+        matches = matches[np.argsort(-index["uses"][matches], kind="stable")]
+        results = []
+        for position in matches:
+            recipe = index["recipes"][position]
+            if textAllergens and findAllergens(recipe["ingredients"], textAllergens):
+                continue
+            if textIncluded or textExcluded:
+                text = normalize(" ".join(str(ingredient) for ingredient in recipe["ingredients"]))
+                if not all(word in text for word in textIncluded) or any(word in text for word in textExcluded):
+                    continue
+            results.append(recipe)
+            if len(results) >= limit:
+                break
+        return results
+
+    def getPlannerMeals(self, targets: dict, allergies: list = None, cuisine: str = None, limit: int = None) -> list:
+        """
+        Recipes the menu planner can use for a user: for every meal type, the recipes whose calories can be
+        scaled to the share of the day of that type, without the user's allergens, from the user's cuisine first.
+        Only recipes with macros computed from their ingredients are used: the planner rescales the portions.
+
+        Returns:
+        Meals with the keys of the menu planner library (type, name, protein, starch, ingredients, instructions).
+        """
+        limit = limit or int(os.environ.get("RECIPE_PLANNER_CANDIDATES", 40))
+        meals = []
+        for mealType, share in DAY_SLOTS:
+            calories = (targets["calories"] * share * nutritionEngine.minScale, targets["calories"] * share * nutritionEngine.maxScale)
+            recipes = self.query(mealType, {"calories": calories}, allergies, cuisine=cuisine, computedOnly=True, limit=limit) if cuisine else []
+            if len(recipes) < limit:
+                seen = {recipe["recipeId"] for recipe in recipes}
+                recipes += [recipe for recipe in self.query(mealType, {"calories": calories}, allergies, computedOnly=True, limit=limit) if recipe["recipeId"] not in seen]
+            meals += [{
+                "type": recipe["type"], "name": f"Recipe {recipe['recipeId']}", "protein": recipe["mainProtein"], "starch": recipe["starch"],
+                "ingredients": recipe["ingredients"], "instructions": recipe["instructions"],
+            } for recipe in recipes[:limit]]
+        return meals
+
+    def getStats(self) -> dict:
+        """
+        Counters of the library and size of the in-memory index.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["indexedRecipes"] = len(self.index["recipes"]) if self.index is not None else None
+            stats["indexAgeSeconds"] = round(time.monotonic() - self.indexBuiltAt, 1) if self.index is not None else None
+        return stats
+
+
+recipeLibrary = RecipeLibrary()
@@ -0,0 +1,140 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from dotenv import load_dotenv
+from structuredLogging import getLogger
+
+"""
+Signed, stateless session tokens.
+
+A token is "<userId>.<issuedAt>.<expiresAt>.<tokenId>.<signature>", where the signature is an
+HMAC-SHA256 of the rest with SESSION_SECRET. Verifying a token only recomputes the HMAC and compares
+it in constant time: no database query and no bcrypt, so every page load can check the session cheaply.
+
+Tokens are valid for SESSION_TTL_SECONDS (7 days by default). Logging out puts the token ID in an
+in-memory revocation list until the token would have expired anyway. The list is per process:
+with several workers, revocations are only seen by the worker that received them.
+
+Without SESSION_SECRET a random secret is generated, so tokens do not survive a restart and are
+not shared between workers. main.py refuses to start that way while sessions are required.
+"""
+
+logger = getLogger(__name__)
+
+
+def encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+class SessionTokens:
+    def __init__(self, secret: str = None, ttlSeconds: int = None):
+        """
+        secret: key used to sign the tokens.
+        ttlSeconds: lifetime of a token.
+        """
+        load_dotenv()
+        secret = secret or os.environ.get("SESSION_SECRET")
+        # True when the secret is per process: tokens signed by one worker are rejected by the others
+        self.generatedSecret = not secret
+        if not secret:
+            logger.warning("SESSION_SECRET is not set, sessions will not survive a restart")
+            secret = secrets.token_hex(32)
+        self.secret = secret.encode("utf-8")
+        self.ttlSeconds = ttlSeconds or int(os.environ.get("SESSION_TTL_SECONDS", 7 * 24 * 3600))
+        # tokenId -> expiresAt of the revoked tokens
+        self.revoked = {}
+        self.lock = threading.Lock()
+        self.stats = {"issued": 0, "verified": 0, "rejected": 0, "revoked": 0}
+
+    def sign(self, payload: str) -> str:
+        return encode(hmac.new(self.secret, payload.encode("utf-8"), hashlib.sha256).digest())
+
+    def issue(self, userId: int) -> dict:
+        """
+        Create a token for a user who just proved their identity (e.g. after signInUser).
+
+        Returns:
+        Dictionary with the token and its expiration as a Unix timestamp.
+        """
+        issuedAt = int(time.time())
+        expiresAt = issuedAt + self.ttlSeconds
+        payload = f"{int(userId)}.{issuedAt}.{expiresAt}.{secrets.token_urlsafe(12)}"
+        with self.lock:
+            self.stats["issued"] += 1
+        return {"token": f"{payload}.{self.sign(payload)}", "expiresAt": expiresAt}
+
+    def parse(self, token: str):
+        """
+        Check the signature and the expiration of a token, without the revocation list.
+
+        Returns:
+        (userId, expiresAt, tokenId), or None if the token is malformed, forged or expired.
+        """
+        if not isinstance(token, str) or token.count(".") != 4:
+            return None
+        payload, signature = token.rsplit(".", 1)
+        try:
+            # Compared as bytes: compare_digest rejects str with non-ASCII characters with a TypeError
+            if not hmac.compare_digest(signature.encode("utf-8"), self.sign(payload).encode("utf-8")):
+                return None
+            userId, issuedAt, expiresAt, tokenId = payload.split(".")
+            userId, expiresAt = int(userId), int(expiresAt)
+        except (TypeError, ValueError):
+            # Also UnicodeEncodeError, e.g. lone surrogates in the header
+            return None
+        if expiresAt <= time.time():
+            return None
+        return userId, expiresAt, tokenId
+
+    def verify(self, token: str):
+        """
+        Verify a token.
+
+        Arguments:
+        token: The token sent by the client.
+
+        Returns:
+        The ID of the user of the session, or None if the token is invalid, expired or revoked.
+        """
+        parsed = self.parse(token)
+        with self.lock:
+            if parsed is None or parsed[2] in self.revoked:
+                self.stats["rejected"] += 1
+                return None
+            self.stats["verified"] += 1
+        return parsed[0]
+
+    def revoke(self, token: str) -> bool:
+        """
+        Revoke a token until its expiration, e.g. on logout.
+
+        Returns:
+        True if the token was valid and is now revoked.
+        """
+        parsed = self.parse(token)
+        if parsed is None:
+            return False
+        now = time.time()
+        with self.lock:
+            # Forget the revoked tokens that have expired in the meantime
+            self.revoked = {tokenId: expiresAt for tokenId, expiresAt in self.revoked.items() if expiresAt > now}
+            self.revoked[parsed[2]] = parsed[1]
+            self.stats["revoked"] += 1
+        return True
+
+    def getStats(self) -> dict:
+        """
+        Counters of issued, verified, rejected and revoked tokens, and size of the revocation list.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["revocationList"] = len(self.revoked)
+        stats["ttlSeconds"] = self.ttlSeconds
+        return stats
+
+
+sessionTokens = SessionTokens()
@@ -0,0 +1,146 @@
+import json
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import Future
+
+"""
+Request coalescing for duplicate in-flight calls (single-flight).
+
+While a call with a given key is running, identical calls don't run again: they wait for the first
+one and get the same result, or the same exception. Once the call has finished the key is released,
+so later calls run normally. Keys are built from the endpoint, the user ID and a hash of the input.
+
+Thread (do) and asyncio (doAsync) callers share the same in-flight calls, so a request served by an
+endpoint and a job of the job queue with the same key coalesce too. Followers receive the very same
+result object as the leader and must not modify it.
+"""
+
+
+class SingleFlight:
+    def __init__(self):
+        # key -> Future of the call in flight
+        self.flights = {}
+        # Tasks of the asyncio calls in flight
+        self.tasks = set()
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    @staticmethod
+    def makeKey(endpoint: str, userId, *inputs) -> str:
+        """
+        Build the key of a call.
+
+        Arguments:
+        endpoint: Name of the endpoint.
+        userId: ID of the user making the call.
+        inputs: The rest of the input of the call, JSON serializable.
+
+        Returns:
+        The key, "<endpoint>:<userId>:<hash of the inputs>".
+        """
+        inputHash = hashlib.sha256(json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+        return f"{endpoint}:{userId}:{inputHash}"
+
+    def join(self, key: str) -> tuple:
+        """
+        Get the call in flight for the key, or register a new one.
+
+        Returns:
+        (future, isLeader). The leader must run the call and complete the future with finish().
+        """
+        with self.lock:
+            self.stats["calls"] += 1
+            future = self.flights.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future, False
+            future = Future()
+            # A running future cannot be cancelled: a follower that is cancelled while waiting
+            # (e.g. asyncio.wrap_future on a disconnected request) leaves the call to the others
+            future.set_running_or_notify_cancel()
+            self.flights[key] = future
+            return future, True
+
+    def finish(self, key: str, future: Future, result=None, error: BaseException = None) -> None:
+        """
+        Release the key and hand the result (or exception) of the leader to the followers.
+        """
+        with self.lock:
+            if self.flights.get(key) is future:
+                del self.flights[key]
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key: str, func, *args, **kwargs):
+        """
+        Run a blocking function, unless a call with the same key is in flight.
+
+        Arguments:
+        key: Key of the call, see makeKey.
+        func: blocking callable.
+        args, kwargs: arguments forwarded to func.
+
+        Returns:
+        The value returned by func, in this call or in the call that was already in flight.
+        """
+        future, isLeader = self.join(key)
+        if not isLeader:
+            return future.result()
+        result, error = None, None
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.finish(key, future, result, error)
+        return result
+
+    async def doAsync(self, key: str, coroutineFactory):
+        """
+        Await a coroutine, unless a call with the same key is in flight.
+        The coroutine runs as its own task: if the leader's request is cancelled (e.g. the client
+        disconnected), the call goes on for the followers.
+
+        Arguments:
+        key: Key of the call, see makeKey.
+        coroutineFactory: callable without arguments that returns the coroutine to run.
+
+        Returns:
+        The value returned by the coroutine, in this call or in the call that was already in flight.
+        """
+        future, isLeader = self.join(key)
+        if isLeader:
+            async def lead():
+                result, error = None, None
+                try:
+                    result = await coroutineFactory()
+                except BaseException as e:
+                    # Also CancelledError, e.g. on shutdown: the followers get it and the key is released
+                    error = e
+                    if not isinstance(e, Exception):
+                        raise
+                finally:
+                    self.finish(key, future, result, error)
+            # The task is referenced until it finishes, so it is not garbage collected midway
+            task = asyncio.ensure_future(lead())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return await asyncio.wrap_future(future)
+
+    def getStats(self) -> dict:
+        """
+        Number of calls, calls that were coalesced and calls currently in flight.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["inFlight"] = len(self.flights)
+        return stats
+
+
+singleFlight = SingleFlight()
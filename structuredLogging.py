@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+
+"""
+Structured, leveled and non-blocking logging for every module of the backend.
+
+Records are put in a bounded in-memory queue and written to stdout by a background thread, so a
+request never waits for console I/O. If the queue is full, records are dropped and counted instead
+of blocking. Each record is one JSON line (LOG_FORMAT=json, default) or a plain text line (LOG_FORMAT=text).
+
+Settings, all changeable at runtime:
+- LOG_LEVEL: minimum level written (INFO by default).
+- LOG_SAMPLE_RATE: fraction of the DEBUG and INFO records that are written (1.0 by default).
+  Warnings and errors are always written. A record can set its own rate with extra={"sampleRate": ...}.
+- LOG_PAYLOADS: whether full payloads (prompts, LLM responses, user rows, search results) are logged
+  through logPayload (false by default).
+- LOG_FIELD_MAX_CHARS: maximum characters of the message and of every field (1000 by default).
+
+Usage:
+    logger = getLogger(__name__)
+    logger.info("Menu saved", extra={"fields": {"userId": id}})
+    logPayload(logger, "Rendered prompt", prompt=prompt)
+"""
+
+ROOT_LOGGER_NAME = "tasteai"
+
+settings = {}
+setupLock = threading.Lock()
+listener = None
+queueHandler = None
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler that drops records when the queue is full instead of raising.
+    """
+    def __init__(self, logQueue):
+        super().__init__(logQueue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of the DEBUG and INFO records.
+    """
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = getattr(record, "sampleRate", settings["sampleRate"])
+        return rate >= 1.0 or random.random() < rate
+
+
+def capValue(value):
+    """
+    Cut strings longer than LOG_FIELD_MAX_CHARS, keeping how many characters were left out.
+    """
+    if not isinstance(value, str):
+        try:
+            value = value if isinstance(value, (int, float, bool, type(None))) else json.dumps(value, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            value = str(value)
+        if not isinstance(value, str):
+            return value
+    maxChars = settings["fieldMaxChars"]
+    if len(value) > maxChars:
+        return f"{value[:maxChars]}...[+{len(value) - maxChars} chars]"
+    return value
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": capValue(record.getMessage()),
+        }
+        for key, value in (getattr(record, "fields", None) or {}).items():
+            entry[key] = capValue(value)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        fields = " ".join(f"{key}={capValue(value)}" for key, value in (getattr(record, "fields", None) or {}).items())
+        line = f"{self.formatTime(record)} {record.levelname} {record.name}: {capValue(record.getMessage())}"
+        return f"{line} {fields}" if fields else line
+
+
+def setupLogging() -> None:
+    """
+    Configure the "tasteai" logger with the queue handler and start the writer thread. Idempotent.
+    """
+    global listener, queueHandler
+    if listener is not None:
+        return
+    with setupLock:
+        if listener is not None:
+            return
+        load_dotenv()
+        settings["sampleRate"] = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+        settings["payloads"] = os.environ.get("LOG_PAYLOADS", "false").lower() == "true"
+        settings["fieldMaxChars"] = int(os.environ.get("LOG_FIELD_MAX_CHARS", 1000))
+
+        streamHandler = logging.StreamHandler(sys.stdout)
+        streamHandler.setFormatter(TextFormatter() if os.environ.get("LOG_FORMAT", "json") == "text" else JSONFormatter())
+
+        queueHandler = DroppingQueueHandler(queue.Queue(maxsize=int(os.environ.get("LOG_QUEUE_SIZE", 10000))))
+        queueHandler.addFilter(SamplingFilter())
+
+        rootLogger = logging.getLogger(ROOT_LOGGER_NAME)
+        rootLogger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        rootLogger.addHandler(queueHandler)
+        rootLogger.propagate = False
+
+        listener = QueueListener(queueHandler.queue, streamHandler, respect_handler_level=True)
+        listener.start()
+        # Write the records still in the queue when the process exits
+        atexit.register(listener.stop)
+
+
+def getLogger(name: str) -> logging.Logger:
+    """
+    Get the logger of a module.
+
+    Arguments:
+    name: Name of the module, usually __name__.
+
+    Returns:
+    A child of the "tasteai" logger.
+    """
+    setupLogging()
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
+
+
+def logPayload(logger: logging.Logger, message: str, **payload) -> None:
+    """
+    Log a full payload (prompt, LLM response, user row...) at DEBUG level, only if payload logging is enabled.
+    Every payload field is size capped like any other field.
+
+    Arguments:
+    logger: The logger of the module.
+    message: Description of the payload.
+    payload: The payload fields.
+    """
+    if settings.get("payloads") and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, extra={"fields": payload})
+
+
+def setPayloadLogging(enabled: bool) -> None:
+    """
+    Turn payload logging on or off at runtime. Payloads are logged at DEBUG level, so the level
+    must be DEBUG as well for them to be written.
+    """
+    setupLogging()
+    settings["payloads"] = bool(enabled)
+
+
+def setLogLevel(level: str) -> None:
+    """
+    Change the minimum level written, at runtime.
+    """
+    setupLogging()
+    logging.getLogger(ROOT_LOGGER_NAME).setLevel(level.upper())
+
+
+def setSampleRate(rate: float) -> None:
+    """
+    Change the fraction of DEBUG and INFO records written, at runtime.
+    """
+    setupLogging()
+    settings["sampleRate"] = min(max(float(rate), 0.0), 1.0)
+
+
+def getLoggingSettings() -> dict:
+    """
+    Current logging settings and number of records dropped because the queue was full.
+    """
+    setupLogging()
+    return {
+        "level": logging.getLevelName(logging.getLogger(ROOT_LOGGER_NAME).level),
+        "payloads": settings["payloads"],
+        "sampleRate": settings["sampleRate"],
+        "fieldMaxChars": settings["fieldMaxChars"],
+        "queued": queueHandler.queue.qsize(),
+        "dropped": queueHandler.dropped,
+    }
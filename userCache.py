@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from structuredLogging import getLogger
+
+"""
+Cache of user profiles read by viewUserById.
+
+Every projection (set of columns) of a user is cached separately, in an in-process LRU with a TTL.
+If REDIS_URL is set and the redis package is installed, entries are also shared between workers
+through Redis. Writes to the users table must call invalidate() (or set() with the fresh row),
+so readers never see a profile older than the last write of their own worker.
+
+A reader that loaded a row before a concurrent write must not cache it after the writer's invalidate():
+every user has a generation, bumped by invalidate() (in Redis too when shared). Readers take it with
+getGeneration() before the SELECT and pass it to set(), which does nothing if it changed in the meantime.
+"""
+
+logger = getLogger(__name__)
+
+
+class UserProfileCache:
+    def __init__(self, ttlSeconds: float = None, maxEntries: int = None, redisUrl: str = None):
+        """
+        ttlSeconds: seconds an entry stays valid (USER_CACHE_TTL, 300 by default).
+            With a shared backend, this also bounds how long other workers may serve a stale profile.
+        maxEntries: maximum number of cached projections in this process (USER_CACHE_MAX_ENTRIES, 10000 by default).
+        redisUrl: optional Redis URL used as shared backend (REDIS_URL).
+        """
+        load_dotenv()
+        self.ttlSeconds = ttlSeconds or float(os.environ.get("USER_CACHE_TTL", 300))
+        self.maxEntries = maxEntries or int(os.environ.get("USER_CACHE_MAX_ENTRIES", 10000))
+        self.entries = OrderedDict()
+        # userId -> number of invalidations in this process
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "sharedHits": 0, "invalidations": 0, "staleWritesSkipped": 0}
+
+        self.shared = None
+        redisUrl = redisUrl or os.environ.get("REDIS_URL")
+        if redisUrl:
+            try:
+                import redis
+                self.shared = redis.Redis.from_url(redisUrl)
+                logger.info("User profile cache shared through Redis")
+            except Exception as e:
+                logger.error(f"Shared user profile cache not available, using the in-process cache only: {e}")
+
+    @staticmethod
+    def projectionKey(columns) -> str:
+        return "*" if columns is None else ",".join(sorted(columns))
+
+    def get(self, userId: int, columns=None) -> dict:
+        """
+        Get a cached projection of a user.
+
+        Arguments:
+        userId: ID of the user.
+        columns: the projected columns, None for the full profile.
+
+        Returns:
+        A copy of the cached row, or None on a miss.
+        """
+        key = (userId, self.projectionKey(columns))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return dict(entry[1])
+            if entry is not None:
+                del self.entries[key]
+
+        if self.shared is not None:
+            try:
+                value = self.shared.hget(f"tasteai:user:{userId}", key[1])
+                if value is not None:
+                    row = json.loads(value)
+                    self.storeLocally(key, row)
+                    with self.lock:
+                        self.stats["sharedHits"] += 1
+                    return dict(row)
+            except Exception as e:
+                logger.error(f"Error reading the shared user profile cache: {e}")
+
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def storeLocally(self, key: tuple, row: dict, generation: int = None) -> bool:
+        """
+        Store an entry in this process, unless the user was invalidated since generation was taken.
+        """
+        with self.lock:
+            if generation is not None and self.generations.get(key[0], 0) != generation:
+                self.stats["staleWritesSkipped"] += 1
+                return False
+            self.entries[key] = (time.monotonic() + self.ttlSeconds, dict(row))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return True
+
+    def getGeneration(self, userId: int) -> tuple:
+        """
+        Current generation of a user, to take before reading the row that will be passed to set().
+
+        Returns:
+        (local generation, shared generation or None without Redis).
+        """
+        with self.lock:
+            localGeneration = self.generations.get(userId, 0)
+        sharedGeneration = None
+        if self.shared is not None:
+            try:
+                sharedGeneration = int(self.shared.get(f"tasteai:user:{userId}:generation") or 0)
+            except Exception as e:
+                logger.error(f"Error reading the shared user profile generation: {e}")
+        return localGeneration, sharedGeneration
+
+    def set(self, userId: int, columns, row: dict, generation: tuple = None) -> None:
+        """
+        Store a projection of a user.
+
+        Arguments:
+        userId: ID of the user.
+        columns: the projected columns, None for the full profile.
+        row: the row read from the users table.
+        generation: getGeneration() taken before the row was read. If the user was invalidated since,
+            the row may be older than the write and is not stored. None stores it unconditionally.
+        """
+        key = (userId, self.projectionKey(columns))
+        localGeneration, sharedGeneration = generation if generation is not None else (None, None)
+        if not self.storeLocally(key, row, localGeneration):
+            return
+        if self.shared is not None:
+            sharedKey = f"tasteai:user:{userId}"
+            try:
+                if generation is None or sharedGeneration is None:
+                    self.shared.hset(sharedKey, key[1], json.dumps(row, default=str))
+                    self.shared.expire(sharedKey, int(self.ttlSeconds))
+                    return
+                # The write is dropped if another worker invalidated the user after the generation was taken
+                import redis
+                with self.shared.pipeline() as pipe:
+                    try:
+                        pipe.watch(f"{sharedKey}:generation")
+                        if int(pipe.get(f"{sharedKey}:generation") or 0) != sharedGeneration:
+                            with self.lock:
+                                self.stats["staleWritesSkipped"] += 1
+                            return
+                        pipe.multi()
+                        pipe.hset(sharedKey, key[1], json.dumps(row, default=str))
+                        pipe.expire(sharedKey, int(self.ttlSeconds))
+                        pipe.execute()
+                    except redis.WatchError:
+                        with self.lock:
+                            self.stats["staleWritesSkipped"] += 1
+            except Exception as e:
+                logger.error(f"Error writing the shared user profile cache: {e}")
+
+    def invalidate(self, userId: int) -> None:
+        """
+        Drop every cached projection of a user. Must be called after any write to the user's row.
+
+        Arguments:
+        userId: ID of the user.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == userId]:
+                del self.entries[key]
+            self.generations[userId] = self.generations.get(userId, 0) + 1
+            self.stats["invalidations"] += 1
+        if self.shared is not None:
+            try:
+                sharedKey = f"tasteai:user:{userId}"
+                pipe = self.shared.pipeline()
+                pipe.incr(f"{sharedKey}:generation")
+                # Readers only compare generations during a read, a day is plenty
+                pipe.expire(f"{sharedKey}:generation", 24 * 3600)
+                pipe.delete(sharedKey)
+                pipe.execute()
+            except Exception as e:
+                logger.error(f"Error invalidating the shared user profile cache: {e}")
+
+    def getStats(self) -> dict:
+        """
+        Cache counters and current number of entries in this process.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self.entries)
+        lookups = stats["hits"] + stats["sharedHits"] + stats["misses"]
+        stats["hitRatio"] = round((stats["hits"] + stats["sharedHits"]) / lookups, 4) if lookups else 0.0
+        stats["shared"] = self.shared is not None
+        return stats
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+from abc import ABC, abstractmethod
+from typing import List, Dict
+from structuredLogging import getLogger
+
+"""
+Storage backends for the chat message embeddings used by PineconeVectorizedDatabase.
+
+1. PineconeVectorStore: the managed Pinecone index.
+2. LocalVectorStore: in-process exact cosine search over one NumPy matrix per (user, day),
+   optionally persisted as memory-mapped .npy files. No network round trip and no external service.
+
+Both return query results in the Pinecone format: {"matches": [{"id", "score", "metadata"}, ...]},
+sorted by descending score.
+"""
+
+logger = getLogger(__name__)
+
+
+class VectorStore(ABC):
+    @abstractmethod
+    def upsert(self, namespace: int, vectors: List[Dict]) -> None:
+        """
+        Insert or replace vectors of a namespace.
+
+        Arguments:
+        namespace: The partition to store the vectors (the user ID).
+        vectors: List of {'id', 'values', 'metadata'} dictionaries. metadata must contain the "day".
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def query(self, namespace: int, vector: List[float], top_k: int, day: int) -> Dict:
+        """
+        Find the vectors of a namespace and day most similar to the given vector.
+
+        Arguments:
+        namespace: The partition to search within.
+        vector: The query embedding.
+        top_k: The number of results to return.
+        day: Only vectors whose metadata day matches are returned.
+
+        Returns:
+        {"matches": [...]} sorted by descending cosine similarity.
+        """
+        raise NotImplementedError
+
+
+class PineconeVectorStore(VectorStore):
+    def __init__(self, apiKey: str, environment: str, indexName: str, statsRefreshInterval: float = 300):
+        """
+        apiKey, environment, indexName: Pinecone credentials and index.
+        statsRefreshInterval: seconds between two refreshes of the index stats snapshot.
+        """
+        from pinecone import Pinecone
+        self.pc = Pinecone(api_key=apiKey, environment=environment)
+        self.pinecone_index_name = indexName
+        self.stats_refresh_interval = statsRefreshInterval
+
+        # The index handle is created on first use and then reused by every vector operation
+        self.index = None
+        self.index_lock = threading.Lock()
+        self.index_stats = None
+        self.stats_thread = None
+
+    def initialize_index(self):
+        """
+        Get the Pinecone index connection. On first use, the index is created if it doesn't exist,
+        the handle is cached and a background thread starts refreshing the index stats.
+
+        Returns:
+        The Pinecone index object.
+        """
+        if self.index is not None:
+            return self.index
+
+        with self.index_lock:
+            if self.index is None:
+                from pinecone import ServerlessSpec
+                if self.pinecone_index_name not in self.pc.list_indexes().names():
+                    try:
+                        self.pc.create_index(
+                            name=self.pinecone_index_name,
+                            dimension=768,
+                            metric="cosine",
+                            spec=ServerlessSpec(cloud="aws",
+                                region="us-east-1")
+                        )
+                        logger.info(f"Created index: {self.pinecone_index_name}")
+                    except Exception as E:
+                        # Another worker may have created it in the meantime
+                        logger.error(f"Index {self.pinecone_index_name} could not be created ... {E}")
+                self.index = self.pc.Index(self.pinecone_index_name)
+                logger.info(f"Connected to index: {self.pinecone_index_name}")
+
+                self.stats_thread = threading.Thread(target=self.refresh_index_stats, name="pinecone-stats", daemon=True)
+                self.stats_thread.start()
+        return self.index
+
+    def refresh_index_stats(self) -> None:
+        """
+        Background loop that keeps a snapshot of the index stats, so no request has to wait for
+        describe_index_stats().
+        """
+        while True:
+            try:
+                self.index_stats = self.index.describe_index_stats()
+            except Exception as e:
+                logger.error(f"Error refreshing index stats: {e}")
+            time.sleep(self.stats_refresh_interval)
+
+    def get_index_stats(self):
+        """
+        Get the last snapshot of the index stats, or None if they have not been fetched yet.
+        """
+        return self.index_stats
+
+    def upsert(self, namespace: int, vectors: List[Dict]) -> None:
+        index = self.initialize_index()
+        index.upsert(vectors=vectors, namespace=str(namespace))
+
+    def query(self, namespace: int, vector: List[float], top_k: int, day: int) -> Dict:
+        index = self.initialize_index()
+        return index.query(
+            vector=vector,
+            top_k=top_k,
+            include_metadata=True,
+            namespace=str(namespace),
+            filter={
+                "day": {'$eq': str(day)},
+            }
+        )
+
+
+class LocalVectorStore(VectorStore):
+    def __init__(self, directory: str = None):
+        """
+        directory: folder where every (namespace, day) partition is persisted as <namespace>_<day>.npy
+        plus a .json file with its ids and metadata. Partitions are loaded memory-mapped on first use.
+        If None, vectors only live in memory.
+        """
+        self.directory = directory
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        # (namespace, day) -> {"ids": [...], "matrix": np.ndarray of L2 normalized rows, "metadata": [...]}
+        self.partitions = {}
+        self.lock = threading.Lock()
+
+    def partitionPaths(self, namespace: str, day: str) -> tuple:
+        base = os.path.join(self.directory, f"{namespace}_{day}")
+        return f"{base}.npy", f"{base}.json"
+
+    def getPartition(self, namespace: str, day: str) -> Dict:
+        """
+        Get a partition from memory, loading it from disk if needed. Must be called with the lock held.
+        """
+        key = (namespace, day)
+        if key not in self.partitions:
+            partition = {"ids": [], "matrix": np.empty((0, 0), dtype=np.float32), "metadata": []}
+            if self.directory:
+                matrixPath, recordsPath = self.partitionPaths(namespace, day)
+                if os.path.exists(matrixPath) and os.path.exists(recordsPath):
+                    with open(recordsPath, "r", encoding="utf-8") as f:
+                        records = json.load(f)
+                    partition = {"ids": records["ids"], "matrix": np.load(matrixPath, mmap_mode="r"), "metadata": records["metadata"]}
+            self.partitions[key] = partition
+        return self.partitions[key]
+
+    def savePartition(self, namespace: str, day: str, partition: Dict) -> None:
+        """
+        Persist a partition, replacing the files atomically. Must be called with the lock held.
+        """
+        if not self.directory:
+            return
+        matrixPath, recordsPath = self.partitionPaths(namespace, day)
+        with open(f"{matrixPath}.tmp", "wb") as f:
+            np.save(f, partition["matrix"])
+        with open(f"{recordsPath}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"ids": partition["ids"], "metadata": partition["metadata"]}, f, ensure_ascii=False)
+        os.replace(f"{matrixPath}.tmp", matrixPath)
+        os.replace(f"{recordsPath}.tmp", recordsPath)
+
+    def upsert(self, namespace: int, vectors: List[Dict]) -> None:
+        groups = {}
+        for vector in vectors:
+            groups.setdefault(str(vector["metadata"].get("day")), []).append(vector)
+
+        with self.lock:
+            for day, dayVectors in groups.items():
+                partition = self.getPartition(str(namespace), day)
+                ids = list(partition["ids"])
+                metadata = list(partition["metadata"])
+                rows = [np.asarray(row, dtype=np.float32) for row in partition["matrix"]]
+                positions = {vectorID: position for position, vectorID in enumerate(ids)}
+                for vector in dayVectors:
+                    values = np.asarray(vector["values"], dtype=np.float32)
+                    norm = np.linalg.norm(values)
+                    values = values / norm if norm else values
+                    if vector["id"] in positions:
+                        rows[positions[vector["id"]]] = values
+                        metadata[positions[vector["id"]]] = vector["metadata"]
+                    else:
+                        positions[vector["id"]] = len(ids)
+                        ids.append(vector["id"])
+                        rows.append(values)
+                        metadata.append(vector["metadata"])
+                partition = {"ids": ids, "matrix": np.vstack(rows), "metadata": metadata}
+                self.partitions[(str(namespace), day)] = partition
+                self.savePartition(str(namespace), day, partition)
+
+    def query(self, namespace: int, vector: List[float], top_k: int, day: int) -> Dict:
+        with self.lock:
+            partition = self.getPartition(str(namespace), str(day))
+        if not partition["ids"]:
+            return {"matches": []}
+
+        queryVector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(queryVector)
+        if norm:
+            queryVector = queryVector / norm
+        scores = partition["matrix"] @ queryVector
+
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return {"matches": [
+            {"id": partition["ids"][position], "score": float(scores[position]), "metadata": partition["metadata"][position]}
+            for position in best
+        ]}
@@ -1,9 +1,15 @@
-import google.generativeai as genai
-from pinecone import Pinecone, ServerlessSpec
 import os
 from typing import List, Dict
 from dotenv import load_dotenv
-import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from vectorStores import PineconeVectorStore, LocalVectorStore
+from lazyResources import LazyResource
+from structuredLogging import getLogger, logPayload
+
+logger = getLogger(__name__)
 
 class PineconeVectorizedDatabase:
     def __init__(self):
@@ -12,14 +18,47 @@ class PineconeVectorizedDatabase:
         self.pinecone_api_key = os.getenv('PINECONE_API_KEY')
         self.pinecone_environment = os.getenv('PINECONE_ENVIRONMENT')
         self.pinecone_index_name=os.getenv('PINECONE_INDEX_NAME')
+        self.stats_refresh_interval=float(os.getenv('PINECONE_STATS_INTERVAL', 300))
+        # "pinecone" (default) or "local" for the in-process NumPy index
+        self.vector_store_backend=os.getenv('VECTOR_STORE_BACKEND', 'pinecone')
+
+        # Embedding batches are limited by the provider, chunks of a batch run concurrently
+        self.embedding_model='models/text-embedding-004'
+        self.embedding_batch_size=int(os.getenv('EMBEDDING_BATCH_SIZE', 100))
+        self.embedding_executor=ThreadPoolExecutor(max_workers=int(os.getenv('EMBEDDING_CONCURRENCY', 4)), thread_name_prefix="embedding")
+        # LRU memo of recent embeddings, users often resend the same request
+        self.embedding_cache=OrderedDict()
+        self.embedding_cache_size=int(os.getenv('EMBEDDING_CACHE_SIZE', 1024))
+        self.embedding_cache_lock=threading.Lock()
+
+        if not self.gemini_api_key:
+            raise ValueError("GEMINI_API_KEY is not set in environment variables.")
+
+        # The vector store and the Gemini SDK are only loaded on first use
+        self.store_resource=LazyResource("vector store", self.create_store)
+        self.genai_resource=LazyResource("gemini embeddings", self.create_genai)
 
+
+    def create_store(self):
+        """
+        Build the vector store selected by VECTOR_STORE_BACKEND, or None if Pinecone is not configured.
+        """
+        if self.vector_store_backend == 'local':
+            return LocalVectorStore(os.getenv('LOCAL_VECTOR_STORE_PATH'))
         if self.pinecone_api_key and self.pinecone_environment and self.pinecone_index_name:
-            self.pc=Pinecone(api_key=self.pinecone_api_key, environment=self.pinecone_environment)
-            
-        if self.gemini_api_key:
-            genai.configure(api_key=self.gemini_api_key)
-        else:
-            raise ValueError("GEMINI_API_KEY is not set in environment variables.")
+            return PineconeVectorStore(self.pinecone_api_key, self.pinecone_environment, self.pinecone_index_name, self.stats_refresh_interval)
+        return None
+
+
+    def create_genai(self):
+        import google.generativeai as genai
+        genai.configure(api_key=self.gemini_api_key)
+        return genai
+
+
+    @property
+    def store(self):
+        return self.store_resource.get()
 
 
     def generate_embedding(self, text: str) -> List[float]:
@@ -32,47 +71,75 @@ class PineconeVectorizedDatabase:
         Returns:
         A list of floats representing the embedding vector.
         """
-        result = genai.embed_content(
-            model='models/text-embedding-004',
-            content=text,
-            task_type="retrieval_document"
-        )
-        return result['embedding']
-    
+        return self.generate_embeddings([text])[0].tolist()
+
 
-    def initialize_index(self)->Pinecone.Index:
+    def generate_embeddings(self, texts: List[str], task_type: str = "retrieval_document") -> np.ndarray:
         """
-        Initialize the Pinecone index connection. Create it if it doesn't exist.
+        Create vectorized representations of several texts using Gemini embeddings.
+        Texts are sent in chunks of at most embedding_batch_size, and the chunks run concurrently.
+        Texts embedded recently are served from an LRU memo without calling the provider.
 
         Arguments:
-        None
+        texts: The input texts to be vectorized.
+        task_type: The Gemini embedding task type.
 
         Returns:
-        The Pinecone index object.
+        A NumPy array of shape (len(texts), dimension), one row per text in the same order.
         """
-        try:
-            index=self.pc.create_index(
-                name=self.pinecone_index_name,
-                dimension=768,
-                metric="cosine",
-                spec=ServerlessSpec(cloud="aws",
-                    region="us-east-1")
-            )
-            print(f"Created index: {self.pinecone_index_name}")
-        except Exception as E:
-            print(f"Index {self.pinecone_index_name} already exists ... {E}")
-        finally:
-            # Connect to index if already existant or after creation
-            index = self.pc.Index(self.pinecone_index_name)
-            print(f"Connected to index: {self.pinecone_index_name}")
-            print(f"Index stats: {index.describe_index_stats()}")
-            return index
+        embeddings = [None] * len(texts)
+        missing = {}
+        with self.embedding_cache_lock:
+            for position, text in enumerate(texts):
+                key = (task_type, text)
+                if key in self.embedding_cache:
+                    self.embedding_cache.move_to_end(key)
+                    embeddings[position] = self.embedding_cache[key]
+                else:
+                    # Identical texts in the same batch are only embedded once
+                    missing.setdefault(text, []).append(position)
+
+        uniqueTexts = list(missing)
+        chunks = [uniqueTexts[i:i + self.embedding_batch_size] for i in range(0, len(uniqueTexts), self.embedding_batch_size)]
+        results = self.embedding_executor.map(lambda chunk: self.embed_chunk(chunk, task_type), chunks)
+
+        with self.embedding_cache_lock:
+            for chunk, chunkEmbeddings in zip(chunks, results):
+                for text, embedding in zip(chunk, chunkEmbeddings):
+                    for position in missing[text]:
+                        embeddings[position] = embedding
+                    self.embedding_cache[(task_type, text)] = embedding
+                    self.embedding_cache.move_to_end((task_type, text))
+            while len(self.embedding_cache) > self.embedding_cache_size:
+                self.embedding_cache.popitem(last=False)
+
+        if not embeddings:
+            return np.empty((0, 768), dtype=np.float32)
+        return np.vstack(embeddings)
+
+
+    def embed_chunk(self, texts: List[str], task_type: str) -> np.ndarray:
+        """
+        Embed a chunk of texts with a single request to Gemini.
 
+        Arguments:
+        texts: The input texts, at most embedding_batch_size of them.
+        task_type: The Gemini embedding task type.
 
+        Returns:
+        A NumPy array with one row per text.
+        """
+        result = self.genai_resource.get().embed_content(
+            model=self.embedding_model,
+            content=texts,
+            task_type=task_type
+        )
+        return np.asarray(result['embedding'], dtype=np.float32)
     
+
     def upsert_embedding(self, namespace: int, embedding: List[float], messageID:int,creationDate: str, query:str, day:int) -> None:
         """
-        Upsert a single embedding vector into the Pinecone index.
+        Upsert a single embedding vector into the vector store.
 
         Arguments:
         namespace: The partition to store the embedding.
@@ -84,22 +151,36 @@ class PineconeVectorizedDatabase:
         None
         """
         try:
-            index = self.initialize_index()
-            index.upsert( #Here id refers to the messageID in the chat_history table, however, id key is required for pinecone
-                vectors=[{'id':str(messageID),'values': embedding, 'metadata': {'creationDate': creationDate, "query":query, "day":str(day)}}],
-                namespace=str(namespace)
+            self.store.upsert( #Here id refers to the messageID in the chat_history table, however, id key is required for pinecone
+                namespace,
+                [{'id':str(messageID),'values': embedding, 'metadata': {'creationDate': creationDate, "query":query, "day":str(day)}}]
             )
-            print(f"Upserted embedding for namespace {namespace}")
-            # Wait for indexing
-            time.sleep(2)
-            #print(f"Updated index stats: {index.describe_index_stats()}")
+            logger.debug(f"Upserted embedding for namespace {namespace}")
         except Exception as e:
-            print(f"Error upserting embedding: {e}")
+            logger.error(f"Error upserting embedding: {e}")
+
+
+    def upsert_embeddings(self, namespace: int, vectors: List[Dict]) -> None:
+        """
+        Upsert several embedding vectors of the same namespace in a single request.
+
+        Arguments:
+        namespace: The partition to store the embeddings.
+        vectors: List of {'id', 'values', 'metadata'} dictionaries, where id is the messageID in the chat history SQL table.
+
+        returns:
+        None
+
+        Raises:
+        Any exception raised by the vector store, so the caller can retry.
+        """
+        self.store.upsert(namespace, vectors)
+        logger.debug(f"Upserted {len(vectors)} embeddings for namespace {namespace}")
 
 
     def semantic_search(self,query: str,  namespace:int, day: int, top_k: int = 10) -> List[Dict]:
         """
-        Perform semantic search using Pinecone
+        Perform semantic search using the configured vector store
 
         Arguments:
         query: The search query string.
@@ -109,24 +190,15 @@ class PineconeVectorizedDatabase:
         returns:
         A list of dictionaries containing the top_k search results with their metadata.
         """
-        # Generate query embedding and initialize index
+        # Generate query embedding
         query_embedding = self.generate_embedding(query)
-        index = self.initialize_index()
-        results=[]
-        # Search the query in Pinecone
+        results={"matches": []}
+        # Search the query in the vector store
         try:
-            results = index.query(
-                vector=query_embedding,
-                top_k=top_k,
-                include_metadata=True,
-                namespace= str(namespace), 
-                filter={
-                    "day": {'$eq': str(day)},
-                }
-            )
+            results = self.store.query(namespace, query_embedding, top_k, day)
         except Exception as e:
-            print(f"Error during search: {e}")
-            results=[]
+            logger.error(f"Error during search: {e}")
+            results={"matches": []}
         finally:
 
             #  Sort by message id to get chronological order
@@ -139,6 +211,5 @@ class PineconeVectorizedDatabase:
             filtered_matches = [m for m in trimmed_matches if m["score"] >= 0.75]
 
             results["matches"] = filtered_matches
-            print(results)
-            print(type(results))
+            logPayload(logger, "Semantic search results", results=results)
         return results